@@ -0,0 +1,450 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from gradingSession import GradingSession
+import reportSnapshot
+import graderBackups
+from storageBackends import SQLiteBackend, set_backend
+from reportCache import ReportCache, set_report_cache
+from reportIndex import ReportIndex, set_report_index
+from queryLog import QueryLog, get_query_log, set_query_log
+from progressSummary import rebuild_progress_summary
+from highlighter import benchmark_highlighter
+from reportFormatting import format_report_text
+
+# The notebook entry points need the notebook helper libraries (annotationHelperLib,
+# dxFilterLibraryPreGrading, IPython). Without them only the GradingSession and
+# highlighter benchmarks run.
+# reportMarkingFunctions and projectTableFunctions import each other: reportMarkingFunctions
+# is imported first, as in the notebooks, so it sees every function of projectTableFunctions
+try:
+    from reportMarkingFunctions import mark_reports, get_more_reports_to_grade, backup_grader_table
+    import projectTableFunctions
+    from projectTableFunctions import get_project_report_stats
+    from reliabilityLib import calculate_metric_for_graders
+except ImportError as e:
+    projectTableFunctions = None
+    notebook_import_error = e
+
+with open(f"{os.path.dirname(__file__)}/sql_tables.json", 'r', encoding='utf-8') as f:
+    sql_tables = json.load(f)
+
+with open(f"{os.path.dirname(__file__)}/phrases_to_highlight.json", 'r', encoding='utf-8') as f:
+    default_phrases = json.load(f)
+
+# Version of the results format, stored with the results
+results_version = 1
+
+# Project and grading criteria of the synthetic tables
+benchmark_project = "Benchmark"
+benchmark_criteria = "SLIP"
+benchmark_sort = ["proc_ord_datetime desc"]
+
+# Words the synthetic reports are made of (with the phrases to highlight mixed in)
+report_words = (
+    "the a of and with no there is are in on within normal mild moderate small left right bilateral "
+    "ventricles sulci brain parenchyma white matter signal intensity lesion mass effect midline shift "
+    "extra-axial collection hemorrhage restricted diffusion enhancement cerebellum brainstem sinuses "
+    "orbits visualized appears unremarkable stable compared prior study"
+).split()
+
+
+def _sentence_pool(rng, phrases, size=2000):
+    # Sentences the reports are sampled from. About one in three holds a phrase to highlight
+    pool = []
+    for _ in range(size):
+        words = list(rng.choice(report_words, rng.integers(6, 15)))
+        if len(phrases) > 0 and rng.random() < 0.3:
+            words.insert(rng.integers(0, len(words)), phrases[rng.integers(0, len(phrases))])
+        pool.append(" ".join(words).capitalize() + ".")
+    return pool
+
+
+def generate_synthetic_tables(backend, n_reports=10000, n_graders=5, project=benchmark_project,
+                              grade_criteria=benchmark_criteria, graded_fraction=0.3, validation_fraction=0.2,
+                              queued_per_grader=50, to_highlight=None, seed=0, chunk_size=100000):
+    """
+    Fill a local database with synthetic reports, patients and grades. Rows are
+    generated and loaded chunk_size reports at a time, so millions of reports fit in memory
+
+    Args:
+        backend (SQLiteBackend): backend to fill (its tables are created if needed)
+        n_reports (int): Number of reports (procedures) in the project
+        n_graders (int): Number of graders
+        project (string): Name of the project
+        grade_criteria (string): Grading criteria of the project
+        graded_fraction (float): Share of the reports already graded by one grader
+        validation_fraction (float): Share of the graded reports also graded by a second grader
+        queued_per_grader (int): Number of reports waiting in each grader's queue
+        to_highlight (dictionary): phrases to mix into the report text (default: phrases_to_highlight.json)
+        seed (int): Random seed
+        chunk_size (int): Number of reports generated at a time
+
+    Return:
+        graders (list): names of the graders
+    """
+
+    global sql_tables
+    rng = np.random.default_rng(seed)
+    if to_highlight is None:
+        to_highlight = default_phrases
+    phrases = [p for v in to_highlight.values() for p in ([v] if type(v) == str else v)]
+    sentences = np.array(_sentence_pool(rng, phrases), dtype=object)
+    graders = [f"Benchmark Grader {i}" for i in range(n_graders)]
+    backend.create_tables()
+
+    # Which reports are graded (by whom) and queued, decided up front for all chunks
+    order = rng.permutation(n_reports)
+    n_graded = int(n_reports * graded_fraction)
+    n_validation = int(n_graded * validation_fraction)
+    n_queued = min(queued_per_grader * n_graders, n_reports - n_graded)
+    first_grader = np.full(n_reports, -1)
+    second_grader = np.full(n_reports, -1)
+    queued_for = np.full(n_reports, -1)
+    first_grader[order[:n_graded]] = rng.integers(0, n_graders, n_graded)
+    if n_graders > 1:
+        validated = order[:n_validation]
+        second_grader[validated] = (first_grader[validated] + rng.integers(1, n_graders, n_validation)) % n_graders
+    queued_for[order[n_graded:n_graded + n_queued]] = np.arange(n_queued) % n_graders
+
+    for start in range(0, n_reports, chunk_size):
+        idx = np.arange(start, min(start + chunk_size, n_reports))
+        n = len(idx)
+        ids = (10000000 + idx).astype(str)
+        pat_ids = (50000000 + idx // 3).astype(str)
+        dates = pd.Timestamp("2010-01-01") + pd.to_timedelta(rng.integers(0, 5000, n), unit="D")
+        ages = rng.uniform(0, 7000, n)
+
+        backend.load_dataframe(pd.DataFrame({
+            "pat_id": pat_ids,
+            "proc_ord_id": ids,
+            "proc_ord_age": ages,
+            "proc_ord_year": dates.year,
+            "proc_ord_desc": "MRI BRAIN WO CONTRAST",
+            "proc_ord_datetime": dates.strftime("%Y-%m-%d %H:%M:%S"),
+            "encounter_id": ids,
+        }), sql_tables["procedure_table"])
+        first_of_patient = idx % 3 == 0
+        backend.load_dataframe(pd.DataFrame({
+            "pat_id": pat_ids[first_of_patient],
+            "sex": rng.choice(["F", "M"], first_of_patient.sum()),
+            "gestational_age_num": rng.normal(39, 2, first_of_patient.sum()).round(1),
+            "birth_weight_kg": rng.normal(3.4, 0.5, first_of_patient.sum()).round(2),
+        }), sql_tables["patient_table"])
+        backend.load_dataframe(pd.DataFrame({
+            "encounter_id": ids,
+            "enc_type_name": np.where(rng.random(n) < 0.05, "Reconciled Outside Data", "Appointment"),
+        }), "visits")
+        backend.load_dataframe(
+            pd.DataFrame({"pat_id": pat_ids, "proc_ord_id": ids, "project": project}), sql_tables["project_table"]
+        )
+
+        n_sentences = rng.integers(4, 12, n)
+        picks = rng.integers(0, len(sentences), n_sentences.sum())
+        bounds = np.concatenate([[0], np.cumsum(n_sentences)])
+        backend.load_dataframe(pd.DataFrame({
+            "proc_ord_id": ids,
+            "narrative_text": [
+                "CLINICAL INDICATION: " + sentences[picks[bounds[i]]] + " FINDINGS: "
+                + " ".join(sentences[picks[bounds[i] + 1:bounds[i + 1]]])
+                for i in range(n)
+            ],
+        }), sql_tables["source_table"])
+        has_impression = rng.random(n) < 0.7
+        backend.load_dataframe(pd.DataFrame({
+            "pat_id": pat_ids[has_impression],
+            "proc_ord_id": ids[has_impression],
+            "impression_text": sentences[rng.integers(0, len(sentences), has_impression.sum())],
+        }), sql_tables["impression_table"])
+
+        rows = []
+        for graders_of, graded in ((first_grader, True), (second_grader, True), (queued_for, False)):
+            mask = graders_of[idx] >= 0
+            if not mask.any():
+                continue
+            k = mask.sum()
+            rows.append(pd.DataFrame({
+                "proc_ord_id": ids[mask],
+                "name": np.array(graders, dtype=object)[graders_of[idx][mask]],
+                "grade": rng.choice([0, 1, 2, -1], k, p=[0.3, 0.3, 0.35, 0.05]) if graded else 999,
+                "grade_category": "Unique",
+                "pat_id": pat_ids[mask],
+                "age_in_days": ages[mask],
+                "proc_ord_year": dates.year[mask],
+                "proc_name": "MRI BRAIN WO CONTRAST",
+                "report_origin_table": "narrative",
+                "grade_date": (
+                    (pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, 365, k), unit="D")).strftime("%Y-%m-%d")
+                    if graded else "0000-00-00"
+                ),
+                "grade_criteria": grade_criteria,
+            }))
+        if len(rows) > 0:
+            backend.load_dataframe(pd.concat(rows, ignore_index=True), sql_tables["grader_table"])
+
+    # Without table statistics SQLite may look reports up through the project index,
+    # which holds every report here, and the project counts become quadratic
+    backend.execute("ANALYZE")
+    rebuild_progress_summary(backend)
+    return graders
+
+
+@contextlib.contextmanager
+def benchmark_environment(backend, work_dir, project=benchmark_project, grade_criteria=benchmark_criteria):
+    """
+    Point the grading functions at a synthetic database and keep them away from the
+    grader's own files: the project parameter and config files are written to work_dir,
+    and the report cache, snapshot, index, query log and backups stay in memory or in
+    work_dir. The active backend and caches are replaced for the rest of the session,
+    so run the benchmarks in their own Python process
+
+    Args:
+        backend (StorageBackend): backend holding the synthetic tables
+        work_dir (string): Directory for the project files and backups
+        project (string): Name of the synthetic project
+        grade_criteria (string): Grading criteria of the project
+    """
+
+    os.makedirs(os.path.join(work_dir, "project_params"), exist_ok=True)
+    os.makedirs(os.path.join(work_dir, "queries"), exist_ok=True)
+    with open(os.path.join(work_dir, "project_params", f"{project}.json"), "w") as f:
+        json.dump({"sort": benchmark_sort, "validation": "yes", "prioritize_validation": "yes"}, f)
+    with open(os.path.join(work_dir, "queries", "config.json"), "w") as f:
+        json.dump({project: {"grade_criteria": grade_criteria}}, f)
+
+    set_backend(backend)
+    set_report_cache(ReportCache(path=None))
+    reportSnapshot.set_report_snapshot(
+        reportSnapshot.ReportSnapshot(work_dir) if reportSnapshot.pa is not None else None
+    )
+    set_report_index(ReportIndex(":memory:"))
+    set_query_log(QueryLog(None))
+
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    if projectTableFunctions is not None:
+        base_dir = projectTableFunctions.base_dir
+        projectTableFunctions.base_dir = work_dir
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+        if projectTableFunctions is not None:
+            projectTableFunctions.base_dir = base_dir
+
+
+def _time_runs(fn, repeats, items=None):
+    # Run fn repeats times with its output hidden. fn gets the run number
+    log = get_query_log()
+    seconds, queries = [], []
+    for run in range(repeats):
+        start_record = len(log)
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            fn(run)
+            seconds.append(time.perf_counter() - start)
+        queries.append(sum(1 for r in log.records_since(start_record) if not r["operation"].startswith("step:")))
+    result = {
+        "repeats": repeats,
+        "median_seconds": float(np.median(seconds)),
+        "min_seconds": float(np.min(seconds)),
+        "max_seconds": float(np.max(seconds)),
+        "queries": int(np.median(queries)),
+    }
+    if items is not None:
+        result["items"] = items
+        result["seconds_per_item"] = result["median_seconds"] / items
+    return result
+
+
+def _grade_session(name, n_grades, rng):
+    # Grade through the GradingSession API, without the printing of mark_reports
+    with GradingSession(name, benchmark_project, batch_size=min(25, n_grades), to_highlight=default_phrases) as session:
+        for _ in range(n_grades):
+            report = session.next_report()
+            if report is None:
+                break
+            session.submit_grade(report["proc_ord_id"], rng.choice([0, 1, 2]))
+
+
+def _environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, timeout=10,
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "sqlite": sqlite3.sqlite_version,
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "git_commit": commit,
+    }
+
+
+def run_benchmarks(n_reports=10000, n_graders=5, repeats=3, num_to_add=100, n_grades=50, path=None, seed=0):
+    """
+    Build a synthetic database and time the main grading entry points against it:
+    get_project_report_stats, calculate_metric_for_graders, backup_grader_table (first
+    and incremental backup, and an incremental backup with the server-side bak_ copy),
+    get_more_reports_to_grade, mark_reports (graded by a function instead of a grader),
+    a GradingSession grading as many reports (the per-report latency without printing)
+    and the highlighter. Replaces the active backend and caches, so run it in its own
+    Python process (python benchmarks.py). Entry points whose dependencies are not
+    installed (the notebook libraries, or pyarrow for the backups) are skipped with a
+    warning
+
+    Args:
+        n_reports (int): Number of synthetic reports (10k to 10M)
+        n_graders (int): Number of synthetic graders (5 to 200)
+        repeats (int): Number of runs of each entry point
+        num_to_add (int): Reports added to the queue per get_more_reports_to_grade run
+        n_grades (int): Reports graded per mark_reports and GradingSession run
+        path (string): Database file (default: a file in a temporary directory)
+        seed (int): Random seed
+
+    Return:
+        results (dictionary): configuration, environment, setup time and, for each
+        entry point, the median/min/max seconds of its runs and its number of queries
+    """
+
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as work_dir:
+        if path is None:
+            path = os.path.join(work_dir, "benchmark.db")
+        backend = SQLiteBackend(path)
+        start = time.perf_counter()
+        graders = generate_synthetic_tables(
+            backend, n_reports, n_graders, queued_per_grader=2 * n_grades * repeats, seed=seed
+        )
+        setup_seconds = time.perf_counter() - start
+
+        results = {}
+        with benchmark_environment(backend, work_dir):
+            backup_root = os.path.join(work_dir, "backups")
+            run_backups = projectTableFunctions is not None and graderBackups.pa is not None
+            if graderBackups.pa is None:
+                print("WARNING: pyarrow is not installed, the backup benchmarks are skipped")
+            if projectTableFunctions is None:
+                print("WARNING: the notebook entry points are skipped:", notebook_import_error)
+            else:
+                results["get_project_report_stats"] = _time_runs(
+                    lambda run: get_project_report_stats(benchmark_project), repeats
+                )
+                results["calculate_metric_for_graders"] = _time_runs(
+                    lambda run: calculate_metric_for_graders(graders, "kappa", benchmark_project), repeats
+                )
+            if run_backups:
+                results["backup_grader_table_first"] = _time_runs(
+                    lambda run: backup_grader_table(root=backup_root), 1
+                )
+            if projectTableFunctions is not None:
+                results["get_more_reports_to_grade"] = _time_runs(
+                    lambda run: get_more_reports_to_grade(graders[run % n_graders], benchmark_project, num_to_add),
+                    repeats, items=num_to_add,
+                )
+                results["mark_reports"] = _time_runs(
+                    lambda run: mark_reports(
+                        graders[run % n_graders], benchmark_project, n_grades, default_phrases,
+                        grade_fn=lambda proc_ord_id, report_text: rng.choice([0, 1, 2]),
+                    ),
+                    repeats, items=n_grades,
+                )
+            results["grading_session"] = _time_runs(
+                lambda run: _grade_session(graders[run % n_graders], n_grades, rng), repeats, items=n_grades,
+            )
+            if run_backups:
+                results["backup_grader_table_incremental"] = _time_runs(
+                    lambda run: backup_grader_table(root=backup_root), repeats
+                )
+                results["backup_grader_table_server_copy"] = _time_runs(
+                    lambda run: backup_grader_table(root=backup_root, server_copy=True), repeats
+                )
+
+            sample = backend.query(
+                f"SELECT narrative_text FROM {sql_tables['source_table']} LIMIT 200"
+            )["narrative_text"].map(format_report_text).tolist()
+            results["highlighter"] = benchmark_highlighter(default_phrases, sample, repeats)
+
+    return {
+        "results_version": results_version,
+        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "config": {
+            "n_reports": n_reports, "n_graders": n_graders, "repeats": repeats,
+            "num_to_add": num_to_add, "n_grades": n_grades, "seed": seed,
+        },
+        "environment": _environment(),
+        "setup_seconds": setup_seconds,
+        "results": results,
+    }
+
+
+def compare_benchmarks(baseline, current, tolerance=0.25):
+    """
+    Compare benchmark results to a baseline run with the same configuration
+
+    Args:
+        baseline (dictionary): results of run_benchmarks (e.g. loaded from the saved JSON)
+        current (dictionary): results of run_benchmarks
+        tolerance (float): Slowdown allowed before a benchmark counts as a regression (0.25 = 25%)
+
+    Return:
+        (dataframe): benchmark, baseline and current median seconds, ratio and regression
+    """
+    if baseline["config"] != current["config"]:
+        print("WARNING: the baseline was run with a different configuration:", baseline["config"])
+    rows = []
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            continue
+        key = "median_seconds" if "median_seconds" in result else "compiled_seconds_per_report"
+        before, after = baseline["results"][name][key], result[key]
+        ratio = after / before if before > 0 else float("inf")
+        rows.append({
+            "benchmark": name, "baseline_seconds": before, "current_seconds": after,
+            "ratio": ratio, "regression": ratio > 1 + tolerance,
+        })
+    return pd.DataFrame(rows, columns=["benchmark", "baseline_seconds", "current_seconds", "ratio", "regression"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the grading pipeline on a synthetic local database")
+    parser.add_argument("--reports", type=int, default=10000)
+    parser.add_argument("--graders", type=int, default=5)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--num-to-add", type=int, default=100)
+    parser.add_argument("--n-grades", type=int, default=50)
+    parser.add_argument("--db", default=None, help="database file (default: a temporary file)")
+    parser.add_argument("--output", default=None, help="file to save the results to as JSON")
+    parser.add_argument("--baseline", default=None, help="results of an earlier run to compare to")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="slowdown allowed, e.g. 0.25 for 25%%")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.reports, args.graders, args.repeats, args.num_to_add, args.n_grades, args.db)
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+    if args.baseline is not None:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            comparison = compare_benchmarks(json.load(f), results, args.tolerance)
+        print(comparison.to_string(index=False))
+        if comparison["regression"].any():
+            sys.exit("Benchmarks slower than the baseline: " + ", ".join(comparison.benchmark[comparison.regression]))
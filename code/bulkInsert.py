@@ -0,0 +1,55 @@
+import time
+import pandas as pd
+from storageBackends import get_backend
+
+# Rows per insert statement. BigQuery limits the size of a request (about 10 MB
+# with the query parameters), a few thousand rows of the grading tables fit well
+bulk_chunk_size = 2000
+
+
+def bulk_insert(table, rows, backend=None, chunk_size=bulk_chunk_size, optional_columns=(), verbose=False):
+    """
+    Insert many rows with parameterized statements of chunk_size rows each, so
+    values are never pasted into SQL. Columns are checked against the cached
+    table schema: columns the table does not have raise an error unless they are
+    listed in optional_columns, in which case they are left out
+
+    Args:
+        table (string): Name of the table
+        rows (dataframe or list): rows to insert, as a dataframe or a list of dictionaries
+        backend (StorageBackend): backend to use (default: the active backend)
+        chunk_size (int): Number of rows per statement
+        optional_columns (list): columns only inserted if the table has them, e.g. ["project"]
+        verbose (boolean): Print the number of rows inserted and the insert rate
+
+    Return:
+        stats (dictionary): rows, statements, seconds and rows_per_second of the insert
+    """
+
+    if backend is None:
+        backend = get_backend()
+    df = rows if isinstance(rows, pd.DataFrame) else pd.DataFrame(list(rows))
+    stats = {"rows": len(df), "statements": 0, "seconds": 0.0, "rows_per_second": 0.0}
+    if len(df) == 0:
+        return stats
+
+    table_columns = backend.table_columns(table)
+    unknown = [col for col in df.columns if col not in table_columns and col not in optional_columns]
+    if len(unknown) > 0:
+        raise ValueError(f"Columns {unknown} are not in table {table}")
+    df = df[[col for col in df.columns if col in table_columns]]
+
+    start = time.perf_counter()
+    records = df.to_dict("records")
+    for i in range(0, len(records), chunk_size):
+        backend.insert_rows(table, records[i:i + chunk_size])
+        stats["statements"] += 1
+    stats["seconds"] = time.perf_counter() - start
+    stats["rows_per_second"] = len(records) / stats["seconds"] if stats["seconds"] > 0 else float("inf")
+
+    if verbose:
+        print(
+            f"Inserted {stats['rows']} rows into {table} in {stats['statements']} statement(s), "
+            f"{stats['seconds']:.2f} s ({stats['rows_per_second']:.0f} rows/s)"
+        )
+    return stats
@@ -0,0 +1,173 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+import numpy as np
+from storageBackends import SQLiteBackend, BigQueryBackend
+from queryLog import get_query_log
+
+
+def default_backend_factory():
+    """
+    Create the backend of a session: a local database if the RADIOLOGY_GRADING_DB
+    environment variable points to a file, BigQuery otherwise
+
+    Return:
+        (StorageBackend): new backend
+    """
+    local_db = os.environ.get("RADIOLOGY_GRADING_DB", "")
+    if local_db != "":
+        backend = SQLiteBackend(local_db)
+        backend.create_tables()
+        return backend
+    return BigQueryBackend()
+
+
+class ConnectionManager:
+    """
+    Holds the one backend (and so the one bigquery client, with its credentials and
+    HTTP session) used by every grading function of the process. The backend is
+    created on first use, by whichever thread asks first, and reused afterwards.
+    Tests and benchmarks inject their own backend with set_backend or use_backend.
+    """
+
+    def __init__(self, factory=default_backend_factory):
+        """
+        Args:
+            factory (function): Creates the backend on first use
+        """
+        self.factory = factory
+        self._backend = None
+        self._lock = threading.Lock()
+        self.created_at = None
+        self.setup_seconds = None
+        self.last_health_check = None
+
+    def get_backend(self):
+        """
+        Get the backend, creating it on first use
+
+        Return:
+            (StorageBackend): the shared backend
+        """
+        backend = self._backend
+        if backend is None:
+            with self._lock:
+                if self._backend is None:
+                    start = time.perf_counter()
+                    self._backend = self.factory()
+                    self.setup_seconds = time.perf_counter() - start
+                    self.created_at = time.time()
+                backend = self._backend
+        return backend
+
+    def current_backend(self):
+        """
+        Return:
+            (StorageBackend): the backend if it was created or injected, else None
+        """
+        return self._backend
+
+    def set_backend(self, backend):
+        """
+        Replace the shared backend, e.g. SQLiteBackend(path) in tests (None creates a new one on next use)
+        """
+        with self._lock:
+            self._backend = backend
+            self.created_at = time.time() if backend is not None else None
+            self.setup_seconds = None
+            self.last_health_check = None
+
+    @contextmanager
+    def use_backend(self, backend):
+        """
+        Use a backend for the duration of a with block, then restore the previous one
+        """
+        previous = self._backend
+        self.set_backend(backend)
+        try:
+            yield backend
+        finally:
+            self.set_backend(previous)
+
+    def get_client(self):
+        """
+        Get the bigquery client of the shared backend, for the notebooks and functions that
+        take a client argument
+
+        Return:
+            the bigquery client, or the backend itself when it is not a BigQuery backend
+            (every function taking a client also accepts a backend)
+        """
+        backend = self.get_backend()
+        return getattr(backend, "client", backend)
+
+    def health_check(self):
+        """
+        Run a trivial query against the backend
+
+        Return:
+            (dictionary): ok, seconds taken, backend type and the error if the query failed
+        """
+        start = time.perf_counter()
+        result = {"backend": None, "ok": False, "seconds": None, "error": None}
+        try:
+            backend = self.get_backend()
+            result["backend"] = type(backend).__name__
+            backend.query("SELECT 1 AS ok")
+            result["ok"] = True
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+        result["seconds"] = time.perf_counter() - start
+        result["checked_at"] = time.time()
+        self.last_health_check = result
+        return result
+
+    def stats(self):
+        """
+        Latency of the database calls of this session, from the running totals of the
+        query log (percentiles of the last calls it keeps)
+
+        Return:
+            (dictionary): backend type, when it was created and how long that took, number
+            of calls and errors, total, median, 95th percentile and slowest seconds per call,
+            bytes processed (BigQuery) and the last health check
+        """
+        totals, seconds = get_query_log().call_totals()
+        seconds = np.array(seconds)
+        return {
+            "backend": type(self._backend).__name__ if self._backend is not None else None,
+            "created_at": self.created_at,
+            "setup_seconds": self.setup_seconds,
+            "calls": totals["calls"],
+            "errors": totals["errors"],
+            "total_seconds": totals["seconds"],
+            "median_seconds": float(np.median(seconds)) if len(seconds) > 0 else None,
+            "p95_seconds": float(np.percentile(seconds, 95)) if len(seconds) > 0 else None,
+            "max_seconds": totals["max_seconds"],
+            "bytes_processed": int(totals["bytes_processed"]) if totals["bytes_processed"] is not None else None,
+            "last_health_check": self.last_health_check,
+        }
+
+
+_connection_manager = ConnectionManager()
+
+
+def get_connection_manager():
+    """
+    Get the connection manager of this process
+
+    Return:
+        (ConnectionManager): the manager holding the shared backend
+    """
+    return _connection_manager
+
+
+def get_client():
+    """
+    Get the shared bigquery client (or local backend), created once per process
+
+    Return:
+        the bigquery client, or the local backend when RADIOLOGY_GRADING_DB is set
+    """
+    return _connection_manager.get_client()
@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import atexit
+import weakref
+import threading
+from datetime import date
+from storageBackends import get_backend
+from progressSummary import grade_changes, record_grade_changes
+
+with open(f"{os.path.dirname(__file__)}/sql_tables.json", 'r', encoding='utf-8') as f:
+    sql_tables = json.load(f)
+
+# Buffers that still exist when the interpreter exits are flushed then
+_live_buffers = weakref.WeakSet()
+
+
+class GradeBuffer:
+    """
+    Write-behind buffer for grades. Grades are kept in memory and written to the
+    grader table (and skipped reports table) in one transaction every max_grades
+    grades or max_seconds seconds, whichever comes first.
+
+    Use as a context manager or call flush() when done so no grade is lost. Any
+    grades still pending when the interpreter exits are flushed automatically.
+    """
+
+    def __init__(self, backend=None, max_grades=25, max_seconds=60):
+        """
+        Args:
+            backend (StorageBackend): backend to write to (default: the active backend)
+            max_grades (int): Number of pending grades that triggers a flush
+            max_seconds (float): Age of the oldest pending grade that triggers a flush
+        """
+        self.backend = backend if backend is not None else get_backend()
+        self.max_grades = max_grades
+        self.max_seconds = max_seconds
+        self.grades = {}
+        self.skips = []
+        self.oldest = None
+        self.num_flushes = 0
+        self.num_written = 0
+        self._lock = threading.Lock()
+        _live_buffers.add(self)
+
+    def __len__(self):
+        return len(self.grades) + len(self.skips)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def add_grade(self, proc_ord_id, name, grade, grade_date=None):
+        """
+        Queue a grade for a report in a grader's queue. A later grade for the same
+        report and grader replaces an earlier pending one.
+
+        Args:
+            proc_ord_id (string): proc_ord_id of the graded report
+            name (string): Full name of the grader
+            grade (int): Grade assigned to the report
+            grade_date (string): Date in YYYY-MM-DD format (default: today)
+        """
+        if grade_date is None:
+            grade_date = date.today().strftime("%Y-%m-%d")
+        with self._lock:
+            self.grades[(str(proc_ord_id), name)] = {
+                "grade": int(grade),
+                "grade_date": grade_date,
+                "proc_ord_id": str(proc_ord_id),
+                "name": name,
+            }
+            self._mark_pending()
+        self._flush_if_due()
+
+    def add_skip(self, proc_ord_id, name, grade, skip_reason, grade_criteria, skip_date=None):
+        """
+        Queue a row for the skipped reports table
+
+        Args:
+            proc_ord_id (string): proc_ord_id of the skipped report
+            name (string): Full name of the grader
+            grade (int): Skip grade (-1 skip, 503 outside scan)
+            skip_reason (string): Reason given by the grader
+            grade_criteria (string): Grading criteria of the report
+            skip_date (string): Date in YYYY-MM-DD format (default: today)
+        """
+        if skip_date is None:
+            skip_date = date.today().strftime("%Y-%m-%d")
+        with self._lock:
+            self.skips.append({
+                "proc_ord_id": str(proc_ord_id),
+                "grade": int(grade),
+                "name": name,
+                "skip_date": skip_date,
+                "skip_reason": skip_reason,
+                "regrade_date": "",
+                "regrade_reason": "",
+                "grade_criteria": grade_criteria,
+            })
+            self._mark_pending()
+        self._flush_if_due()
+
+    def _mark_pending(self):
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+
+    def _flush_if_due(self):
+        if len(self.grades) >= self.max_grades:
+            self.flush()
+        elif self.oldest is not None and time.monotonic() - self.oldest >= self.max_seconds:
+            self.flush()
+
+    def flush(self):
+        """
+        Write all pending grades and skips to the backend. A flush is one query
+        reading the previous grades (for the progress summary and candidate pool)
+        and one transaction (a single job on BigQuery) of up to four statements:
+        the skipped reports insert, the grades and the progress summary and
+        candidate pool increments
+
+        Return:
+            (int): number of grades written
+        """
+        global sql_tables
+        with self._lock:
+            grades = list(self.grades.values())
+            skips = self.skips
+            if len(grades) == 0 and len(skips) == 0:
+                return 0
+
+            writes = [
+                ("insert_rows", sql_tables["skipped_reports_table"], skips),
+                ("update_rows", sql_tables["grader_table"], grades, ["proc_ord_id", "name"]),
+            ]
+            try:
+                changes = grade_changes(
+                    [(g["proc_ord_id"], g["name"]) for g in grades], [g["grade"] for g in grades], self.backend
+                )
+            except Exception as e:
+                print("Warning: could not read the previous grades for the progress summary:", e)
+                changes = None
+            if changes is not None:
+                record_grade_changes(changes, self.backend, writes)
+            else:
+                self.backend.write_transaction(writes)
+            self.grades = {}
+            self.skips = []
+
+            self.oldest = None
+            self.num_flushes += 1
+            self.num_written += len(grades)
+            return len(grades)
+
+
+@atexit.register
+def _flush_live_buffers():
+    for buffer in list(_live_buffers):
+        try:
+            buffer.flush()
+        except Exception as e:
+            print("Error: could not save pending grades on exit:", e)
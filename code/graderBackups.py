@@ -0,0 +1,305 @@
+import os
+import json
+import time
+import argparse
+from datetime import datetime, timedelta
+import pandas as pd
+from storageBackends import get_backend
+from bulkInsert import bulk_insert
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+with open(f"{os.path.dirname(__file__)}/sql_tables.json", 'r', encoding='utf-8') as f:
+    sql_tables = json.load(f)
+
+# Backups of a table are kept in <backup_root>/<table>/ as Parquet segments listed
+# in manifest.json. Each segment holds the rows that changed since the one before
+backup_root = "~/.backups"
+
+# Columns identifying a row of the grader table: a grader has one row per report,
+# grade criteria and grade category
+backup_keys = ["proc_ord_id", "name", "grade_criteria", "grade_category"]
+
+# Column marking the rows of a segment that were deleted from the table
+deleted_column = "_deleted"
+
+# Days after which a backup downloads every row again, to find deleted rows and
+# changes that did not set grade_date (e.g. edits made outside the notebooks)
+full_backup_days = 7
+
+# Compaction merges segments older than keep_days into one base segment, once
+# there are more than compact_after_segments segments
+compact_after_segments = 30
+keep_days = 30
+
+# grade_date of reports queued but not graded (or released back to the queue)
+ungraded_date = "0000-00-00"
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("pyarrow is required for the grader table backups")
+
+
+def _backup_dir(table, root):
+    return os.path.join(os.path.expanduser(root), table.replace(".", "_"))
+
+
+def _load_manifest(backup_dir):
+    path = os.path.join(backup_dir, "manifest.json")
+    if not os.path.exists(path):
+        return {"segments": [], "last_backup": None, "last_full": None}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _save_manifest(backup_dir, manifest):
+    # Write then rename, so an interrupted backup leaves the previous manifest intact
+    path = os.path.join(backup_dir, "manifest.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def _write_segment(backup_dir, df, created_at, kind):
+    fn = f"{kind}_{datetime.now().strftime('%Y%m%dT%H%M%S%f')}.parquet"
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), os.path.join(backup_dir, fn), compression="zstd")
+    return {"file": fn, "created_at": created_at, "kind": kind, "rows": len(df)}
+
+
+def _table_keys(df, keys=backup_keys):
+    # Tables without a grade criteria or category column are keyed on the rest
+    return [k for k in keys if k in df.columns]
+
+
+def _replay(backup_dir, segments, keys=backup_keys):
+    # Later segments replace earlier rows with the same key, and deleted rows are dropped
+    if len(segments) == 0:
+        return pd.DataFrame()
+    df = pd.concat(
+        [pq.read_table(os.path.join(backup_dir, s["file"])).to_pandas() for s in segments],
+        ignore_index=True,
+    )
+    df = df.drop_duplicates(_table_keys(df, keys), keep="last")
+    if deleted_column in df.columns:
+        df = df[df[deleted_column] != True].drop(columns=deleted_column)
+    return df.reset_index(drop=True)
+
+
+def _changed_rows(current, state, keys=backup_keys):
+    # Rows of current that are new or differ from the backed up state in any column
+    if len(state) == 0:
+        return current
+    keys = _table_keys(current, keys)
+    columns = [col for col in current.columns if col not in keys and col in state.columns]
+    merged = current.merge(state[keys + columns], on=keys, how="left", suffixes=("", "_backup"), indicator=True)
+    changed = (merged["_merge"] == "left_only").to_numpy().copy()
+    for col in columns:
+        a, b = merged[col], merged[col + "_backup"]
+        # Numbers are compared as numbers: a missing value makes an int column float
+        if pd.api.types.is_numeric_dtype(a) and pd.api.types.is_numeric_dtype(b):
+            same = (a == b) | (a.isna() & b.isna())
+        else:
+            same = (a.astype(str) == b.astype(str)) | (a.isna() & b.isna())
+        changed |= ~same.to_numpy()
+    return current[changed]
+
+
+def _deleted_rows(current, state, keys=backup_keys):
+    # Rows of the backed up state that are no longer in current, marked as deleted
+    if len(state) == 0:
+        return state
+    keys = _table_keys(state, keys)
+    merged = state.merge(current[keys].drop_duplicates(), on=keys, how="left", indicator=True)
+    deleted = state[(merged["_merge"] == "left_only").to_numpy()].copy()
+    deleted[deleted_column] = True
+    return deleted
+
+
+def load_backup(table=sql_tables["grader_table"], as_of=None, root=backup_root):
+    """
+    Rebuild a table as it was at a point in time from its backup segments
+
+    Args:
+        table (string): Name of the backed up table
+        as_of (string or datetime): Time to restore (default: the latest backup). Times
+                                    before the last compaction restore the compacted base
+        root (string): Directory holding the backups
+
+    Return:
+        df (dataframe): rows of the table at the latest backup made at or before as_of
+    """
+
+    _require_pyarrow()
+    backup_dir = _backup_dir(table, root)
+    segments = _load_manifest(backup_dir)["segments"]
+    if as_of is not None:
+        as_of = pd.Timestamp(as_of).strftime("%Y-%m-%d %H:%M:%S")
+        # A compacted base stands for every time up to its newest merged segment
+        segments = [s for s in segments if s["kind"] == "base" or s["created_at"] <= as_of]
+    return _replay(backup_dir, segments)
+
+
+def backup_table(table=sql_tables["grader_table"], backend=None, root=backup_root, full=False):
+    """
+    Save the rows of a table that changed since its last backup as a zstd compressed
+    Parquet segment. Only rows graded since the day of the last backup and rows
+    waiting in a queue (grade_date 0000-00-00) are downloaded, and of those only the
+    ones that differ from the backup are written. The first backup, and one backup
+    every full_backup_days, download every row instead: rows missing from the table
+    are then saved as deleted
+
+    Args:
+        table (string): Name of the table to back up
+        backend (StorageBackend): backend to use (default: the active backend)
+        root (string): Directory holding the backups
+        full (boolean): Download every row to look for changes, e.g. after editing old grades
+
+    Return:
+        stats (dictionary): rows downloaded, written and deleted, whether every row was
+        checked, segment file and seconds taken
+    """
+
+    _require_pyarrow()
+    if backend is None:
+        backend = get_backend()
+    start = time.perf_counter()
+    backup_dir = _backup_dir(table, root)
+    os.makedirs(backup_dir, exist_ok=True)
+    manifest = _load_manifest(backup_dir)
+    created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    last_full = manifest.get("last_full")
+    if last_full is None or len(manifest["segments"]) == 0:
+        full = True
+    elif datetime.now() - datetime.fromisoformat(last_full) > timedelta(days=full_backup_days):
+        full = True
+
+    q = f"select * from {table}"
+    params = None
+    if not full:
+        # grade_date holds no time of day, so the day of the last backup is read again
+        q += " where grade_date >= @since or grade_date = @ungraded"
+        params = {"since": manifest["last_backup"][:10], "ungraded": ungraded_date}
+    df_current = backend.query(q, params)
+    if "proc_ord_id" in df_current.columns:
+        df_current["proc_ord_id"] = df_current["proc_ord_id"].astype(str)
+
+    df_state = _replay(backup_dir, manifest["segments"])
+    df_changed = _changed_rows(df_current, df_state)
+    df_deleted = _deleted_rows(df_current, df_state) if full else df_state.iloc[:0]
+    stats = {
+        "rows_downloaded": len(df_current), "rows_written": len(df_changed),
+        "rows_deleted": len(df_deleted), "full": full, "segment": None,
+    }
+    if len(df_deleted) > 0:
+        df_changed = pd.concat([df_changed.assign(**{deleted_column: False}), df_deleted], ignore_index=True)
+    if len(df_changed) > 0:
+        kind = "base" if len(manifest["segments"]) == 0 else "delta"
+        segment = _write_segment(backup_dir, df_changed, created_at, kind)
+        manifest["segments"].append(segment)
+        stats["segment"] = segment["file"]
+    manifest["last_backup"] = created_at
+    if full:
+        manifest["last_full"] = created_at
+    _save_manifest(backup_dir, manifest)
+    stats["seconds"] = time.perf_counter() - start
+    return stats
+
+
+def compact_backups(table=sql_tables["grader_table"], root=backup_root, keep_days=keep_days):
+    """
+    Merge the segments older than keep_days into one base segment. Restoring a time
+    before the newest merged segment then restores the merged state
+
+    Args:
+        table (string): Name of the backed up table
+        root (string): Directory holding the backups
+        keep_days (float): Age of the segments that stay separate for point-in-time restores
+
+    Return:
+        (int): number of segments merged
+    """
+
+    _require_pyarrow()
+    backup_dir = _backup_dir(table, root)
+    manifest = _load_manifest(backup_dir)
+    cutoff = (datetime.now() - timedelta(days=keep_days)).strftime("%Y-%m-%d %H:%M:%S")
+    old = [s for s in manifest["segments"] if s["created_at"] < cutoff]
+    if len(old) < 2:
+        return 0
+
+    base = _write_segment(backup_dir, _replay(backup_dir, old), old[-1]["created_at"], "base")
+    manifest["segments"] = [base] + manifest["segments"][len(old):]
+    _save_manifest(backup_dir, manifest)
+    for s in old:
+        os.remove(os.path.join(backup_dir, s["file"]))
+    return len(old)
+
+
+def list_backups(table=sql_tables["grader_table"], root=backup_root):
+    """
+    Get the backup segments of a table (the times that can be restored)
+
+    Return:
+        (dataframe): file, created_at, kind (base or delta) and rows of each segment
+    """
+    return pd.DataFrame(_load_manifest(_backup_dir(table, root))["segments"], columns=["file", "created_at", "kind", "rows"])
+
+
+def restore_backup(as_of=None, table=sql_tables["grader_table"], target_table=None, backend=None, root=backup_root):
+    """
+    Restore a table as it was at a point in time
+
+    Args:
+        as_of (string or datetime): Time to restore (default: the latest backup)
+        table (string): Name of the backed up table
+        target_table (string): Table to write the restored rows to. It is replaced by a
+                               table with the columns of table. None only returns the rows
+        backend (StorageBackend): backend to use (default: the active backend)
+        root (string): Directory holding the backups
+
+    Return:
+        df (dataframe): the restored rows
+    """
+
+    df = load_backup(table, as_of, root)
+    if target_table is not None:
+        if target_table == table:
+            raise ValueError("Restore to a new table and check it before replacing " + table)
+        if backend is None:
+            backend = get_backend()
+        backend.execute(f"drop table if exists {target_table}")
+        backend.execute(f"create table {target_table} as select * from {table} where false")
+        backend.__dict__.get("_columns_cache", {}).pop(target_table, None)
+        bulk_insert(target_table, df, backend)
+        print(len(df), "rows of", table, "restored to", target_table)
+    return df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Incremental backups of the grader table")
+    parser.add_argument("command", choices=["backup", "compact", "list", "restore"])
+    parser.add_argument("--table", default=sql_tables["grader_table"])
+    parser.add_argument("--root", default=backup_root)
+    parser.add_argument("--full", action="store_true", help="backup: look for changes in every row")
+    parser.add_argument("--keep-days", type=float, default=keep_days, help="compact: segments kept separate")
+    parser.add_argument("--as-of", default=None, help="restore: time to restore, e.g. '2024-05-01 12:00'")
+    parser.add_argument("--to-table", default=None, help="restore: table to write the rows to")
+    parser.add_argument("--to-csv", default=None, help="restore: csv file to write the rows to")
+    args = parser.parse_args()
+
+    if args.command == "backup":
+        print(backup_table(args.table, root=args.root, full=args.full))
+    elif args.command == "compact":
+        print(compact_backups(args.table, args.root, args.keep_days), "segments merged")
+    elif args.command == "list":
+        print(list_backups(args.table, args.root).to_string(index=False))
+    else:
+        df = restore_backup(args.as_of, args.table, args.to_table, root=args.root)
+        if args.to_csv is not None:
+            df.to_csv(args.to_csv, index=False)
+        print(len(df), "rows restored")
@@ -0,0 +1,453 @@
+import os
+import json
+import math
+import time
+import asyncio
+import argparse
+import threading
+from http import HTTPStatus
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from storageBackends import get_backend
+from gradingSession import GradingSession
+from highlighter import get_highlighter
+from reportCache import get_report_cache
+from queryLog import in_context
+
+default_phrases_path = f"{os.path.dirname(__file__)}/phrases_to_highlight.json"
+default_host = "127.0.0.1"
+default_port = 8765
+
+# Largest request body accepted (grades are a few hundred bytes)
+max_body_bytes = 1024 ** 2
+
+# Seconds between checks for sessions left open by graders who stopped
+idle_check_seconds = 60
+
+
+class RequestError(Exception):
+    """
+    A request the server cannot answer, returned to the client as {"error": message}
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class SessionClosedError(RequestError):
+    """
+    A request for a session that was closed (by /close or for being idle) while the
+    request waited for it. Nothing was saved: the grader asks for a report again
+    """
+
+    def __init__(self, name):
+        super().__init__(409, f"The session of {name} was closed. Ask for a report with /next")
+
+
+def _json_value(value):
+    # numpy numbers and dates in the report metadata become JSON values, and NaN or
+    # infinity (e.g. the median time of a session with no reports) become null
+    if isinstance(value, dict):
+        return {str(key): _json_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_json_value(item) for item in value]
+    if hasattr(value, "item") and not isinstance(value, str):
+        value = value.item()
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    return str(value)
+
+
+def _field(body, key):
+    if key not in body or body[key] is None:
+        raise RequestError(400, f"Missing field {key}")
+    return body[key]
+
+
+class GradingServer:
+    """
+    Grading service for many graders working against one process. Each grader gets a
+    GradingSession (opened by their first /next request), and all sessions share one
+    backend, the report text cache, the compiled highlighter and a cache of highlight
+    spans. Requests are served by an asyncio event loop; the database work runs on
+    two bounded thread pools (requests and prefetching), so the number of database
+    connections stays fixed however many graders are connected.
+
+    JSON API (POST bodies are JSON objects):
+        POST /next   {"name", "project"}                     -> {"report": {...} or null}
+        POST /grade  {"name", "proc_ord_id", "grade", "reason"} -> {"ok": true}
+        POST /skip   {"name", "reason", "proc_ord_id"}        -> {"ok": true}
+        POST /close  {"name"}                                 -> {"stats": {...}}
+        GET  /stats                                           -> server and session stats
+        GET  /health                                          -> {"status": "ok"}
+
+    Reports come with their highlights as [start, end, color] offsets into report_text.
+    A request for a session closed while it waited (by /close or for being idle) gets a
+    409 error and saves nothing.
+    The server has no authentication, so it listens on localhost by default.
+    """
+
+    def __init__(self, backend=None, to_highlight=None, batch_size=25, max_buffered_grades=25,
+                 workers=16, prefetch_workers=8, session_timeout=1800, span_cache_size=10000):
+        """
+        Args:
+            backend (StorageBackend): backend shared by all sessions (default: the active backend)
+            to_highlight (dictionary): phrases to highlight (default: phrases_to_highlight.json)
+            batch_size (int): Number of reports loaded at a time per grader
+            max_buffered_grades (int): Number of grades per grader collected before writing them
+            workers (int): Threads running requests against the database
+            prefetch_workers (int): Threads loading the next batch of reports of every grader
+            session_timeout (float): Seconds without requests after which a session is closed
+                                     and its grades written
+            span_cache_size (int): Number of reports whose highlight spans are kept in memory
+        """
+        if to_highlight is None:
+            with open(default_phrases_path, "r", encoding="utf-8") as f:
+                to_highlight = json.load(f)
+        self.backend = backend if backend is not None else get_backend()
+        self.to_highlight = to_highlight
+        self.highlighter = get_highlighter(to_highlight)
+        self.batch_size = batch_size
+        self.max_buffered_grades = max_buffered_grades
+        self.session_timeout = session_timeout
+
+        # Color of each phrase, the first color a phrase is listed under as in the highlighter
+        self.phrase_colors = {}
+        for color, to_mark in to_highlight.items():
+            for phrase in ([to_mark] if type(to_mark) == str else to_mark):
+                self.phrase_colors.setdefault(str(phrase), color)
+
+        self.span_cache_size = span_cache_size
+        self._span_cache = OrderedDict()
+        self._span_lock = threading.Lock()
+
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="grading-server")
+        self.prefetch_executor = ThreadPoolExecutor(max_workers=prefetch_workers, thread_name_prefix="report-prefetch")
+        self.sessions = {}
+        self.num_requests = 0
+        self.num_errors = 0
+        self.route_seconds = {}
+        self.started_at = time.time()
+        self._server = None
+        self._connections = set()
+        self._loop = None
+        self._thread = None
+
+    # Report handling
+
+    def _spans(self, report):
+        # Precomputed spans from the report index, else the shared span cache, else the highlighter
+        proc_ord_id = report["proc_ord_id"]
+        if report["spans"] is not None:
+            return report["spans"]
+        with self._span_lock:
+            cached = self._span_cache.get(proc_ord_id)
+            if cached is not None and cached[0] == report["report_text"]:
+                self._span_cache.move_to_end(proc_ord_id)
+                return cached[1]
+        spans = self.highlighter.spans(report["report_text"])
+        with self._span_lock:
+            self._span_cache[proc_ord_id] = (report["report_text"], spans)
+            while len(self._span_cache) > self.span_cache_size:
+                self._span_cache.popitem(last=False)
+        return spans
+
+    def _next_report(self, session):
+        report = session.next_report()
+        if report is None:
+            return None
+        report = dict(report)
+        report["highlights"] = [
+            [start, end, self.phrase_colors.get(phrase)] for start, end, phrase in self._spans(report)
+        ]
+        del report["spans"]
+        return report
+
+    # Sessions
+
+    def _open_session(self, name, project):
+        entry = self.sessions.get(name)
+        if entry is not None:
+            return entry
+        entry = {
+            "session": GradingSession(
+                name, project, self.batch_size, self.max_buffered_grades, self.to_highlight,
+                backend=self.backend, prefetch_executor=self.prefetch_executor,
+            ),
+            "lock": asyncio.Lock(),
+            "last_used": time.monotonic(),
+            "closed": False,
+        }
+        self.sessions[name] = entry
+        return entry
+
+    def _get_session(self, name):
+        entry = self.sessions.get(name)
+        if entry is None:
+            raise RequestError(404, f"No open session for {name}. Ask for a report with /next first")
+        return entry
+
+    async def _run(self, entry, fn, *args):
+        # One request at a time per session, on the database threads. A request that
+        # waited while the session was closed is refused, so a grade is never added
+        # to a buffer after its last flush
+        loop = asyncio.get_running_loop()
+        async with entry["lock"]:
+            if entry["closed"]:
+                raise SessionClosedError(entry["session"].name)
+            entry["last_used"] = time.monotonic()
+            return await loop.run_in_executor(self.executor, in_context(lambda: fn(*args)))
+
+    async def _close_session(self, name, entry):
+        if self.sessions.get(name) is entry:
+            del self.sessions[name]
+        loop = asyncio.get_running_loop()
+        async with entry["lock"]:
+            if not entry["closed"]:
+                entry["closed"] = True
+                await loop.run_in_executor(self.executor, in_context(entry["session"].close))
+        return entry["session"].stats()
+
+    async def _close_idle_sessions(self):
+        while True:
+            await asyncio.sleep(idle_check_seconds)
+            now = time.monotonic()
+            for name, entry in list(self.sessions.items()):
+                if now - entry["last_used"] > self.session_timeout and not entry["lock"].locked():
+                    try:
+                        await self._close_session(name, entry)
+                    except Exception as e:
+                        print(f"Error: could not close the session of {name}:", e)
+
+    # Routes
+
+    async def _route(self, method, path, body):
+        if method == "GET" and path == "/health":
+            return {"status": "ok", "sessions": len(self.sessions)}
+        if method == "GET" and path == "/stats":
+            return self.stats()
+        if method != "POST":
+            raise RequestError(404, f"Unknown route {method} {path}")
+
+        if path == "/next":
+            name, project = str(_field(body, "name")), str(_field(body, "project"))
+            entry = self.sessions.get(name)
+            if entry is not None and entry["session"].project != project:
+                # The grader switched projects: write the grades of the previous project
+                await self._close_session(name, entry)
+            entry = self._open_session(name, project)
+            try:
+                return {"report": await self._run(entry, self._next_report, entry["session"])}
+            except SessionClosedError:
+                # Closed for being idle just as the grader came back: start a new session
+                entry = self._open_session(name, project)
+                return {"report": await self._run(entry, self._next_report, entry["session"])}
+        if path == "/grade":
+            entry = self._get_session(str(_field(body, "name")))
+            await self._run(
+                entry, entry["session"].submit_grade,
+                _field(body, "proc_ord_id"), _field(body, "grade"), body.get("reason"),
+            )
+            return {"ok": True}
+        if path == "/skip":
+            entry = self._get_session(str(_field(body, "name")))
+            await self._run(entry, entry["session"].skip, str(_field(body, "reason")), body.get("proc_ord_id"))
+            return {"ok": True}
+        if path == "/close":
+            name = str(_field(body, "name"))
+            return {"stats": await self._close_session(name, self._get_session(name))}
+        raise RequestError(404, f"Unknown route {method} {path}")
+
+    # HTTP
+
+    async def _read_request(self, reader):
+        line = await reader.readline()
+        if line == b"":
+            return None
+        parts = line.decode("latin-1").split()
+        if len(parts) != 3:
+            raise RequestError(400, "Malformed request line")
+        method, target, version = parts
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+
+        length = int(headers.get("content-length", 0))
+        if length > max_body_bytes:
+            raise RequestError(413, "Request body too large")
+        body = {}
+        if length > 0:
+            try:
+                body = json.loads(await reader.readexactly(length))
+            except json.JSONDecodeError:
+                raise RequestError(400, "The request body is not valid JSON")
+            if not isinstance(body, dict):
+                raise RequestError(400, "The request body must be a JSON object")
+        keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+        return method, urlsplit(target).path, body, keep_alive
+
+    async def _handle_connection(self, reader, writer):
+        self._connections.add(asyncio.current_task())
+        try:
+            while True:
+                keep_alive = False
+                start = time.perf_counter()
+                route = None
+                try:
+                    request = await self._read_request(reader)
+                    if request is None:
+                        break
+                    method, path, body, keep_alive = request
+                    route = f"{method} {path}"
+                    status, payload = 200, await self._route(method, path, body)
+                except RequestError as e:
+                    status, payload = e.status, {"error": str(e)}
+                except ValueError as e:
+                    # Invalid grades, reports not handed out, ...
+                    status, payload = 400, {"error": str(e)}
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except Exception as e:
+                    status, payload = 500, {"error": f"{type(e).__name__}: {e}"}
+
+                self.num_requests += 1
+                if status >= 400:
+                    self.num_errors += 1
+                if route is not None:
+                    calls, seconds = self.route_seconds.get(route, (0, 0.0))
+                    self.route_seconds[route] = (calls + 1, seconds + time.perf_counter() - start)
+
+                data = json.dumps(_json_value(payload), allow_nan=False).encode("utf-8")
+                writer.write((
+                    f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                    "Content-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+                ).encode("latin-1") + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(asyncio.current_task())
+            writer.close()
+
+    async def start(self, host=default_host, port=default_port):
+        """
+        Start listening (in the running event loop)
+
+        Return:
+            (int): the port, e.g. the one picked by the system for port 0
+        """
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        self._idle_task = asyncio.create_task(self._close_idle_sessions())
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """
+        Stop listening, write the grades of every open session and stop the threads
+        """
+        if self._server is not None:
+            self._server.close()
+            # Drop the connections kept alive by clients
+            connections = list(self._connections)
+            for task in connections:
+                task.cancel()
+            await asyncio.gather(*connections, return_exceptions=True)
+            await self._server.wait_closed()
+            self._idle_task.cancel()
+        for name, entry in list(self.sessions.items()):
+            try:
+                await self._close_session(name, entry)
+            except Exception as e:
+                print(f"Error: could not save the grades of {name}:", e)
+        self.executor.shutdown(wait=True)
+        self.prefetch_executor.shutdown(wait=False, cancel_futures=True)
+
+    async def serve_forever(self, host=default_host, port=default_port):
+        """
+        Serve until cancelled (e.g. Ctrl+C), then write the pending grades
+        """
+        port = await self.start(host, port)
+        print(f"Grading server listening on http://{host}:{port}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self.stop()
+
+    def start_in_thread(self, host=default_host, port=0):
+        """
+        Run the server on an event loop in a background thread, e.g. from a notebook or a load test
+
+        Return:
+            (int): the port the server listens on
+        """
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+        result = {}
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            result["port"] = self._loop.run_until_complete(self.start(host, port))
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="grading-server", daemon=True)
+        self._thread.start()
+        started.wait()
+        return result["port"]
+
+    def stop_thread(self):
+        """
+        Stop a server started with start_in_thread, writing the pending grades
+        """
+        asyncio.run_coroutine_threadsafe(self.stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def stats(self):
+        """
+        Return:
+            (dictionary): requests served, errors, calls and mean seconds per route, report
+            cache hits and the stats of every open session
+        """
+        cache = get_report_cache()
+        return {
+            "uptime_seconds": round(time.time() - self.started_at, 1),
+            "requests": self.num_requests,
+            "errors": self.num_errors,
+            "routes": {
+                route: {"calls": calls, "mean_seconds": seconds / calls}
+                for route, (calls, seconds) in self.route_seconds.items()
+            },
+            "report_cache": {"memory_hits": cache.memory_hits, "disk_hits": cache.disk_hits, "misses": cache.misses},
+            "span_cache_reports": len(self._span_cache),
+            "sessions": {name: entry["session"].stats() for name, entry in self.sessions.items()},
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local HTTP/JSON grading server shared by many graders")
+    parser.add_argument("--host", default=default_host)
+    parser.add_argument("--port", type=int, default=default_port)
+    parser.add_argument("--batch-size", type=int, default=25)
+    parser.add_argument("--workers", type=int, default=16, help="threads running database requests")
+    parser.add_argument("--session-timeout", type=float, default=1800, help="seconds before an idle session is closed")
+    args = parser.parse_args()
+
+    server = GradingServer(batch_size=args.batch_size, workers=args.workers, session_timeout=args.session_timeout)
+    try:
+        asyncio.run(server.serve_forever(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
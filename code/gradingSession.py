@@ -0,0 +1,208 @@
+import time
+import numpy as np
+from storageBackends import get_backend
+from gradeBuffer import GradeBuffer
+from reportQueue import ReportPrefetcher
+from reportIndex import get_report_spans
+from queryLog import timed
+
+# Grades accepted by submit_grade: 0 do not use, 1 maybe use, 2 definitely use,
+# -1 skip and 503 outside scan. -2 (escalate to a clinician) needs enable_md_flag
+valid_grades = (0, 1, 2, -1, 503)
+md_grade = -2
+
+# Skip reason saved for reports graded 503
+outside_scan_reason = "OUTSIDE SCAN"
+
+
+class GradingSession:
+    """
+    A grader's pass through their queue as plain method calls, without input(),
+    print() or clear_output(), so it can be driven by the notebooks, another UI,
+    tests or a load generator. It holds the batch of reports prefetched in the
+    background and the buffer of grades not written yet:
+
+        with GradingSession(name, project) as session:
+            report = session.next_report()
+            while report is not None:
+                session.submit_grade(report["proc_ord_id"], 2)
+                report = session.next_report()
+
+    Reports handed out but not graded stay in the queue for the next session.
+    """
+
+    def __init__(self, name, project, batch_size=25, max_buffered_grades=25, to_highlight=None,
+                 enable_md_flag=False, backend=None, prefetch_executor=None, max_reports=None):
+        """
+        Args:
+            name (string): Full name of the grader (to also be referenced in publications)
+            project (string): Project the grader is grading for
+            batch_size (int): Number of reports loaded at a time. The next batch is loaded in
+                              the background while the current one is graded
+            max_buffered_grades (int): Number of grades to collect before writing them to the grader table
+            to_highlight (dictionary): phrases to look up precomputed highlight spans for
+            enable_md_flag (boolean): True to accept -2 grades (escalate to a clinician)
+            backend (StorageBackend): backend to use (default: the active backend)
+            prefetch_executor (ThreadPoolExecutor): pool loading the next batches, shared by
+                                                    sessions (default: a thread per session)
+            max_reports (int): Number of reports the caller will grade at most. No batch is
+                               loaded beyond it (default: the whole queue)
+        """
+        self.name = name
+        self.project = project
+        self.to_highlight = to_highlight if to_highlight is not None else {}
+        self.enable_md_flag = enable_md_flag
+        self.backend = backend if backend is not None else get_backend()
+        self.prefetcher = ReportPrefetcher(name, batch_size, self.backend, prefetch_executor, max_reports)
+        self.grade_buffer = GradeBuffer(self.backend, max_grades=max_buffered_grades)
+
+        self.missing = []
+        self._batch = []
+        self._batch_done = False
+        self._open_reports = {}
+        self._current = None
+        self._handed_out_at = {}
+        self.num_presented = 0
+        self.num_graded = 0
+        self.num_skipped = 0
+        self.report_seconds = []
+        self.wait_seconds = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _load_batch(self):
+        batch = self.prefetcher.next_batch()
+        self.missing += list(batch["missing"])
+        df = batch["queue"]
+        if len(df) == 0:
+            self._batch_done = True
+            return
+
+        report_df = batch["reports"]
+        texts = dict(zip(report_df.proc_ord_id.astype(str), report_df.report_text))
+        spans = get_report_spans(report_df, self.to_highlight)
+        project_df = batch["projects"]
+        projects = project_df.groupby(project_df.proc_ord_id.astype(str))["project"].apply(list).to_dict()
+
+        df = df.assign(proc_ord_id=df.proc_ord_id.astype(str)).drop_duplicates("proc_ord_id")
+        for row in df.itertuples(index=False):
+            report_projects = projects.get(row.proc_ord_id, [])
+            self._batch.append({
+                "proc_ord_id": row.proc_ord_id,
+                "report_text": texts.get(row.proc_ord_id),
+                "spans": spans.get(row.proc_ord_id),
+                "proc_ord_year": row.proc_ord_year,
+                "age_years": np.round(row.age_in_days / 365.25, 2),
+                "grade_criteria": row.grade_criteria,
+                "grade_category": row.grade_category,
+                "projects": report_projects,
+                "in_project": self.project in report_projects,
+            })
+
+    def next_report(self):
+        """
+        Get the next report of the grader's queue
+
+        Return:
+            report (dictionary): proc_ord_id, report_text (formatted for display), spans
+            (precomputed highlight spans or None), proc_ord_year, age_years, grade_criteria,
+            grade_category, projects (the report's cohorts) and in_project. None once the
+            queue is empty
+        """
+        with timed("step:next_report"):
+            start = time.perf_counter()
+            while len(self._batch) == 0 and not self._batch_done:
+                self._load_batch()
+            self.wait_seconds.append(time.perf_counter() - start)
+        if len(self._batch) == 0:
+            self._current = None
+            return None
+
+        report = self._batch.pop(0)
+        self._open_reports[report["proc_ord_id"]] = report
+        self._handed_out_at[report["proc_ord_id"]] = time.perf_counter()
+        self._current = report["proc_ord_id"]
+        self.num_presented += 1
+        return report
+
+    def submit_grade(self, proc_ord_id, grade, reason=None):
+        """
+        Save the grade of a report handed out by next_report. Grades are buffered and
+        written in bulk (see flush)
+
+        Args:
+            proc_ord_id (string): proc_ord_id of the report
+            grade (int): 0, 1, 2, -1 (skip), 503 (outside scan) or -2 (escalate, with enable_md_flag)
+            reason (string): Why the report was skipped. Required for -1
+        """
+        proc_ord_id = str(proc_ord_id)
+        grade = int(grade)
+        if proc_ord_id not in self._open_reports:
+            raise ValueError(f"Report {proc_ord_id} was not handed out by this session or is already graded")
+        if grade not in valid_grades and not (self.enable_md_flag and grade == md_grade):
+            raise ValueError(f"Invalid grade {grade}. Options: {', '.join(str(g) for g in valid_grades)}")
+        if grade == 503 and reason is None:
+            reason = outside_scan_reason
+        if grade == -1 and reason is None:
+            raise ValueError("A reason is required to skip a report")
+
+        report = self._open_reports.pop(proc_ord_id)
+        if grade in (-1, 503):
+            self.grade_buffer.add_skip(proc_ord_id, self.name, grade, reason, report["grade_criteria"])
+            self.num_skipped += 1
+        self.grade_buffer.add_grade(proc_ord_id, self.name, grade)
+        self.num_graded += 1
+        self.report_seconds.append(time.perf_counter() - self._handed_out_at.pop(proc_ord_id))
+        if self._current == proc_ord_id:
+            self._current = None
+
+    def skip(self, reason, proc_ord_id=None):
+        """
+        Skip a report (grade -1)
+
+        Args:
+            reason (string): Part(s) of the report that were confusing
+            proc_ord_id (string): Report to skip (default: the last report handed out)
+        """
+        if proc_ord_id is None:
+            proc_ord_id = self._current
+        if proc_ord_id is None:
+            raise ValueError("There is no report to skip")
+        self.submit_grade(proc_ord_id, -1, reason)
+
+    def flush(self):
+        """
+        Write the buffered grades and skips to the grader and skipped reports tables
+
+        Return:
+            (int): number of grades written
+        """
+        return self.grade_buffer.flush()
+
+    def close(self):
+        """
+        Write the buffered grades and stop loading reports
+        """
+        try:
+            self.flush()
+        finally:
+            self.prefetcher.close()
+
+    def stats(self):
+        """
+        Return:
+            (dictionary): reports presented, graded and skipped, grades not written yet, and
+            the median seconds per report (hand out to grade) and waiting on next_report
+        """
+        return {
+            "presented": self.num_presented,
+            "graded": self.num_graded,
+            "skipped": self.num_skipped,
+            "pending_writes": len(self.grade_buffer),
+            "median_report_seconds": float(np.median(self.report_seconds)) if self.report_seconds else None,
+            "median_wait_seconds": float(np.median(self.wait_seconds)) if self.wait_seconds else None,
+        }
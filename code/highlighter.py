@@ -0,0 +1,237 @@
+import re
+import json
+import time
+import random
+from functools import lru_cache
+
+# ANSI codes for each highlight color (bold black text on a colored background)
+color_codes = {
+    "green": "\x1b[5;30;42m",
+    "yellow": "\x1b[5;30;43m",
+    "red": "\x1b[5;30;41m",
+    "gray": "\x1b[5;30;47m",
+    "grey": "\x1b[5;30;47m",
+}
+end_code = "\x1b[0m"
+
+
+def _trie_pattern(phrases):
+    """
+    Build a regular expression matching any of the phrases from a character trie.
+    At each branch longer continuations are tried first, so the pattern returns the
+    longest phrase starting at the leftmost match position.
+    """
+    trie = {}
+    for phrase in phrases:
+        node = trie
+        for char in phrase:
+            node = node.setdefault(char, {})
+        node[""] = True
+
+    def to_regex(node):
+        terminal = "" in node
+        branches = [re.escape(char) + to_regex(child) for char, child in sorted(node.items()) if char != ""]
+        if len(branches) == 0:
+            return ""
+        if len(branches) == 1 and not terminal:
+            return branches[0]
+        alternatives = "(?:" + "|".join(branches) + ")"
+        return alternatives + "?" if terminal else alternatives
+
+    return to_regex(trie)
+
+
+class Highlighter:
+    """
+    Highlights every phrase of a {color: phrases} dictionary in one pass over a report.
+    Overlapping phrases are resolved leftmost, longest match first. A phrase listed
+    under several colors uses the first color it appears under.
+    """
+
+    def __init__(self, to_highlight):
+        """
+        Args:
+            to_highlight (dictionary): terms to highlight and the color(s) to highlight them as.
+            Phrases given in a list are shown in upper case, a single string is shown as is
+        """
+        self.replacements = {}
+        for color, to_mark in to_highlight.items():
+            if color not in color_codes:
+                raise ValueError(f"Unknown highlight color {color}. Options: {', '.join(color_codes)}")
+            if type(to_mark) == str:
+                phrases = [(to_mark, to_mark)]
+            elif type(to_mark) in (list, tuple):
+                phrases = [(str(phrase), str(phrase).upper()) for phrase in to_mark]
+            else:
+                raise TypeError("The phrases for each color must be either a string or a list of strings")
+
+            for phrase, shown in phrases:
+                if phrase != "" and phrase not in self.replacements:
+                    self.replacements[phrase] = color_codes[color] + shown + end_code
+
+        self.pattern = None
+        if len(self.replacements) > 0:
+            self.pattern = re.compile(_trie_pattern(self.replacements))
+
+    def spans(self, text):
+        """
+        Find the phrases to highlight in a text
+
+        Args:
+            text (string): Text of a radiology report
+
+        Return:
+            (list): (start, end, phrase) for each match, in order
+        """
+        if self.pattern is None:
+            return []
+        return [(m.start(), m.end(), m.group(0)) for m in self.pattern.finditer(text)]
+
+    def highlight(self, text, spans=None):
+        """
+        Highlight the phrases in a text
+
+        Args:
+            text (string): Text of a radiology report
+            spans (list): precomputed (start, end, phrase) matches, e.g. from a report index
+
+        Return:
+            (string): text with the phrases highlighted
+        """
+        if spans is None:
+            if self.pattern is None:
+                return text
+            return self.pattern.sub(lambda m: self.replacements[m.group(0)], text)
+
+        pieces = []
+        last = 0
+        for start, end, phrase in sorted(spans):
+            if start < last or phrase not in self.replacements:
+                continue
+            pieces.append(text[last:start])
+            pieces.append(self.replacements[phrase])
+            last = end
+        pieces.append(text[last:])
+        return "".join(pieces)
+
+
+def _freeze(to_highlight):
+    return tuple(
+        (color, to_mark if type(to_mark) == str else tuple(to_mark))
+        for color, to_mark in to_highlight.items()
+    )
+
+
+@lru_cache(maxsize=16)
+def _cached_highlighter(frozen):
+    return Highlighter({color: to_mark if type(to_mark) == str else list(to_mark) for color, to_mark in frozen})
+
+
+def get_highlighter(to_highlight):
+    """
+    Get the compiled highlighter for a {color: phrases} dictionary. Highlighters
+    are cached, so the phrases are only compiled once per session.
+
+    Args:
+        to_highlight (dictionary): terms to highlight and the color(s) to highlight them as
+
+    Return:
+        (Highlighter): compiled highlighter
+    """
+    return _cached_highlighter(_freeze(to_highlight))
+
+
+def _legacy_highlight(report_text, to_highlight):
+    """
+    The original highlighting loop (one str.replace per phrase per color), kept
+    as the baseline for benchmark_highlighter
+    """
+    for color, to_mark in to_highlight.items():
+        start = color_codes[color]
+        if type(to_mark) == str:
+            report_text = report_text.replace(to_mark, start + to_mark + end_code)
+        else:
+            for phrase in sorted(to_mark, key=len)[::-1]:
+                report_text = report_text.replace(str(phrase), start + str(phrase).upper() + end_code)
+    return report_text
+
+
+def benchmark_highlighter(to_highlight, reports, repeats=3):
+    """
+    Time the compiled highlighter against the original str.replace loop
+
+    Args:
+        to_highlight (dictionary): terms to highlight and the color(s) to highlight them as
+        reports (list): report texts to highlight
+        repeats (int): Number of times to highlight the full list of reports
+
+    Return:
+        results (dictionary): phrase and report counts, seconds per report for each
+        implementation, compile time and speedup
+    """
+    n_phrases = sum(1 if type(v) == str else len(v) for v in to_highlight.values())
+
+    t0 = time.perf_counter()
+    highlighter = Highlighter(to_highlight)
+    compile_seconds = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        for report in reports:
+            _legacy_highlight(report, to_highlight)
+    legacy_seconds = (time.perf_counter() - t0) / (repeats * len(reports))
+
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        for report in reports:
+            highlighter.highlight(report)
+    compiled_seconds = (time.perf_counter() - t0) / (repeats * len(reports))
+
+    return {
+        "n_phrases": n_phrases,
+        "n_reports": len(reports),
+        "compile_seconds": compile_seconds,
+        "legacy_seconds_per_report": legacy_seconds,
+        "compiled_seconds_per_report": compiled_seconds,
+        "speedup": legacy_seconds / compiled_seconds if compiled_seconds > 0 else float("inf"),
+    }
+
+
+def synthetic_phrase_list(to_highlight, scale, seed=0):
+    """
+    Grow a phrase dictionary to scale times its size with shuffled-word variants of
+    its phrases, for benchmarking on large phrase lists
+
+    Args:
+        to_highlight (dictionary): terms to highlight and the color(s) to highlight them as
+        scale (int): Multiple of the original number of phrases to return
+        seed (int): Random seed
+
+    Return:
+        (dictionary): color -> list of phrases
+    """
+    rng = random.Random(seed)
+    grown = {}
+    for color, to_mark in to_highlight.items():
+        phrases = [to_mark] if type(to_mark) == str else list(to_mark)
+        extra = []
+        for _ in range(len(phrases) * (scale - 1)):
+            words = rng.choice(phrases).split()
+            rng.shuffle(words)
+            extra.append(" ".join(words))
+        grown[color] = phrases + extra
+    return grown
+
+
+if __name__ == "__main__":
+    import os
+    with open(f"{os.path.dirname(__file__)}/phrases_to_highlight.json", 'r', encoding='utf-8') as f:
+        phrases = json.load(f)
+    all_phrases = [p for v in phrases.values() for p in v]
+    rng = random.Random(1)
+    sample_reports = [
+        ". ".join(rng.choice(all_phrases) + " " + " ".join(rng.choice(["mild", "the", "of", "scan", "left"]) for _ in range(8)) for _ in range(30))
+        for _ in range(50)
+    ]
+    for scale in [1, 10, 50]:
+        print(f"x{scale}:", benchmark_highlighter(synthetic_phrase_list(phrases, scale), sample_reports, repeats=1))
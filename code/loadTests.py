@@ -0,0 +1,366 @@
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+import http.client
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+import reportSnapshot
+from storageBackends import SQLiteBackend
+from gradeBuffer import GradeBuffer
+from queueAssignment import assign_reports, select_candidates, claim_reports
+from reportCache import ReportCache, set_report_cache
+from reportIndex import ReportIndex, set_report_index
+from gradingServer import GradingServer
+
+with open(f"{os.path.dirname(__file__)}/sql_tables.json", 'r', encoding='utf-8') as f:
+    sql_tables = json.load(f)
+
+# Sort order of the load test project, validation reports first as in the project parameter files
+load_test_order = ['report_type = "validation" desc', "proc_ord_datetime desc"]
+
+# Sentences the synthetic report text is made of
+load_test_sentences = [
+    "FINDINGS: The ventricles are normal in size and configuration.",
+    "There is no intracranial hemorrhage, mass effect or midline shift.",
+    "Myelination is age appropriate.",
+    "Mild ventriculomegaly, unchanged from the prior study.",
+    "The cerebellar tonsils terminate above the level of the foramen magnum.",
+    "Motion artifact limits evaluation of the posterior fossa.",
+    "IMPRESSION: No acute intracranial abnormality.",
+]
+
+
+class UnkeyedSQLiteBackend(SQLiteBackend):
+    """
+    Local backend with the write semantics of BigQuery that matter when claiming
+    reports: tables have no unique keys, and insert_missing_rows looks for the keys
+    and inserts the missing rows in separate steps, so graders claiming the same
+    slot at the same time can all write their claim
+    """
+
+    # Time between looking for the keys and inserting, to make simultaneous claims likely
+    race_seconds = 0.01
+
+    def create_tables(self):
+        super().create_tables()
+        for index in self.query("SELECT name FROM sqlite_master WHERE type = 'index' and name LIKE 'uq_%'")["name"]:
+            self.execute(f"DROP INDEX {index}")
+
+    def insert_missing_rows(self, table, rows, key_columns):
+        if len(rows) == 0:
+            return 0
+        existing = self.query(
+            f"SELECT {', '.join(key_columns)} FROM {table} WHERE {key_columns[0]} IN @keys",
+            {"keys": list({row[key_columns[0]] for row in rows})},
+        )
+        existing = set(existing.astype(str).itertuples(index=False, name=None))
+        time.sleep(self.race_seconds)
+        return self.insert_rows(table, [
+            row for row in rows if tuple(str(row[col]) for col in key_columns) not in existing
+        ])
+
+
+def build_load_test_backend(path, n_reports=5000, project="Load Test", seed=0, unique_keys=True):
+    """
+    Create a local database with synthetic reports for one project and no grades
+
+    Args:
+        path (string): Database file (use a file, not ":memory:", to test concurrent writers)
+        n_reports (int): Number of reports in the project
+        project (string): Name of the project
+        seed (int): Random seed
+        unique_keys (boolean): False for a backend without unique keys, like BigQuery
+                               (see UnkeyedSQLiteBackend)
+
+    Return:
+        backend (SQLiteBackend): backend holding the tables
+    """
+
+    rng = np.random.default_rng(seed)
+    backend = SQLiteBackend(path) if unique_keys else UnkeyedSQLiteBackend(path)
+    backend.create_tables()
+
+    ids = [str(100000 + i) for i in range(n_reports)]
+    pat_ids = [str(500000 + i // 3) for i in range(n_reports)]
+    dates = pd.Timestamp("2015-01-01") + pd.to_timedelta(rng.integers(0, 3000, n_reports), unit="D")
+    backend.load_dataframe(pd.DataFrame({
+        "pat_id": pat_ids,
+        "proc_ord_id": ids,
+        "proc_ord_age": rng.uniform(0, 6000, n_reports),
+        "proc_ord_year": dates.year,
+        "proc_ord_desc": "MRI BRAIN WO CONTRAST",
+        "proc_ord_datetime": dates.strftime("%Y-%m-%d %H:%M:%S"),
+        "encounter_id": ids,
+    }), sql_tables["procedure_table"])
+    backend.load_dataframe(pd.DataFrame({
+        "pat_id": sorted(set(pat_ids)),
+        "sex": "U",
+        "gestational_age_num": 40.0,
+        "birth_weight_kg": 3.5,
+    }), sql_tables["patient_table"])
+    backend.load_dataframe(pd.DataFrame({
+        "encounter_id": ids,
+        "enc_type_name": np.where(rng.random(n_reports) < 0.05, "Reconciled Outside Data", "Appointment"),
+    }), "visits")
+    backend.load_dataframe(pd.DataFrame({"pat_id": pat_ids, "proc_ord_id": ids, "project": project}), sql_tables["project_table"])
+    backend.load_dataframe(pd.DataFrame({
+        "proc_ord_id": ids,
+        "narrative_text": [
+            " ".join(rng.choice(load_test_sentences, size=5)) for _ in range(n_reports)
+        ],
+    }), sql_tables["source_table"])
+    return backend
+
+
+def _grader_session(backend, name, project, grade_criteria, num_requests, num_to_add, num_validation,
+                    crash_rate, lease_minutes, seed):
+    # One grader: ask for reports, grade them, repeat. Some requests crash after
+    # claiming reports, leaving their leases to expire
+    rng = random.Random(seed)
+    latencies, n_added, n_abandoned = [], 0, 0
+    for _ in range(num_requests):
+        start = time.perf_counter()
+        if rng.random() < crash_rate:
+            df_candidates = select_candidates(name, project, grade_criteria, num_to_add, num_validation, load_test_order, backend)
+            n_abandoned += len(claim_reports(df_candidates, name, grade_criteria, backend, lease_minutes))
+            latencies.append(time.perf_counter() - start)
+            continue
+        df_reports = assign_reports(
+            name, project, grade_criteria, num_to_add, num_validation, load_test_order, backend, lease_minutes
+        )
+        latencies.append(time.perf_counter() - start)
+        n_added += len(df_reports)
+
+        with GradeBuffer(backend, max_grades=len(df_reports) + 1) as grade_buffer:
+            for proc_ord_id in df_reports["proc_ord_id"]:
+                grade_buffer.add_grade(proc_ord_id, name, rng.choice([0, 1, 1, 2, 2, 2]))
+    return latencies, n_added, n_abandoned
+
+
+def check_assignments(backend, num_validation, grade_criteria="SLIP"):
+    """
+    Check the grader table for reports queued more often than allowed
+
+    Return:
+        problems (dict): reports queued twice for the same grader, and reports
+        queued for more than num_validation graders
+    """
+
+    global sql_tables
+    df = backend.count_rows(
+        sql_tables["grader_table"], ["proc_ord_id", "name"], "grade_criteria = @criteria", {"criteria": grade_criteria}
+    )
+    per_report = df.groupby("proc_ord_id")["name"].nunique()
+    return {
+        "duplicate_rows": df.loc[df["n"] > 1, ["proc_ord_id", "name"]],
+        "over_assigned": per_report[per_report > max(num_validation, 1)],
+    }
+
+
+def run_claim_load_test(n_graders=20, num_requests=5, num_to_add=25, num_validation=2, n_reports=5000,
+                        crash_rate=0.1, lease_minutes=0.1, path=None, project="Load Test", grade_criteria="SLIP",
+                        unique_keys=True):
+    """
+    Simulate many graders asking for reports at the same time against a local
+    database, then check that no report was queued beyond the validation limit
+
+    Args:
+        n_graders (int): Number of graders running at once (one thread each)
+        num_requests (int): Number of times each grader asks for reports
+        num_to_add (int): Number of reports per request
+        num_validation (int): Number of graders each validation report needs
+        n_reports (int): Number of reports in the project
+        crash_rate (float): Share of requests that claim reports and never queue them
+        lease_minutes (float): Claim lease, short so abandoned claims expire during the test
+        path (string): Database file (default: a temporary file)
+        project (string): Name of the project
+        grade_criteria (string): Grading criteria of the project
+        unique_keys (boolean): False to claim without unique keys, as on BigQuery
+
+    Return:
+        results (dict): throughput, latency percentiles and problems found
+    """
+
+    tmp_dir = None
+    if path is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(tmp_dir.name, "load_test.db")
+    backend = build_load_test_backend(path, n_reports, project, unique_keys=unique_keys)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_graders) as executor:
+        sessions = list(executor.map(
+            lambda i: _grader_session(
+                backend, f"Grader {i}", project, grade_criteria, num_requests, num_to_add, num_validation,
+                crash_rate, lease_minutes, seed=i,
+            ),
+            range(n_graders),
+        ))
+    elapsed = time.perf_counter() - start
+
+    latencies = np.concatenate([s[0] for s in sessions])
+    problems = check_assignments(backend, num_validation, grade_criteria)
+    results = {
+        "graders": n_graders,
+        "requests": len(latencies),
+        "reports_queued": int(sum(s[1] for s in sessions)),
+        "reports_abandoned": int(sum(s[2] for s in sessions)),
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "latency_p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 1),
+        "latency_p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 1),
+        "duplicate_rows": len(problems["duplicate_rows"]),
+        "over_assigned": len(problems["over_assigned"]),
+        "claims_left": int(backend.query(
+            f"SELECT COUNT(*) AS n FROM {sql_tables['claims_table']} WHERE status = 'committed'"
+        )["n"].values[0]),
+    }
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+    return results
+
+
+def _server_grader(port, name, project, num_grades, think_seconds, seed):
+    # One grader on the grading server: ask for a report, grade it, repeat
+    rng = random.Random(seed)
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+    latencies = []
+
+    def call(path, body):
+        start = time.perf_counter()
+        conn.request("POST", path, json.dumps(body), {"Content-Type": "application/json"})
+        response = conn.getresponse()
+        payload = json.loads(response.read())
+        latencies.append(time.perf_counter() - start)
+        if response.status != 200:
+            raise RuntimeError(f"{path} failed for {name}: {payload['error']}")
+        return payload
+
+    n_graded = 0
+    try:
+        while n_graded < num_grades:
+            report = call("/next", {"name": name, "project": project})["report"]
+            if report is None:
+                break
+            time.sleep(think_seconds)
+            call("/grade", {"name": name, "proc_ord_id": report["proc_ord_id"], "grade": rng.choice([0, 1, 1, 2, 2, 2])})
+            n_graded += 1
+        call("/close", {"name": name})
+    finally:
+        conn.close()
+    return latencies, n_graded
+
+
+def run_server_load_test(n_graders=50, num_grades=40, n_reports=5000, batch_size=25, workers=16,
+                         think_seconds=0.0, path=None, project="Load Test", grade_criteria="SLIP"):
+    """
+    Simulate many graders grading through one grading server against a local
+    database, then check that every grade was written
+
+    Replaces the shared report cache, snapshot and index with empty ones, so run it
+    in its own Python process (python loadTests.py --test server)
+
+    Args:
+        n_graders (int): Number of graders grading at once (one thread and connection each)
+        num_grades (int): Number of reports each grader grades
+        n_reports (int): Number of reports in the project (at least n_graders * num_grades)
+        batch_size (int): Number of reports the server loads at a time per grader
+        workers (int): Database threads of the server
+        think_seconds (float): Time each grader spends on a report
+        path (string): Database file (default: a temporary file)
+        project (string): Name of the project
+        grade_criteria (string): Grading criteria of the project
+
+    Return:
+        results (dict): throughput, latency percentiles and grades lost
+    """
+
+    tmp_dir = tempfile.TemporaryDirectory()
+    if path is None:
+        path = os.path.join(tmp_dir.name, "load_test.db")
+    backend = build_load_test_backend(path, n_reports, project)
+    names = [f"Grader {i}" for i in range(n_graders)]
+    for name in names:
+        assign_reports(name, project, grade_criteria, num_grades, 0, load_test_order, backend)
+
+    # Keep the synthetic reports out of the grader's own caches
+    set_report_cache(ReportCache(path=None))
+    reportSnapshot.set_report_snapshot(
+        reportSnapshot.ReportSnapshot(tmp_dir.name) if reportSnapshot.pa is not None else None
+    )
+    set_report_index(ReportIndex(":memory:"))
+
+    server = GradingServer(backend, batch_size=batch_size, workers=workers)
+    port = server.start_in_thread()
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=n_graders) as executor:
+            sessions = list(executor.map(
+                lambda i: _server_grader(port, names[i], project, num_grades, think_seconds, seed=i),
+                range(n_graders),
+            ))
+        elapsed = time.perf_counter() - start
+        server_stats = server.stats()
+    finally:
+        server.stop_thread()
+
+    latencies = np.concatenate([s[0] for s in sessions])
+    n_graded = int(sum(s[1] for s in sessions))
+    n_written = int(backend.query(
+        f"SELECT count(*) n FROM {sql_tables['grader_table']} WHERE grade != 999 and name IN @names",
+        {"names": names},
+    )["n"][0])
+    results = {
+        "graders": n_graders,
+        "requests": len(latencies),
+        "grades": n_graded,
+        "seconds": round(elapsed, 3),
+        "grades_per_second": round(n_graded / elapsed, 1),
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "latency_p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 1),
+        "latency_p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 1),
+        "latency_max_ms": round(float(np.max(latencies)) * 1000, 1),
+        "server_errors": server_stats["errors"],
+        "grades_lost": n_graded - n_written,
+    }
+    tmp_dir.cleanup()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load tests of report assignment and of the grading server against a local database")
+    parser.add_argument("--test", choices=["claims", "server"], default="claims")
+    parser.add_argument("--graders", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=5)
+    parser.add_argument("--num-to-add", type=int, default=25)
+    parser.add_argument("--num-validation", type=int, default=2)
+    parser.add_argument("--reports", type=int, default=5000)
+    parser.add_argument("--crash-rate", type=float, default=0.1)
+    parser.add_argument("--db", default=None, help="database file (default: a temporary file)")
+    parser.add_argument("--no-unique-keys", action="store_true",
+                        help="claims: test without unique keys, as on BigQuery")
+    parser.add_argument("--grades", type=int, default=40, help="server: reports graded per grader")
+    parser.add_argument("--workers", type=int, default=16, help="server: database threads")
+    parser.add_argument("--think-seconds", type=float, default=0.0, help="server: time spent on each report")
+    args = parser.parse_args()
+
+    if args.test == "server":
+        results = run_server_load_test(
+            args.graders, args.grades, args.reports, workers=args.workers,
+            think_seconds=args.think_seconds, path=args.db,
+        )
+        print(json.dumps(results, indent=2))
+        if results["grades_lost"] > 0 or results["server_errors"] > 0:
+            raise SystemExit("Grades were lost or requests failed")
+    else:
+        results = run_claim_load_test(
+            args.graders, args.requests, args.num_to_add, args.num_validation, args.reports,
+            args.crash_rate, path=args.db, unique_keys=not args.no_unique_keys,
+        )
+        print(json.dumps(results, indent=2))
+        if results["duplicate_rows"] > 0 or results["over_assigned"] > 0:
+            raise SystemExit("Reports were queued beyond the validation limit")
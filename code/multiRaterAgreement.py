@@ -0,0 +1,226 @@
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+# Grade levels compared between graders (skips, 404s and ungraded 999s are left out)
+valid_grades = (0, 1, 2)
+
+
+def grade_counts(df_ratings, grades=valid_grades):
+    """
+    Count how many graders gave each grade to each report
+
+    Args:
+        df_ratings (dataframe): One row per report and one column per grader, e.g. from
+                                get_reliability_ratings_df or get_grade_matrix(...).T. A
+                                proc_ord_id column, if present, is used as the index
+        grades (list): Grade levels to count, in order. Other values count as not graded
+
+    Return:
+        counts (dataframe): One row per report, one column per grade level
+    """
+
+    if "proc_ord_id" in df_ratings.columns:
+        df_ratings = df_ratings.set_index("proc_ord_id")
+    ratings = df_ratings.to_numpy(dtype=float)
+
+    level = np.full(ratings.shape, -1)
+    for idx, grade in enumerate(grades):
+        level[ratings == grade] = idx
+    report_idx, _ = np.nonzero(level >= 0)
+    counts = np.bincount(
+        report_idx * len(grades) + level[level >= 0], minlength=len(ratings) * len(grades)
+    ).reshape(len(ratings), len(grades))
+
+    return pd.DataFrame(counts, index=df_ratings.index, columns=list(grades))
+
+
+def _pairable(counts):
+    # Only reports graded by at least two graders say anything about agreement
+    counts = np.asarray(counts, dtype=float)
+    return counts[counts.sum(axis=1) >= 2]
+
+
+def _fleiss_terms(counts):
+    # Per-report agreement and grade totals, so resampled reports only need a weighted sum
+    n_raters = counts.sum(axis=1)
+    agreement = ((counts ** 2).sum(axis=1) - n_raters) / (n_raters * (n_raters - 1))
+    return agreement, counts, n_raters
+
+
+def _fleiss_from_weights(weights, agreement, counts, n_raters):
+    # weights: (n_samples, n_reports) number of times each report is drawn
+    p_bar = weights @ agreement / weights.sum(axis=1)
+    p_grade = (weights @ counts) / (weights @ n_raters)[:, None]
+    p_e = (p_grade ** 2).sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        kappa = (p_bar - p_e) / (1 - p_e)
+    return np.where(np.isclose(p_e, 1), np.nan, kappa)
+
+
+def fleiss_kappa(counts):
+    """
+    Fleiss' kappa for any number of graders. Reports may have a different number
+    of graders each; reports with fewer than two grades are ignored
+
+    Args:
+        counts (dataframe): report x grade counts from grade_counts
+
+    Return:
+        kappa (float): Fleiss' kappa (NaN if every grade is the same)
+    """
+
+    counts = _pairable(counts)
+    if len(counts) == 0:
+        return np.nan
+    return float(_fleiss_from_weights(np.ones((1, len(counts))), *_fleiss_terms(counts))[0])
+
+
+def _distance_metric(n_grades, level, grade_totals=None):
+    # Squared distance between grade levels for Krippendorff's alpha
+    levels = np.arange(n_grades)
+    if level == "nominal":
+        return 1 - np.eye(n_grades)
+    if level == "interval":
+        return (levels[:, None] - levels[None, :]).astype(float) ** 2
+    if level == "ordinal":
+        # Distance is the number of grades given between two levels, counting half of each end
+        cumulative = np.cumsum(grade_totals, axis=-1)
+        low = np.minimum(levels[:, None], levels[None, :])
+        high = np.maximum(levels[:, None], levels[None, :])
+        between = cumulative[..., high] - cumulative[..., low] + grade_totals[..., low]
+        return (between - (grade_totals[..., low] + grade_totals[..., high]) / 2) ** 2
+    raise ValueError(f"Unknown level of measurement {level}. Options: nominal, ordinal, interval")
+
+
+def _coincidence_terms(counts):
+    # Each report's contribution to the coincidence matrix, flattened to one row per report
+    n_raters = counts.sum(axis=1)
+    pairs = counts[:, :, None] * counts[:, None, :]
+    pairs -= counts[:, :, None] * np.eye(counts.shape[1])
+    return (pairs / (n_raters - 1)[:, None, None]).reshape(len(counts), -1)
+
+
+def _alpha_from_weights(weights, coincidence_terms, n_grades, level):
+    coincidence = (weights @ coincidence_terms).reshape(len(weights), n_grades, n_grades)
+    grade_totals = coincidence.sum(axis=2)
+    n = grade_totals.sum(axis=1)
+    delta = _distance_metric(n_grades, level, grade_totals)
+    if delta.ndim == 2:
+        delta = np.broadcast_to(delta, coincidence.shape)
+
+    observed = (coincidence * delta).sum(axis=(1, 2))
+    expected = (grade_totals[:, :, None] * grade_totals[:, None, :] * delta).sum(axis=(1, 2)) / (n - 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        alpha = 1 - observed / expected
+    return np.where(expected == 0, np.nan, alpha)
+
+
+def krippendorff_alpha(counts, level="ordinal"):
+    """
+    Krippendorff's alpha from the grade counts of each report. Missing grades are
+    allowed; reports with fewer than two grades are ignored
+
+    Args:
+        counts (dataframe): report x grade counts from grade_counts, columns in grade order
+        level (string): Level of measurement of the grades: ordinal, nominal or interval
+
+    Return:
+        alpha (float): Krippendorff's alpha (NaN if every grade is the same)
+    """
+
+    counts = _pairable(counts)
+    if len(counts) == 0:
+        return np.nan
+    terms = _coincidence_terms(counts)
+    return float(_alpha_from_weights(np.ones((1, len(counts))), terms, counts.shape[1], level)[0])
+
+
+def _bootstrap_chunk(counts, n_samples, seed, level):
+    # One worker's share of the bootstrap: resample reports with replacement, then
+    # evaluate every resample at once as a weighted sum over the original reports
+    rng = np.random.default_rng(seed)
+    fleiss_terms = _fleiss_terms(counts)
+    coincidence_terms = _coincidence_terms(counts)
+    kappas, alphas = [], []
+    # Resamples are drawn 250 at a time to bound the size of the weight matrix
+    for batch in np.array_split(np.arange(n_samples), max(1, n_samples // 250)):
+        weights = rng.multinomial(len(counts), np.full(len(counts), 1 / len(counts)), size=len(batch)).astype(float)
+        kappas.append(_fleiss_from_weights(weights, *fleiss_terms))
+        alphas.append(_alpha_from_weights(weights, coincidence_terms, counts.shape[1], level))
+    return np.concatenate(kappas), np.concatenate(alphas)
+
+
+def bootstrap_agreement(counts, n_boot=1000, level="ordinal", n_jobs=None, seed=0):
+    """
+    Bootstrap Fleiss' kappa and Krippendorff's alpha by resampling reports, with the
+    resamples split across CPU cores
+
+    Args:
+        counts (dataframe): report x grade counts from grade_counts
+        n_boot (int): Number of bootstrap resamples
+        level (string): Level of measurement for Krippendorff's alpha
+        n_jobs (int): Number of worker processes (default: number of CPUs, 1 runs in this process)
+        seed (int): Random seed
+
+    Return:
+        samples (dataframe): fleiss_kappa and krippendorff_alpha of each resample
+    """
+
+    counts = _pairable(counts)
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = max(1, min(n_jobs, n_boot))
+    chunk_sizes = [len(c) for c in np.array_split(np.arange(n_boot), n_jobs)]
+    seeds = np.random.SeedSequence(seed).spawn(n_jobs)
+
+    if n_jobs == 1:
+        results = [_bootstrap_chunk(counts, chunk_sizes[0], seeds[0], level)]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(
+                _bootstrap_chunk, [counts] * n_jobs, chunk_sizes, seeds, [level] * n_jobs
+            ))
+
+    return pd.DataFrame({
+        "fleiss_kappa": np.concatenate([r[0] for r in results]),
+        "krippendorff_alpha": np.concatenate([r[1] for r in results]),
+    })
+
+
+def multi_rater_agreement(df_ratings, n_boot=1000, confidence=0.95, level="ordinal", n_jobs=None, seed=0):
+    """
+    Agreement between all graders at once, with bootstrap confidence intervals
+
+    Args:
+        df_ratings (dataframe): One row per report and one column per grader, e.g. from
+                                get_reliability_ratings_df or get_grade_matrix(...).T
+        n_boot (int): Number of bootstrap resamples (0 skips the confidence intervals)
+        confidence (float): Width of the confidence intervals
+        level (string): Level of measurement for Krippendorff's alpha
+        n_jobs (int): Number of worker processes for the bootstrap
+        seed (int): Random seed
+
+    Return:
+        summary (dataframe): estimate and confidence interval of Fleiss' kappa and
+        Krippendorff's alpha, with the number of reports and graders compared
+    """
+
+    counts = grade_counts(df_ratings)
+    pairable = _pairable(counts)
+    summary = pd.DataFrame({
+        "estimate": [fleiss_kappa(pairable), krippendorff_alpha(pairable, level)],
+        "ci_low": np.nan,
+        "ci_high": np.nan,
+    }, index=["fleiss_kappa", "krippendorff_alpha"])
+
+    if n_boot > 0 and len(pairable) > 0:
+        samples = bootstrap_agreement(pairable, n_boot, level, n_jobs, seed)
+        tail = (1 - confidence) / 2 * 100
+        summary["ci_low"] = np.nanpercentile(samples[summary.index].to_numpy(), tail, axis=0)
+        summary["ci_high"] = np.nanpercentile(samples[summary.index].to_numpy(), 100 - tail, axis=0)
+
+    summary["n_reports"] = len(pairable)
+    summary["n_graders"] = df_ratings.shape[1] - int("proc_ord_id" in df_ratings.columns)
+    return summary
@@ -0,0 +1,241 @@
+import os
+import json
+from datetime import datetime, timedelta
+import pandas as pd
+from storageBackends import get_backend
+from queueAssignment import candidate_pool_write, mark_candidate_pool_stale
+
+with open(f"{os.path.dirname(__file__)}/sql_tables.json", 'r', encoding='utf-8') as f:
+    sql_tables = json.load(f)
+
+# The progress table holds the number of grader table rows n for each of these
+progress_columns = ["name", "grade_criteria", "grade_category", "grade"]
+
+# Hours after which the progress table is rebuilt from the grader table
+rebuild_hours = 24
+
+
+def rebuild_progress_summary(backend=None, seen_rebuilt_at=None):
+    """
+    Recount the progress table from the grader table, correcting any drift from
+    the incremental updates. The old counts are replaced in one transaction, so
+    increments are applied either before or after the rebuild, and callers
+    rebuilding at the same time run one after the other
+
+    Args:
+        backend (StorageBackend): backend to use (default: the active backend)
+        seen_rebuilt_at (string): rebuilt_at of the table the caller found stale. The
+                                  rebuild is skipped if another caller rebuilt the table
+                                  since (None always rebuilds)
+    """
+
+    global sql_tables
+    if backend is None:
+        backend = get_backend()
+    params = {
+        "rebuilt_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "seen_rebuilt_at": str(seen_rebuilt_at) if seen_rebuilt_at is not None else "9999-12-31",
+    }
+
+    fresh = f'''
+      NOT EXISTS (
+        SELECT 1 FROM {sql_tables["progress_table"]} fresh
+        WHERE fresh.rebuilt_at > @seen_rebuilt_at
+      )'''
+    q_delete = f"DELETE FROM {sql_tables['progress_table']} WHERE {fresh}"
+    q_rebuild = f'''
+    INSERT INTO {sql_tables["progress_table"]} (name, grade_criteria, grade_category, grade, n, rebuilt_at)
+    SELECT name, COALESCE(grade_criteria, ''), grade_category, grade, COUNT(*), @rebuilt_at
+    FROM {sql_tables["grader_table"]}
+    WHERE {fresh}
+    GROUP BY name, COALESCE(grade_criteria, ''), grade_category, grade'''
+    backend.execute_transaction([q_delete, q_rebuild], params)
+
+
+def mark_progress_summary_stale(backend=None):
+    """
+    Make the next get_progress_summary rebuild the progress table, e.g. after an
+    update of the table failed and left its counts behind the grader table
+
+    Args:
+        backend (StorageBackend): backend to use (default: the active backend)
+    """
+
+    global sql_tables
+    if backend is None:
+        backend = get_backend()
+    # A transaction of its own, so that it is retried if a concurrent update aborts it
+    backend.execute_transaction([f"UPDATE {sql_tables['progress_table']} SET rebuilt_at = NULL WHERE TRUE"])
+
+
+def grade_changes(keys, new_grades, backend=None):
+    """
+    Look up the rows of the grader table that are about to be regraded. Call before
+    writing the new grades, then pass the result to record_grade_changes once they
+    are written
+
+    Args:
+        keys (list): (proc_ord_id, name) of the rows about to be regraded
+        new_grades (list): new grade of each row, or one grade for all of them
+        backend (StorageBackend): backend to use (default: the active backend)
+
+    Return:
+        changes (dataframe): proc_ord_id, name, grade_criteria, grade_category, the
+        current grade and the new_grade of every affected row
+    """
+
+    global sql_tables
+    if backend is None:
+        backend = get_backend()
+    keys = [(str(proc_ord_id), name) for proc_ord_id, name in keys]
+    if len(keys) == 0:
+        return _no_changes()
+    if not isinstance(new_grades, (list, tuple)):
+        new_grades = [new_grades] * len(keys)
+
+    q_current = f'''
+    SELECT proc_ord_id, name, grade, grade_category, COALESCE(grade_criteria, '') as grade_criteria
+    FROM {sql_tables["grader_table"]}
+    WHERE proc_ord_id IN @proc_ord_ids and name IN @names'''
+    df_current = backend.query(q_current, {
+        "proc_ord_ids": list(dict.fromkeys(k[0] for k in keys)),
+        "names": list(dict.fromkeys(k[1] for k in keys)),
+    })
+    df_current["proc_ord_id"] = df_current["proc_ord_id"].astype(str)
+    df_new = pd.DataFrame(keys, columns=["proc_ord_id", "name"])
+    df_new["new_grade"] = [int(g) for g in new_grades]
+    return df_current.merge(df_new.drop_duplicates(["proc_ord_id", "name"], keep="last"))
+
+
+def queued_reports(proc_ord_ids, name, grade_criteria, grade_category):
+    """
+    Changes for reports added to a grader's queue, to pass to record_grade_changes
+
+    Return:
+        changes (dataframe): one new row with grade 999 per proc_ord_id
+    """
+    changes = _no_changes()
+    changes["proc_ord_id"] = [str(i) for i in proc_ord_ids]
+    changes["name"] = name
+    changes["grade_criteria"] = grade_criteria
+    changes["grade_category"] = grade_category
+    changes["new_grade"] = 999
+    return changes
+
+
+def _no_changes():
+    # A row with a missing grade is a row added to the grader table
+    return pd.DataFrame(columns=["proc_ord_id", "name", "grade", "grade_category", "grade_criteria", "new_grade"])
+
+
+def progress_summary_write(changes):
+    """
+    Write applying changes of the grader table to the progress table
+
+    Args:
+        changes (dataframe): rows from grade_changes or queued_reports
+
+    Return:
+        (tuple): increment_rows write for StorageBackend.write_transaction
+    """
+
+    global sql_tables
+    removed = changes.loc[changes["grade"].notna(), progress_columns].assign(n=-1)
+    added = changes.drop(columns="grade").rename(columns={"new_grade": "grade"})[progress_columns].assign(n=1)
+    deltas = pd.concat([removed, added]).astype({"grade": int})
+    deltas = deltas.groupby(progress_columns, as_index=False)["n"].sum()
+    deltas = deltas[deltas["n"] != 0]
+    return ("increment_rows", sql_tables["progress_table"], deltas.to_dict("records"), progress_columns, ["n"])
+
+
+def record_grade_changes(changes, backend=None, writes=()):
+    """
+    Keep the tables derived from the grader table (progress summary and queue
+    candidate pool) in step with the grader table. Their updates run in one
+    transaction with the writes of the grader table the changes come from, if
+    given. If the transaction fails (e.g. still aborted by concurrent updates on
+    BigQuery after its retries), the writes are run again on their own and the
+    derived tables are marked stale, so that their next use rebuilds them from the
+    grader table: grades are never lost because of these tables
+
+    Args:
+        changes (dataframe): rows from grade_changes or queued_reports
+        backend (StorageBackend): backend to use (default: the active backend)
+        writes (list): writes of the grader table, as for StorageBackend.write_transaction
+                       ([] if they were made already)
+    """
+
+    if backend is None:
+        backend = get_backend()
+    derived = [progress_summary_write(changes), candidate_pool_write(changes)] if len(changes) > 0 else []
+    try:
+        backend.write_transaction(list(writes) + derived)
+        return
+    except Exception as e:
+        if len(derived) == 0:
+            raise
+        print("Warning: the progress summary and candidate pool could not be updated, they are rebuilt on their next use:", e)
+
+    criteria = changes["grade_criteria"].unique().tolist()
+    for mark_stale in (lambda: mark_progress_summary_stale(backend), lambda: mark_candidate_pool_stale(criteria, backend)):
+        try:
+            mark_stale()
+        except Exception as e:
+            print("Warning: the table could not be marked stale either:", e)
+    backend.write_transaction(writes)
+
+
+def get_progress_summary(name=None, backend=None, max_age_hours=rebuild_hours):
+    """
+    Get the number of reports per grade criteria, grade category and grade for a
+    grader. The progress table is rebuilt first if it is older than max_age_hours
+
+    Args:
+        name (string): Full name of the grader (None returns every grader)
+        backend (StorageBackend): backend to use (default: the active backend)
+        max_age_hours (float): Age of the last rebuild that triggers a new one
+
+    Return:
+        summary (dataframe): name, grade_criteria, grade_category, grade and n
+    """
+
+    global sql_tables
+    if backend is None:
+        backend = get_backend()
+
+    rebuilt_at = backend.query(
+        f"SELECT MAX(rebuilt_at) as rebuilt_at FROM {sql_tables['progress_table']}"
+    )["rebuilt_at"].values[0]
+    if pd.isna(rebuilt_at):
+        # Any rebuild made since by another caller is newer than never
+        rebuild_progress_summary(backend, "")
+    elif datetime.now() - datetime.fromisoformat(str(rebuilt_at)) > timedelta(hours=max_age_hours):
+        rebuild_progress_summary(backend, rebuilt_at)
+
+    q_summary = f'''
+    SELECT name, grade_criteria, grade_category, grade, n
+    FROM {sql_tables["progress_table"]}
+    WHERE n > 0'''
+    params = {}
+    if name is not None:
+        q_summary += " and name = @name"
+        params["name"] = name
+    summary = backend.query(q_summary, params)
+    summary["grade"] = summary["grade"].astype(int)
+    summary["n"] = summary["n"].astype(int)
+    return summary
+
+
+def category_progress(summary, grade_category):
+    """
+    Count the graded and assigned reports of one grade category
+
+    Args:
+        summary (dataframe): rows from get_progress_summary
+        grade_category (string): e.g. Reliability or Unique
+
+    Return:
+        (tuple): number of graded reports, number of assigned reports
+    """
+    rows = summary[summary["grade_category"] == grade_category]
+    return int(rows.loc[rows["grade"] != 999, "n"].sum()), int(rows["n"].sum())
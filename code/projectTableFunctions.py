@@ -3,7 +3,7 @@ import numpy as np
 import random
 import os
 from IPython.display import clear_output
-from google.cloud import bigquery # SQL table interface on Arcus
+from storageBackends import *  # SQL table interface (BigQuery or local)
 from dxFilterLibraryPreGrading import *
 from reportMarkingFunctions import *
 import json
@@ -73,32 +73,37 @@ def load_cohort_config(project_id, field):
 
 def get_project_report_stats(cohort):
     global sql_tables
-    # Set up the client
-    client = bigquery.Client()
+    # Get the storage backend
+    backend = get_backend()
     
     # Get the number of reports with the project label
-    q_project_reports = 'select * from ' + sql_tables["project_table"] + ' where project = "'+cohort+'"'
-    df_project_reports = client.query(q_project_reports).to_dataframe()
+    n_project_reports = backend.count_rows(
+        sql_tables["project_table"], where="project = @cohort", params={"cohort": cohort}
+    ).n.sum()
 
     # Load the config
     criteria = load_cohort_config(cohort, "grade_criteria")
     
-    # Get the number of reports with the project label in the grader table
-    q_graded_reports = '''
-    select distinct reports.* 
-    from ''' + sql_tables["grader_table"] + ''' reports 
-    join ''' + sql_tables["project_table"] + ''' projects 
-    on (reports.proc_ord_id = projects.proc_ord_id and reports.pat_id = projects.pat_id) 
-    where projects.project = "''' + cohort + '''" 
-    and grade_criteria = "''' + criteria + '''";'''
-    df_graded_reports = client.query(q_graded_reports).to_dataframe()
+    # Count the reports with the project label in the grader table for each grade
+    in_project = '''grade_criteria = @criteria
+    and exists (
+        select 1 from ''' + sql_tables["project_table"] + ''' projects
+        where projects.proc_ord_id = counted.proc_ord_id
+        and projects.pat_id = counted.pat_id
+        and projects.project = @cohort)'''
+    df_grade_counts = backend.count_rows(
+        sql_tables["grader_table"], ["grade"], in_project, {"cohort": cohort, "criteria": criteria}
+    )
+    # Rows without a grade are not counted under any grade
+    df_grade_counts = df_grade_counts.assign(grade=pd.to_numeric(df_grade_counts["grade"])).dropna(subset=["grade"])
+    grade_counts = dict(zip(df_grade_counts["grade"].astype(int), df_grade_counts["n"]))
     
     # Print info
     print("Project:", cohort)
-    print("Total reports:", len(df_project_reports), "(note each report must be graded by 2 graders)")
-    print("Graded 0:", len(df_graded_reports[df_graded_reports['grade'] == 0]))
-    print("Graded 1:", len(df_graded_reports[df_graded_reports['grade'] == 1]))
-    print("Graded 2:", len(df_graded_reports[df_graded_reports['grade'] == 2]))
-    print("Queued:", len(df_graded_reports[df_graded_reports['grade'] == 999]))
-    print("Skipped:", len(df_graded_reports[df_graded_reports['grade'] < 0]))
+    print("Total reports:", n_project_reports, "(note each report must be graded by 2 graders)")
+    print("Graded 0:", grade_counts.get(0, 0))
+    print("Graded 1:", grade_counts.get(1, 0))
+    print("Graded 2:", grade_counts.get(2, 0))
+    print("Queued:", grade_counts.get(999, 0))
+    print("Skipped:", sum(n for grade, n in grade_counts.items() if grade < 0))
 
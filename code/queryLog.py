@@ -0,0 +1,310 @@
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import threading
+import functools
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+import pandas as pd
+
+# Every database call is logged here as one JSON object per line. Set the
+# environment variable RADIOLOGY_GRADING_QUERY_LOG to another file, or to an
+# empty string to keep the records of the session in memory only
+default_log_path = "~/.cache/radiology_report_grading/query_log.jsonl"
+
+# Identifies the records of this Python session (one notebook kernel) in the log
+session_id = f"{datetime.now().strftime('%Y%m%dT%H%M%S')}_{os.getpid()}"
+
+# Records kept in memory for the summaries. Older records are only in the log file
+max_records = 10000
+
+# The log file is renamed to <path>.1 (and <path>.1 to <path>.2, ...) once it is larger
+# than max_log_bytes, keeping log_backup_count old files
+max_log_bytes = 10 * 1024 * 1024
+log_backup_count = 5
+
+# Frames of these modules are skipped when looking for the function that issued a query
+_internal_files = ("storageBackends.py", "queryLog.py", "bulkInsert.py", "contextlib.py")
+
+_label = contextvars.ContextVar("query_label", default=None)
+
+
+def _caller():
+    # Name of the first function outside the storage layer, e.g. fetch_report_batch
+    frame = sys._getframe(2)
+    while frame is not None and os.path.basename(frame.f_code.co_filename) in _internal_files:
+        frame = frame.f_back
+    return frame.f_code.co_name if frame is not None else None
+
+
+def statement_hash(sql):
+    """
+    Identify a statement in the log without its text (which can hold grader names and
+    report ids): the same statement always gets the same hash
+
+    Return:
+        (string): first 12 hex digits of the sha1 of the statement, whitespace normalized
+    """
+    return hashlib.sha1(re.sub(r"\s+", " ", sql).strip().encode("utf-8")).hexdigest()[:12]
+
+
+class QueryLog:
+    """
+    Timings of the database calls (and other timed steps) of a session. The last
+    max_records records are kept in memory for the summaries, with running totals
+    of all the calls, and every record is appended to a JSON lines file for later
+    analysis, e.g. pd.read_json(path, lines=True). The file is rotated by size.
+    """
+
+    def __init__(self, path=default_log_path, max_records=max_records):
+        """
+        Args:
+            path (string): Log file (None keeps the records in memory only)
+            max_records (int): Number of records kept in memory
+        """
+        self.records = deque(maxlen=max_records)
+        self.num_records = 0
+        # Latencies of the last max_records database calls, and totals of all of them
+        self.call_seconds = deque(maxlen=max_records)
+        self.totals = {"calls": 0, "errors": 0, "seconds": 0.0, "max_seconds": None, "bytes_processed": None}
+        self._lock = threading.Lock()
+        self._file = None
+        if path is not None:
+            path = os.path.expanduser(path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._file = open(path, "a", encoding="utf-8")
+        self.path = path
+
+    def __len__(self):
+        # Records added so far, also those no longer kept in memory
+        return self.num_records
+
+    def add(self, record):
+        """
+        Keep a record and append it to the log file
+
+        Args:
+            record (dictionary): label, caller, operation, rows, bytes_processed, seconds, ...
+        """
+        with self._lock:
+            self.records.append(record)
+            self.num_records += 1
+            if not record["operation"].startswith("step:"):
+                self.call_seconds.append(record["seconds"])
+                self.totals["calls"] += 1
+                self.totals["errors"] += int(record.get("error") is not None)
+                self.totals["seconds"] += record["seconds"]
+                self.totals["max_seconds"] = max(self.totals["max_seconds"] or 0.0, record["seconds"])
+                if record.get("bytes_processed") is not None:
+                    self.totals["bytes_processed"] = (self.totals["bytes_processed"] or 0) + record["bytes_processed"]
+            if self._file is not None:
+                self._rotate_if_needed()
+                self._file.write(json.dumps(record, default=str) + "\n")
+                self._file.flush()
+
+    def _rotate_if_needed(self):
+        # Other kernels append to the same file: it is rotated by whichever process finds
+        # it too large, and the others reopen it once they see it was renamed
+        if self._file.tell() < max_log_bytes:
+            return
+        try:
+            same_file = os.stat(self.path).st_ino == os.fstat(self._file.fileno()).st_ino
+        except FileNotFoundError:
+            same_file = False
+        if same_file:
+            for i in range(log_backup_count - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{i}"):
+                    os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        self._file.close()
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def call_totals(self):
+        """
+        Return:
+            (tuple): totals of the database calls so far (calls, errors, seconds, max_seconds
+            and bytes_processed) and the seconds of each of the last max_records calls
+        """
+        with self._lock:
+            return dict(self.totals), list(self.call_seconds)
+
+    def records_since(self, start=0):
+        """
+        Get the records added since len(log) was start (those still kept in memory)
+        """
+        with self._lock:
+            n_new = min(self.num_records - start, len(self.records))
+            return list(self.records)[len(self.records) - n_new:] if n_new > 0 else []
+
+    def summary(self, start=0):
+        """
+        Total the records per label and operation
+
+        Args:
+            start (int): len(log) before the records to include, e.g. before a cell ran
+
+        Return:
+            (dataframe): label, operation, calls, rows, bytes_processed, seconds and the
+            slowest call (max_seconds) for each label and operation, slowest first
+        """
+        df = pd.DataFrame(self.records_since(start), columns=[
+            "label", "caller", "operation", "rows", "bytes_processed", "seconds",
+        ])
+        if len(df) == 0:
+            return pd.DataFrame(columns=["label", "operation", "calls", "rows", "bytes_processed", "seconds", "max_seconds"])
+        df["label"] = df["label"].fillna(df["caller"]).fillna("")
+        return (
+            df.groupby(["label", "operation"])
+            .agg(
+                calls=("seconds", "size"),
+                # Left empty where the backend does not report them (e.g. bytes on SQLite)
+                rows=("rows", lambda x: x.sum(min_count=1)),
+                bytes_processed=("bytes_processed", lambda x: x.sum(min_count=1)),
+                seconds=("seconds", "sum"),
+                max_seconds=("seconds", "max"),
+            )
+            .reset_index()
+            .sort_values("seconds", ascending=False, ignore_index=True)
+        )
+
+    def print_summary(self, start=0, title="Database calls"):
+        """
+        Print the summary of the records from start on (nothing if there are none)
+        """
+        df = self.summary(start)
+        if len(df) == 0:
+            return
+        queries = df[~df.operation.str.startswith("step:")]
+        print(f"{title}: {int(queries.calls.sum())} queries, {queries.seconds.sum():.2f} s")
+        df["seconds"] = df["seconds"].round(3)
+        df["max_seconds"] = df["max_seconds"].round(3)
+        print(df.to_string(index=False))
+
+
+_query_log = None
+
+
+def get_query_log():
+    """
+    Get the query log of this session
+
+    Return:
+        (QueryLog): the log, writing to RADIOLOGY_GRADING_QUERY_LOG (default: default_log_path)
+    """
+    global _query_log
+    if _query_log is None:
+        path = os.environ.get("RADIOLOGY_GRADING_QUERY_LOG", default_log_path)
+        _query_log = QueryLog(path if path != "" else None)
+    return _query_log
+
+
+def set_query_log(log):
+    """
+    Replace the query log of this session, e.g. QueryLog(None) to stop writing a file
+    """
+    global _query_log
+    _query_log = log
+
+
+@contextmanager
+def timed(operation, sql=None):
+    """
+    Time a database call and log it. The caller fills in what it knows about the result:
+
+        with timed("query", q) as record:
+            df = ...
+            record["rows"] = len(df)
+
+    Args:
+        operation (string): Kind of call, e.g. query, execute or insert_rows. Steps that
+                            are not database calls are named "step:<name>", e.g. step:highlight
+        sql (string): Statement sent to the database, if any
+    """
+    record = {
+        "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f"),
+        "session": session_id,
+        "label": _label.get(),
+        "caller": _caller(),
+        "operation": operation,
+        "rows": None,
+        "bytes_processed": None,
+    }
+    if sql is not None:
+        # The kind of statement and its hash only, the text can hold names and report ids
+        record["statement"] = sql.split(None, 1)[0].lower() if sql.strip() != "" else None
+        record["sql_hash"] = statement_hash(sql)
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record["error"] = type(e).__name__
+        raise
+    finally:
+        record["seconds"] = time.perf_counter() - start
+        get_query_log().add(record)
+
+
+def labelled(func):
+    """
+    Decorator labelling every database call made while the function runs with the
+    function name, so the calls of e.g. mark_reports are summed up together. Calls
+    made from another labelled function keep the label of the outer function
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _label.get() is not None:
+            return func(*args, **kwargs)
+        token = _label.set(func.__name__)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _label.reset(token)
+    return wrapper
+
+
+def in_context(func):
+    """
+    Wrap a function submitted to a thread pool so its database calls keep the label
+    of the code that submitted it
+    """
+    return functools.partial(contextvars.copy_context().run, func)
+
+
+_cell_hooks_enabled = False
+
+
+def enable_cell_summaries(ipython=None):
+    """
+    Print the database calls of each notebook cell after it runs (no-op outside IPython)
+
+    Args:
+        ipython: The IPython shell (default: the running shell, if any)
+    """
+    global _cell_hooks_enabled
+    if _cell_hooks_enabled:
+        return
+    if ipython is None:
+        try:
+            from IPython import get_ipython
+        except ImportError:
+            return
+        ipython = get_ipython()
+        if ipython is None:
+            return
+
+    cell_start = {"index": 0}
+
+    def pre_run_cell(*args):
+        cell_start["index"] = len(get_query_log())
+
+    def post_run_cell(*args):
+        get_query_log().print_summary(cell_start["index"], title="Database calls in this cell")
+
+    ipython.events.register("pre_run_cell", pre_run_cell)
+    ipython.events.register("post_run_cell", post_run_cell)
+    _cell_hooks_enabled = True
@@ -0,0 +1,545 @@
+import os
+import json
+from datetime import datetime, timedelta
+import pandas as pd
+from storageBackends import get_backend
+
+with open(f"{os.path.dirname(__file__)}/sql_tables.json", 'r', encoding='utf-8') as f:
+    sql_tables = json.load(f)
+
+# Hours after which a project's candidate pool is rebuilt from the grader table
+pool_rebuild_hours = 24
+
+# Names of the pseudo-graders holding the coarse text search results, which the
+# candidate pool does not count as graders
+text_search_prefix = "Coarse Text Search"
+
+# Minutes a grader holds a claimed report before other graders may take it over,
+# e.g. when the notebook crashed between claiming and queueing the report
+claim_lease_minutes = 10
+
+
+def rebuild_candidate_pool(project, grade_criteria, backend=None, seen_rebuilt_at=None):
+    """
+    Recompute the queue candidates of a project: every report of the project with
+    the number of graders who have it in their queue (counter) and the sum of their
+    grades for the project's grading criteria, plus the columns the projects sort
+    candidates by. As before the pool, only Unique rows of real graders count (not
+    reliability rows or the text search pseudo-graders), and reports with only such
+    rows are not candidates. This is the only step that scans the grader table
+
+    The old pool is replaced in one transaction, so select_candidates never finds
+    it empty, and callers rebuilding at the same time run one after the other. The
+    rebuild is recorded in the pool rebuilds table, so that an empty pool is not
+    rebuilt again until it is stale
+
+    Args:
+        project (string): Project to build the pool for
+        grade_criteria (string): Grading criteria of the project
+        backend (StorageBackend): backend to use (default: the active backend)
+        seen_rebuilt_at (string): rebuilt_at of the pool the caller found stale. The
+                                  rebuild is skipped if another caller rebuilt the pool
+                                  since (None always rebuilds)
+    """
+
+    global sql_tables
+    if backend is None:
+        backend = get_backend()
+    params = {
+        "project": project,
+        "criteria": grade_criteria,
+        "rebuilt_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "seen_rebuilt_at": str(seen_rebuilt_at) if seen_rebuilt_at is not None else "9999-12-31",
+        "text_search_graders": text_search_prefix + "%",
+    }
+
+    # Every statement is skipped if another caller rebuilt the pool since
+    fresh = f'''
+      NOT EXISTS (
+        SELECT 1 FROM {sql_tables["pool_rebuilds_table"]} fresh
+        WHERE fresh.project = @project and fresh.grade_criteria = @criteria
+          and fresh.rebuilt_at > @seen_rebuilt_at
+      )'''
+    q_delete = f'''
+    DELETE FROM {sql_tables["candidate_pool_table"]}
+    WHERE project = @project and grade_criteria = @criteria and {fresh}'''
+    # Reports graded before are kept as validation candidates, reports never graded
+    # are only candidates if they are not reconciled outside data
+    q_rebuild = f'''
+    INSERT INTO {sql_tables["candidate_pool_table"]} (project, grade_criteria, proc_ord_id, pat_id,
+        counter, grade_sum, birth_weight_kg, gestational_age_num, proc_ord_datetime, proc_ord_age)
+    WITH counts AS (
+      SELECT proc_ord_id, COUNT(*) AS counter, SUM(grade) AS grade_sum
+      FROM {sql_tables["grader_table"]}
+      WHERE grade_criteria = @criteria
+        and grade_category = "Unique"
+        and name NOT LIKE @text_search_graders
+      GROUP BY proc_ord_id
+    ),
+    queued AS (
+      SELECT DISTINCT proc_ord_id
+      FROM {sql_tables["grader_table"]}
+      WHERE grade_criteria = @criteria
+    ),
+    project_reports AS (
+      SELECT DISTINCT proc_ord_id, pat_id
+      FROM {sql_tables["project_table"]}
+      WHERE project = @project
+    )
+    SELECT
+      @project, @criteria, project_reports.proc_ord_id, project_reports.pat_id,
+      COALESCE(counts.counter, 0), COALESCE(counts.grade_sum, 0),
+      pat.birth_weight_kg, pat.gestational_age_num, proc.proc_ord_datetime, proc.proc_ord_age
+    FROM project_reports
+    LEFT JOIN counts ON (counts.proc_ord_id = project_reports.proc_ord_id)
+    LEFT JOIN queued ON (queued.proc_ord_id = project_reports.proc_ord_id)
+    LEFT JOIN {sql_tables["procedure_table"]} proc ON (proc.proc_ord_id = project_reports.proc_ord_id)
+    LEFT JOIN {sql_tables["patient_table"]} pat ON (pat.pat_id = proc.pat_id)
+    LEFT JOIN visits enc ON (proc.encounter_id = enc.encounter_id)
+    WHERE (counts.counter IS NOT NULL
+      OR (queued.proc_ord_id IS NULL and enc.enc_type_name != "Reconciled Outside Data"))
+      AND {fresh}'''
+    # The rebuild row goes last, as the statements before check the previous one
+    q_delete_rebuild = f'''
+    DELETE FROM {sql_tables["pool_rebuilds_table"]}
+    WHERE project = @project and grade_criteria = @criteria and {fresh}'''
+    q_record_rebuild = f'''
+    INSERT INTO {sql_tables["pool_rebuilds_table"]} (project, grade_criteria, project_reports, rebuilt_at)
+    SELECT @project, @criteria, project_reports.n, @rebuilt_at
+    FROM (
+      SELECT COUNT(DISTINCT proc_ord_id) AS n FROM {sql_tables["project_table"]} WHERE project = @project
+    ) project_reports
+    WHERE {fresh}'''
+    backend.execute_transaction([q_delete, q_rebuild, q_delete_rebuild, q_record_rebuild], params)
+
+
+def ensure_candidate_pool(project, grade_criteria, backend=None, max_age_hours=pool_rebuild_hours):
+    """
+    Rebuild a project's candidate pool if it was never built, was marked stale, is
+    older than max_age_hours, or reports were added to or removed from the project
+    since. Whether the pool is stale is read from its row in the pool rebuilds table,
+    so a pool without candidates is not rebuilt on every call
+    """
+
+    global sql_tables
+    if backend is None:
+        backend = get_backend()
+    df = backend.query(f'''
+        SELECT
+          (SELECT MAX(rebuilt_at) FROM {sql_tables["pool_rebuilds_table"]}
+           WHERE project = @project and grade_criteria = @criteria) AS rebuilt_at,
+          (SELECT MAX(project_reports) FROM {sql_tables["pool_rebuilds_table"]}
+           WHERE project = @project and grade_criteria = @criteria) AS pool_project_reports,
+          (SELECT COUNT(DISTINCT proc_ord_id) FROM {sql_tables["project_table"]}
+           WHERE project = @project) AS project_reports''',
+        {"project": project, "criteria": grade_criteria},
+    )
+    rebuilt_at = df["rebuilt_at"].values[0]
+    if pd.isna(rebuilt_at):
+        # Any rebuild made since by another caller is newer than never
+        rebuild_candidate_pool(project, grade_criteria, backend, "")
+    elif (datetime.now() - datetime.fromisoformat(str(rebuilt_at)) > timedelta(hours=max_age_hours)
+            or df["pool_project_reports"].values[0] != df["project_reports"].values[0]):
+        rebuild_candidate_pool(project, grade_criteria, backend, rebuilt_at)
+
+
+def mark_candidate_pool_stale(grade_criteria, backend=None):
+    """
+    Make the next ensure_candidate_pool rebuild the candidate pools of some grading
+    criteria, e.g. after an update of the pool failed and left its counters behind
+    the grader table
+
+    Args:
+        grade_criteria (list): Grading criteria of the pools
+        backend (StorageBackend): backend to use (default: the active backend)
+    """
+
+    global sql_tables
+    if len(grade_criteria) == 0:
+        return
+    if backend is None:
+        backend = get_backend()
+    # A transaction of its own, so that it is retried if a concurrent update aborts it
+    backend.execute_transaction(
+        [f"UPDATE {sql_tables['pool_rebuilds_table']} SET rebuilt_at = NULL WHERE grade_criteria IN @criteria"],
+        {"criteria": list(grade_criteria)},
+    )
+
+
+def candidate_pool_write(changes):
+    """
+    Write applying changes of the grader table to the counter and grade_sum of the candidates
+
+    Args:
+        changes (dataframe): rows from progressSummary.grade_changes or queued_reports
+
+    Return:
+        (tuple): increment_rows write for StorageBackend.write_transaction
+    """
+
+    global sql_tables
+    # The pool counts Unique rows of real graders only (see rebuild_candidate_pool)
+    changes = changes[
+        (changes["grade_category"] == "Unique")
+        & ~changes["name"].astype(str).str.startswith(text_search_prefix)
+    ]
+    deltas = pd.DataFrame({
+        "grade_criteria": changes["grade_criteria"].values,
+        "proc_ord_id": changes["proc_ord_id"].astype(str).values,
+        # A row without a previous grade is a new row of the grader table
+        "counter": changes["grade"].isna().astype(int).values,
+        "grade_sum": (changes["new_grade"].astype(int) - changes["grade"].fillna(0).astype(int)).values,
+    })
+    deltas = deltas.groupby(["grade_criteria", "proc_ord_id"], as_index=False)[["counter", "grade_sum"]].sum()
+    deltas = deltas[(deltas["counter"] != 0) | (deltas["grade_sum"] != 0)]
+    return (
+        "increment_rows",
+        sql_tables["candidate_pool_table"],
+        deltas.to_dict("records"),
+        ["grade_criteria", "proc_ord_id"],
+        ["counter", "grade_sum"],
+        False,
+    )
+
+
+def select_candidates(name, project, grade_criteria, num_to_add, num_validation, order_params, backend=None):
+    """
+    Pick the next reports to add to a grader's queue from the project's candidate pool:
+    validation reports graded by fewer than num_validation graders with an average
+    grade in (0, 2], and reports nobody has graded yet
+
+    Args:
+        name (string): Full name of the grader (to also be referenced in publications)
+        project (string): Project to grade for
+        grade_criteria (string): Grading criteria of the project
+        num_to_add (int): Number of reports to pick
+        num_validation (int): Number of graders each validation report needs (0 for no validation)
+        order_params (list): ORDER BY terms from the project parameter file
+        backend (StorageBackend): backend to use (default: the active backend)
+
+    Return:
+        df_reports (dataframe): proc_ord_id, counter, avg_grade, report_type ("validation"
+        or "new") and the sort columns of each picked report
+    """
+
+    global sql_tables
+    if backend is None:
+        backend = get_backend()
+    ensure_candidate_pool(project, grade_criteria, backend)
+
+    q_candidates = f'''
+    SELECT * FROM (
+      SELECT
+        proc_ord_id, pat_id, counter,
+        CASE WHEN counter > 0 THEN grade_sum * 1.0 / counter END AS avg_grade,
+        CASE WHEN counter = 0 THEN "new" ELSE "validation" END AS report_type,
+        birth_weight_kg, gestational_age_num, proc_ord_datetime, proc_ord_age
+      FROM {sql_tables["candidate_pool_table"]} candidates
+      WHERE project = @project
+        and grade_criteria = @criteria
+        and (counter = 0 or (counter < @num_validation and grade_sum > 0 and grade_sum <= 2 * counter))
+        and proc_ord_id NOT IN (
+          SELECT proc_ord_id FROM {sql_tables["grader_table"]}
+          WHERE name = @name and grade_criteria = @criteria
+        )
+        and NOT EXISTS (
+          SELECT 1 FROM {sql_tables["claims_table"]} claims
+          WHERE claims.proc_ord_id = candidates.proc_ord_id
+            and claims.grade_criteria = @criteria
+            and claims.slot >= candidates.counter
+            and (claims.status = "committed" or claims.expires_at >= @now)
+        )
+    ) candidates
+    ORDER BY {", ".join(order_params)}
+    LIMIT {int(num_to_add)}'''
+    return backend.query(q_candidates, {
+        "project": project,
+        "criteria": grade_criteria,
+        "num_validation": int(num_validation),
+        "name": name,
+        "now": _timestamp(),
+    })
+
+
+def _timestamp(offset_minutes=0):
+    # Claim times are compared as text, so keep one fixed format with microseconds
+    return (datetime.now() + timedelta(minutes=offset_minutes)).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+def claim_reports(df_reports, name, grade_criteria, backend=None, lease_minutes=claim_lease_minutes):
+    """
+    Claim reports picked by select_candidates for a grader. Each report has one
+    claim slot per grader it can have (slot = counter, the number of graders it
+    had when picked), and a slot can only be claimed once. Of several graders
+    picking the same report at the same time only one gets it, so no report is
+    queued for more graders than the validation allows.
+
+    A claim is a lease until commit_claims: leases older than lease_minutes are
+    dropped and their reports can be claimed again. A report is only queued once
+    its claim is committed. Where the table has no unique key (BigQuery) two graders
+    may both believe they hold a slot here; commit_claims settles it
+
+    Args:
+        df_reports (dataframe): reports from select_candidates
+        name (string): Full name of the grader
+        grade_criteria (string): Grading criteria of the project
+        backend (StorageBackend): backend to use (default: the active backend)
+        lease_minutes (float): How long the claims are held before commit_claims
+
+    Return:
+        df_claimed (dataframe): the rows of df_reports this grader claimed
+    """
+
+    global sql_tables
+    if backend is None:
+        backend = get_backend()
+    if len(df_reports) == 0:
+        return df_reports
+
+    now = _timestamp()
+    backend.execute(
+        f'DELETE FROM {sql_tables["claims_table"]} WHERE status = "leased" and expires_at < @now',
+        {"now": now},
+    )
+
+    proc_ord_ids = df_reports["proc_ord_id"].astype(str).tolist()
+    slots = df_reports["counter"].astype(int).tolist()
+    expires_at = _timestamp(lease_minutes)
+    backend.insert_missing_rows(
+        sql_tables["claims_table"],
+        [{
+            "proc_ord_id": proc_ord_id,
+            "grade_criteria": grade_criteria,
+            "slot": slot,
+            "name": name,
+            "status": "leased",
+            "claimed_at": now,
+            "expires_at": expires_at,
+        } for proc_ord_id, slot in zip(proc_ord_ids, slots)],
+        ["proc_ord_id", "grade_criteria", "slot"],
+    )
+
+    # Read the claims back: without a unique key (BigQuery) simultaneous claims of
+    # a slot may all be written. The earliest one is kept here so that most losers
+    # drop out early, but the claim times come from the graders' clocks: the slot is
+    # only settled by commit_claims
+    df_claims = backend.query(f'''
+    SELECT proc_ord_id, slot, name, claimed_at FROM {sql_tables["claims_table"]}
+    WHERE grade_criteria = @criteria and proc_ord_id IN @proc_ord_ids''',
+        {"criteria": grade_criteria, "proc_ord_ids": proc_ord_ids},
+    )
+    df_claims["proc_ord_id"] = df_claims["proc_ord_id"].astype(str)
+    df_claims["slot"] = df_claims["slot"].astype(int)
+    holders = df_claims.sort_values(["claimed_at", "name"]).drop_duplicates(["proc_ord_id", "slot"])
+    won = holders[holders["name"] == name].merge(
+        pd.DataFrame({"proc_ord_id": proc_ord_ids, "slot": slots})
+    )["proc_ord_id"]
+    return df_reports[df_reports["proc_ord_id"].astype(str).isin(won)]
+
+
+def commit_claims(df_claimed, name, grade_criteria, backend=None):
+    """
+    Turn a grader's leases into permanent claims before queueing the reports. A
+    slot is committed for one grader only: the leases are committed in a single
+    transaction that skips slots another grader committed first or that the
+    candidate pool counts as taken already (counter above the slot), and the
+    leases that lost their slot are deleted in the same transaction. Leases that expired
+    and were dropped in the meantime are not committed either, so those reports
+    must not be queued. Committed claims stay until drop_settled_claims finds the
+    report counted in the candidate pool
+
+    Args:
+        df_claimed (dataframe): reports from claim_reports
+        name (string): Full name of the grader
+        grade_criteria (string): Grading criteria of the project
+        backend (StorageBackend): backend to use (default: the active backend)
+
+    Return:
+        df_committed (dataframe): the rows of df_claimed that are now committed
+    """
+
+    global sql_tables
+    if len(df_claimed) == 0:
+        return df_claimed
+    if backend is None:
+        backend = get_backend()
+    params = {
+        "name": name,
+        "criteria": grade_criteria,
+        "proc_ord_ids": df_claimed["proc_ord_id"].astype(str).tolist(),
+    }
+    backend.execute_transaction([
+        f'''
+        UPDATE {sql_tables["claims_table"]} AS claims SET status = "committed", expires_at = NULL
+        WHERE name = @name and grade_criteria = @criteria and status = "leased" and proc_ord_id IN @proc_ord_ids
+          and NOT EXISTS (
+            SELECT 1 FROM {sql_tables["claims_table"]} other
+            WHERE other.proc_ord_id = claims.proc_ord_id
+              and other.grade_criteria = claims.grade_criteria
+              and other.slot = claims.slot
+              and other.status = "committed"
+          )
+          -- Another grader was queued the report since it was picked (and their claim dropped)
+          and NOT EXISTS (
+            SELECT 1 FROM {sql_tables["candidate_pool_table"]} candidates
+            WHERE candidates.proc_ord_id = claims.proc_ord_id
+              and candidates.grade_criteria = claims.grade_criteria
+              and candidates.counter > claims.slot
+          )''',
+        f'''
+        DELETE FROM {sql_tables["claims_table"]}
+        WHERE name = @name and grade_criteria = @criteria and status = "leased" and proc_ord_id IN @proc_ord_ids''',
+    ], params)
+    df_committed = backend.query(f'''
+    SELECT proc_ord_id, slot FROM {sql_tables["claims_table"]}
+    WHERE name = @name and grade_criteria = @criteria and status = "committed" and proc_ord_id IN @proc_ord_ids''',
+        params,
+    )
+    committed = set(zip(df_committed["proc_ord_id"].astype(str), df_committed["slot"].astype(int)))
+    keys = zip(df_claimed["proc_ord_id"].astype(str), df_claimed["counter"].astype(int))
+    return df_claimed[[key in committed for key in keys]]
+
+
+def drop_settled_claims(grade_criteria, backend=None):
+    """
+    Delete the committed claims that no longer hold back other graders: the report
+    is in the grader's queue and every candidate pool already counts it (counter
+    above the slot), so select_candidates skips the slot without the claim. Also
+    clears claims left by graders whose notebook stopped after queueing
+
+    Args:
+        grade_criteria (string): Grading criteria of the claims
+        backend (StorageBackend): backend to use (default: the active backend)
+    """
+
+    global sql_tables
+    if backend is None:
+        backend = get_backend()
+    backend.execute(f'''
+    DELETE FROM {sql_tables["claims_table"]} AS claims
+    WHERE status = "committed" and grade_criteria = @criteria
+      and EXISTS (
+        SELECT 1 FROM {sql_tables["grader_table"]} grader
+        WHERE grader.proc_ord_id = claims.proc_ord_id
+          and grader.name = claims.name
+          and grader.grade_criteria = @criteria
+      )
+      and NOT EXISTS (
+        SELECT 1 FROM {sql_tables["candidate_pool_table"]} candidates
+        WHERE candidates.proc_ord_id = claims.proc_ord_id
+          and candidates.grade_criteria = @criteria
+          and candidates.counter <= claims.slot
+      )''', {"criteria": grade_criteria})
+
+
+def queue_reports(proc_ord_ids, name, project, grade_criteria, backend=None):
+    """
+    Add reports to a grader's queue (grader table rows with grade 999). Reports
+    without a procedure or patient row cannot be queued and are left out
+
+    Args:
+        proc_ord_ids (list): List of proc_ord_ids associated with a report to grade
+        name (string): Full name of the grader (to also be referenced in publications)
+        project (string): Project to grade for
+        grade_criteria (string): Grading criteria of the project
+        backend (StorageBackend): backend to use (default: the active backend)
+
+    Return:
+        (list): the proc_ord_ids that were queued
+    """
+    # Imported here because progressSummary imports this module
+    from progressSummary import record_grade_changes, queued_reports
+
+    global sql_tables
+    if len(proc_ord_ids) == 0:
+        return []
+    if backend is None:
+        backend = get_backend()
+
+    # Only the reports the insert below joins to a procedure and a patient are queued,
+    # and only those may be counted in the progress summary and candidate pool
+    report_join = f'''
+          {sql_tables["procedure_table"]} proc_ord
+          join {sql_tables["patient_table"]} pat on proc_ord.pat_id = pat.pat_id
+        where
+          proc_ord.proc_ord_id in @proc_ord_ids'''
+    df_found = backend.query(
+        f"select distinct proc_ord.proc_ord_id from {report_join}", {"proc_ord_ids": [str(i) for i in proc_ord_ids]}
+    )
+    found = set(df_found["proc_ord_id"].astype(str))
+    proc_ord_ids = [str(i) for i in proc_ord_ids if str(i) in found]
+    if len(proc_ord_ids) == 0:
+        return []
+
+    cols = backend.table_columns(sql_tables["grader_table"])
+    q_insert = f'''insert into {sql_tables["grader_table"]} ({", ".join(cols)})
+        select
+          distinct
+          proc_ord.proc_ord_id, @name as name,
+          999 as grade,
+          "Unique" as grade_category,
+          proc_ord.pat_id,
+          proc_ord.proc_ord_age as age_in_days,
+          proc_ord.proc_ord_year,
+          proc_ord.proc_ord_desc as proc_name,
+          "procedure_order" as report_origin_table, '''
+    if "project" in cols:
+        q_insert += "@project as project, "
+    q_insert += f'''"0000-00-00" as grade_date,
+          @criteria as grade_criteria
+        from {report_join}'''
+    backend.execute(q_insert, {
+        "name": name,
+        "project": project,
+        "criteria": grade_criteria,
+        "proc_ord_ids": proc_ord_ids,
+    })
+    record_grade_changes(queued_reports(proc_ord_ids, name, grade_criteria, "Unique"), backend)
+    return proc_ord_ids
+
+
+def assign_reports(name, project, grade_criteria, num_to_add, num_validation, order_params,
+                   backend=None, lease_minutes=claim_lease_minutes, max_rounds=3):
+    """
+    Pick, claim and queue reports for a grader. Safe to run for many graders at
+    the same time: reports another grader claimed first are skipped and replaced
+    by the next candidates, for up to max_rounds rounds
+
+    Args:
+        name (string): Full name of the grader (to also be referenced in publications)
+        project (string): Project to grade for
+        grade_criteria (string): Grading criteria of the project
+        num_to_add (int): Number of reports to add to the queue
+        num_validation (int): Number of graders each validation report needs (0 for no validation)
+        order_params (list): ORDER BY terms from the project parameter file
+        backend (StorageBackend): backend to use (default: the active backend)
+        lease_minutes (float): How long claims are held before the reports are queued
+        max_rounds (int): Number of times to pick new candidates for lost claims
+
+    Return:
+        df_reports (dataframe): the queued reports, as returned by select_candidates
+    """
+
+    if backend is None:
+        backend = get_backend()
+
+    claimed = []
+    n_claimed = 0
+    for _ in range(max_rounds):
+        if n_claimed >= num_to_add:
+            break
+        df_candidates = select_candidates(
+            name, project, grade_criteria, num_to_add - n_claimed, num_validation, order_params, backend
+        )
+        if len(df_candidates) == 0:
+            break
+        df_claimed = claim_reports(df_candidates, name, grade_criteria, backend, lease_minutes)
+        claimed.append(df_claimed)
+        n_claimed += len(df_claimed)
+
+    if len(claimed) == 0:
+        return pd.DataFrame(columns=["proc_ord_id", "counter", "avg_grade", "report_type"])
+    df_reports = commit_claims(pd.concat(claimed, ignore_index=True), name, grade_criteria, backend)
+    queued = queue_reports(df_reports["proc_ord_id"].astype(str).tolist(), name, project, grade_criteria, backend)
+    drop_settled_claims(grade_criteria, backend)
+    return df_reports[df_reports["proc_ord_id"].astype(str).isin(queued)]
@@ -1,14 +1,19 @@
 import pandas as pd
+import numpy as np
 from annotationHelperLib import *
-from sklearn.metrics import cohen_kappa_score
 from IPython.display import clear_output
-from google.cloud import bigquery 
+from storageBackends import *
+from queryLog import labelled
+from reportCache import get_report_cache
 import os
 import json
 
 with open(f"{os.path.dirname(__file__)}/sql_tables.json", 'r', encoding='utf-8') as f:
     sql_tables = json.load(f)
-    
+
+# Prefix of the report cache keys of reports read from reports_master
+master_cache_prefix = "reports_master:"
+
 
 def get_reliability_proc_ord_ids():
     """
@@ -25,6 +30,7 @@ def get_reliability_proc_ord_ids():
     return proc_ord_ids
 
 
+@labelled
 def get_reliability_ratings_df():
     """
     Load reliability ratings dataframe
@@ -34,11 +40,11 @@ def get_reliability_ratings_df():
     """
     
     global sql_tables
-    # Initialize the client service
-    client = bigquery.Client()
+    # Get the storage backend
+    backend = get_backend()
 
     reliability_ratings_query = "select * from " + sql_tables["grader_table"] + " where grade_category = 'Reliability';"
-    df_reliability = client.query(reliability_ratings_query).to_dataframe()
+    df_reliability = backend.query(reliability_ratings_query)
     df_reliability[["grade", "proc_ord_id"]] = df_reliability[
         ["grade", "proc_ord_id"]
     ].astype("int64")
@@ -69,7 +75,7 @@ def get_reliability_ratings_df():
       inner join cte on main.proc_ord_id = cte.proc_ord_id
     """
 
-    df_reliability = client.query(query).to_dataframe()
+    df_reliability = backend.query(query)
     reliability_ids = sorted(list(df_reliability["proc_ord_id"].values))[:-1]
 
     df_ratings = df_ratings[df_ratings["proc_ord_id"].isin(reliability_ids)]
@@ -77,6 +83,45 @@ def get_reliability_ratings_df():
     return df_ratings
 
 
+def compare_grader_grades(df_grades1, df_grades2):
+    """
+    Align the grades of 2 graders on proc_ord_id and compare them in one pass
+
+    Args:
+        df_grades1 (dataframe): A dataframe object with columns proc_ord_id and grade for user 1
+        df_grades2 (dataframe): A dataframe object with columns proc_ord_id and grade for user 2
+
+    Return:
+        comparison (dictionary): "disagreement_ids" (proc_ord_ids with 2 different grades,
+        sorted), "agreement_matrix" (counts of user 1 grade x user 2 grade), "pending_ids"
+        (proc_ord_ids excluded because either grade is 999) and "shared" (number of
+        reports graded by both)
+    """
+
+    merged = pd.merge(
+        df_grades1[["proc_ord_id", "grade"]],
+        df_grades2[["proc_ord_id", "grade"]],
+        on="proc_ord_id",
+        suffixes=("_1", "_2"),
+    ).sort_values("proc_ord_id", kind="stable", ignore_index=True)
+
+    # Reports still in a queue (grade 999) are not compared
+    pending = (merged["grade_1"] == 999) | (merged["grade_2"] == 999)
+    graded = merged[~pending]
+    disagree = graded["grade_1"].values != graded["grade_2"].values
+
+    agreement_matrix = pd.crosstab(
+        graded["grade_1"].rename("user 1 grade"), graded["grade_2"].rename("user 2 grade")
+    )
+
+    return {
+        "disagreement_ids": list(graded["proc_ord_id"].values[disagree]),
+        "agreement_matrix": agreement_matrix,
+        "pending_ids": list(merged["proc_ord_id"][pending].values),
+        "shared": len(graded),
+    }
+
+
 def identify_disagreement_reports(df_grades1, df_grades2):
     """
     Identifies reports with different grades for 2 graders
@@ -89,56 +134,129 @@ def identify_disagreement_reports(df_grades1, df_grades2):
         disagreement_proc_ord_ids (list): proc_ord_id strings specifying reports with 2 different grades
     """
     
-    # Double check that the incoming dataframes are sorted the same way
-    df_grades1 = df_grades1.sort_values("proc_ord_id", ignore_index=True)
-    df_grades2 = df_grades2.sort_values("proc_ord_id", ignore_index=True)
-
-    # Triple check the order
-    assert list(df_grades1["proc_ord_id"].values) == list(
-        df_grades2["proc_ord_id"].values
+    # Double check that both graders have the same reports
+    assert np.array_equal(
+        np.sort(df_grades1["proc_ord_id"].values), np.sort(df_grades2["proc_ord_id"].values)
     )
 
-    shared = 0
-    disagreement_proc_ord_ids = []
+    return compare_grader_grades(df_grades1, df_grades2)["disagreement_ids"]
 
-    for idx, row in df_grades1.iterrows():
-        proc_ord_id = row["proc_ord_id"]
-        grades = [df_grades1.iloc[idx]["grade"], df_grades2.iloc[idx]["grade"]]
-        if 999.0 in grades:
-            continue
-        else:
-            shared += 1
-            if grades[0] != grades[1]:
-                disagreement_proc_ord_ids.append(proc_ord_id)
 
-    return disagreement_proc_ord_ids
+def confusion_matrices(grades1, grades2, n_grades = 3):
+    """
+    Count the confusion matrix of one or many pairs of graders with a single bincount
 
+    Args:
+        grades1 (array): grades of the first grader of each pair, shape (n_reports,)
+                         or (n_pairs, n_reports). NaN marks a report the grader has not graded
+        grades2 (array): grades of the second grader of each pair, same shape as grades1
+        n_grades (int): Number of grade levels (grades 0 to n_grades - 1)
 
-def calc_kappa(user1_grades, user2_grades):
+    Return:
+        confusion (array): (n_grades, n_grades) or (n_pairs, n_grades, n_grades) counts,
+        over the reports both graders of a pair have graded
     """
-    For a pair of users with their grades in separate dataframes, compare them and calculate kappa
+
+    grades1 = np.asarray(grades1, dtype=float)
+    grades2 = np.asarray(grades2, dtype=float)
+    batched = grades1.ndim == 2
+    grades1 = np.atleast_2d(grades1)
+    grades2 = np.atleast_2d(grades2)
+
+    graded = ~np.isnan(grades1) & ~np.isnan(grades2)
+    pair_idx = np.nonzero(graded)[0]
+    codes = (pair_idx * n_grades + grades1[graded].astype(int)) * n_grades + grades2[graded].astype(int)
+    confusion = np.bincount(codes, minlength=len(grades1) * n_grades * n_grades)
+    confusion = confusion.reshape(len(grades1), n_grades, n_grades)
+    return confusion if batched else confusion[0]
+
+
+def collapse_confusion(confusion, groups):
+    """
+    Merge grade levels of confusion matrices
 
     Args:
-        user1_grades (dataframe): proc_ord_id and corresponding grades for grader 1 reliability reports
-        user2_grades (dataframe): proc_ord_id and corresponding grades for grader 2 reliability reports
-    
+        confusion (array): (..., n_grades, n_grades) confusion matrices
+        groups (list): new level of each grade, e.g. [0, 0, 1] compares 2 against 0+1
+
     Return:
-        kappa (float): Cohen's kappa between grader 1 and 2
+        (array): (..., n_groups, n_groups) confusion matrices
     """
-    
-    # Double check that the incoming dataframes are sorted the same way
+
+    merge = np.zeros((np.shape(confusion)[-1], max(groups, default=0) + 1))
+    merge[np.arange(len(groups)), groups] = 1
+    return merge.T @ confusion @ merge
+
+
+def kappa_from_confusion(confusion, weights = None):
+    """
+    Cohen's kappa of one or many confusion matrices
+
+    Args:
+        confusion (array): (..., n_grades, n_grades) confusion matrices
+        weights (string): None for unweighted kappa, "linear" or "quadratic" to weight
+                          disagreements by the distance between grade levels
+
+    Return:
+        kappa (array): kappa of each confusion matrix. NaN when the pair has no common
+        reports or when chance agreement is already perfect (e.g. both graders gave one grade)
+    """
+
+    confusion = np.asarray(confusion, dtype=float)
+    n_grades = confusion.shape[-1]
+    levels = np.arange(n_grades)
+    if weights is None:
+        w = 1 - np.eye(n_grades)
+    elif weights == "linear":
+        w = np.abs(levels[:, None] - levels[None, :]).astype(float)
+    elif weights == "quadratic":
+        w = (levels[:, None] - levels[None, :]).astype(float) ** 2
+    else:
+        raise ValueError(f"Unknown weights {weights}. Options: None, linear, quadratic")
+
+    n = confusion.sum(axis=(-2, -1))
+    expected = confusion.sum(axis=-1)[..., :, None] * confusion.sum(axis=-2)[..., None, :]
+    observed_disagreement = (w * confusion).sum(axis=(-2, -1))
+    expected_disagreement = (w * expected).sum(axis=(-2, -1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        kappa = 1 - observed_disagreement * n / expected_disagreement
+    return np.where((expected_disagreement == 0) | (n == 0), np.nan, kappa)
+
+
+def _pair_confusion(user1_grades, user2_grades):
+    # Confusion matrix of two graders' grade dataframes, matched by proc_ord_id, over
+    # the grade levels either grader used (e.g. unfiltered 999s become their own level)
     user1_grades = user1_grades.sort_values("proc_ord_id")
     user2_grades = user2_grades.sort_values("proc_ord_id")
 
-    # Triple check the order
+    # Double check the order
     assert list(user1_grades["proc_ord_id"].values) == list(
         user2_grades["proc_ord_id"].values
     )
-
-    # Calculate Cohen's kappa
-    kappa = cohen_kappa_score(
-        list(user1_grades["grade"].values), list(user2_grades["grade"].values)
+    grades1 = user1_grades["grade"].values.astype(float)
+    grades2 = user2_grades["grade"].values.astype(float)
+    levels = np.union1d(grades1, grades2)
+    confusion = confusion_matrices(
+        np.searchsorted(levels, grades1), np.searchsorted(levels, grades2), n_grades=max(len(levels), 1)
     )
+    return confusion, levels
+
+
+def calc_kappa(user1_grades, user2_grades, weights = None):
+    """
+    For a pair of users with their grades in separate dataframes, compare them and calculate kappa
+
+    Args:
+        user1_grades (dataframe): proc_ord_id and corresponding grades for grader 1 reliability reports
+        user2_grades (dataframe): proc_ord_id and corresponding grades for grader 2 reliability reports
+        weights (string): None, "linear" or "quadratic" (see kappa_from_confusion)
+    
+    Return:
+        kappa (float): Cohen's kappa between grader 1 and 2
+    """
+
+    confusion, levels = _pair_confusion(user1_grades, user2_grades)
+    kappa = float(kappa_from_confusion(confusion, weights))
     # print("Cohen's kappa:", kappa)
     return kappa
 
@@ -156,16 +274,10 @@ def calc_kappa_2_v_all(user1_grades, user2_grades):
     Return:
         kappa (float): Cohen's kappa between grader 1 and 2
     """
-    
-    grades1 = user1_grades["grade"].values.astype(int)
-    grades2 = user2_grades["grade"].values.astype(int)
 
-    condenser = lambda x: 2 if x == 2 else 0
-
-    grades1 = [condenser(i) for i in grades1]
-    grades2 = [condenser(i) for i in grades2]
-
-    kappa = cohen_kappa_score(grades1, grades2)
+    confusion, levels = _pair_confusion(user1_grades, user2_grades)
+    confusion = collapse_confusion(confusion, [int(level == 2) for level in levels])
+    kappa = float(kappa_from_confusion(confusion))
 
     print(" 2 vs. 0+1 kappa:", kappa)
     return kappa
@@ -185,20 +297,15 @@ def calc_kappa_0_v_all(user1_grades, user2_grades):
         kappa (float): Cohen's kappa between grader 1 and 2
     """
 
-    grades1 = user1_grades["grade"].values.astype(int)
-    grades2 = user2_grades["grade"].values.astype(int)
-
-    condenser = lambda x: 0 if x == 0 else 2
-
-    grades1 = [condenser(i) for i in grades1]
-    grades2 = [condenser(i) for i in grades2]
-
-    kappa = cohen_kappa_score(grades1, grades2)
+    confusion, levels = _pair_confusion(user1_grades, user2_grades)
+    confusion = collapse_confusion(confusion, [int(level != 0) for level in levels])
+    kappa = float(kappa_from_confusion(confusion))
 
     print(" 0 vs. 1+2 kappa:", kappa)
     return kappa
 
 
+@labelled
 def get_reports_for_user(user, proc_ord_ids, project = "reliability"):
     """
    Queue reliability reports for a user to grade
@@ -213,7 +320,7 @@ def get_reports_for_user(user, proc_ord_ids, project = "reliability"):
     """
      
     global sql_tables
-    client = bigquery.Client()
+    backend = get_backend()
 
     get_user_reports = '''select cast(proc_ord_id as int64) as proc_ord_id, 
     grade, grade_category, grade_date
@@ -227,7 +334,7 @@ def get_reports_for_user(user, proc_ord_ids, project = "reliability"):
         get_user_reports += '''"
         and grade_category = "Unique";'''
         
-    user_reliablity_reports = client.query(get_user_reports).to_dataframe()
+    user_reliablity_reports = backend.query(get_user_reports)
     user_reliablity_reports = user_reliablity_reports[
         user_reliablity_reports["proc_ord_id"].astype(int).isin(proc_ord_ids)
     ]
@@ -235,6 +342,7 @@ def get_reports_for_user(user, proc_ord_ids, project = "reliability"):
     return user_reliablity_reports
 
 
+@labelled
 def print_report_from_proc_ord_id(proc_ord_id):
     """
     Print a specified radiology report
@@ -244,25 +352,35 @@ def print_report_from_proc_ord_id(proc_ord_id):
     """
     
     global sql_tables
-    client = bigquery.Client()
+    backend = get_backend()
 
     print("Proc ord id:", proc_ord_id)
     print()
 
+    # Reports read by several graders are only downloaded once. Text read from
+    # reports_master is not formatted like load_report_texts, so it has its own keys
+    report_cache = get_report_cache()
+    cache_key = master_cache_prefix + str(proc_ord_id)
+    report_text = report_cache.get(cache_key)
+    if report_text is not None:
+        print(report_text)
+        return
+
     # Get the report for that proc_ord_id from the primary report table
     get_report_row = (
         'SELECT * FROM reports_master where proc_ord_id like "'
         + str(proc_ord_id)
         + '"'
     )
-    df_report = client.query(get_report_row).to_dataframe()
+    df_report = backend.query(get_report_row)
 
     # If the id was in the original table:
     if len(df_report) == 1:
         # Combine the narrative and impression text
         report_text = df_report["narrative_text"].values[0]
-        if df_report["impression_text"].values[0] != "nan":
-            report_text += "\n\nIMPRESSION: " + df_report["impression_text"].values[0]
+        impression_text = df_report["impression_text"].values[0]
+        if report_text is not None and pd.notna(impression_text) and impression_text != "nan":
+            report_text += "\n\nIMPRESSION: " + impression_text
 
     elif len(df_report) == 0:
         get_report_row = (
@@ -270,20 +388,28 @@ def print_report_from_proc_ord_id(proc_ord_id):
             + str(proc_ord_id)
             + '"'
         )
-        report_text = (
-            client.query(get_report_row).to_dataframe()["narrative_text"].values[0]
-        )
+        df_narrative = backend.query(get_report_row)
+        if len(df_narrative) > 0:
+            report_text = df_narrative["narrative_text"].values[0]
 
         get_report_row = (
             'SELECT * FROM ' + sql_tables["impression_table"] + ' where proc_ord_id like "'
             + str(proc_ord_id)
             + '"'
         )
-        df_report = client.query(get_report_row).to_dataframe()
+        df_report = backend.query(get_report_row)
 
-        if len(df_report) == 1:
+        if report_text is not None and len(df_report) == 1 and pd.notna(df_report["impression_text"].values[0]):
             report_text += "\n\nIMPRESSION: " + df_report["impression_text"].values[0]
 
+    else:
+        print(len(df_report), "reports in reports_master match proc_ord_id", proc_ord_id)
+
+    if report_text is None or pd.isna(report_text):
+        print("Report not found for proc_ord_id", proc_ord_id)
+        return
+
+    report_cache.put(cache_key, report_text)
     print(report_text)
 
 
@@ -298,13 +424,13 @@ def print_disagreement_reports(disagreement_ids, grades1, grades2):
 
     """
     
+    # Index the grades by proc_ord_id once instead of filtering for every report
+    lookup1 = dict(zip(grades1["proc_ord_id"].astype(str)[::-1], grades1["grade"].values[::-1]))
+    lookup2 = dict(zip(grades2["proc_ord_id"].astype(str)[::-1], grades2["grade"].values[::-1]))
+
     for proc_ord_id in disagreement_ids:
-        report_grade1 = grades1[grades1["proc_ord_id"].astype(str) == str(proc_ord_id)][
-            "grade"
-        ].values[0]
-        report_grade2 = grades2[grades2["proc_ord_id"].astype(str) == str(proc_ord_id)][
-            "grade"
-        ].values[0]
+        report_grade1 = lookup1[str(proc_ord_id)]
+        report_grade2 = lookup2[str(proc_ord_id)]
 
         print_report_from_proc_ord_id(proc_ord_id)
         print(
@@ -319,68 +445,133 @@ def print_disagreement_reports(disagreement_ids, grades1, grades2):
         clear_output()
 
 
-def calculate_metric_for_graders(graders, metric, project = "reliability"):
+@labelled
+def get_grade_matrix(graders, proc_ord_ids, project = "reliability"):
     """
-    Calculate Cohen's Kappa between graders
+    Load the grades of all graders with one query and pivot them into a
+    grader x proc_ord_id matrix
 
     Args:
         graders (list): Names of graders to compare grades
-        metric (string): Metric to evaluate. Options: disagreement, kappa, 
-                         kappa2vAll, kappa0VAll
+        proc_ord_ids (list): proc_ord_id(s) for reports to compare
         project (string): Project to evaluate grades for
-    
+
     Return:
-        metric_table (dataframe): Dataframe with specified metric between listed graders
+        grade_matrix (dataframe): One row per grader, one column per proc_ord_id. Grades
+        outside 0-2 and reports a grader has not graded are NaN
     """
-    
+
+    global sql_tables
+    backend = get_backend()
+
+    q_grades = f'''select cast(proc_ord_id as int64) as proc_ord_id, name, grade
+    from {sql_tables["grader_table"]}
+    where name IN @graders
+    and grade_category = @grade_category;'''
+    grade_category = "Reliability" if project == "reliability" else "Unique"
+    df_grades = backend.query(q_grades, {"graders": list(graders), "grade_category": grade_category})
+
+    df_grades["proc_ord_id"] = df_grades["proc_ord_id"].astype(int)
+    df_grades = df_grades[df_grades["proc_ord_id"].isin(np.asarray(proc_ord_ids).astype(int))]
+    df_grades = df_grades[np.logical_and(df_grades.grade >= 0, df_grades.grade <= 2)]
+    df_grades = df_grades.drop_duplicates(["name", "proc_ord_id"])
+
+    grade_matrix = df_grades.pivot(index="name", columns="proc_ord_id", values="grade")
+    return grade_matrix.reindex(list(graders)).astype(float)
+
+
+def pairwise_confusion_matrices(grade_matrix, n_grades = 3):
+    """
+    Count the confusion matrix of every pair of graders at once. Each grader's grades
+    are one-hot encoded, so one matrix product counts every (grade1, grade2)
+    combination over the reports both graders have graded
+
+    Args:
+        grade_matrix (dataframe): grader x proc_ord_id matrix from get_grade_matrix
+        n_grades (int): Number of grade levels (grades 0 to n_grades - 1)
+
+    Return:
+        confusion (array): graders x graders x n_grades x n_grades counts, where
+        confusion[i, j, a, b] is the number of reports grader i graded a and grader j graded b
+    """
+
+    grades = grade_matrix.to_numpy(dtype=float)
+    n_graders, n_reports = grades.shape
+    one_hot = np.zeros((n_graders, n_grades, n_reports))
+    graded = ~np.isnan(grades)
+    rows, cols = np.nonzero(graded)
+    one_hot[rows, grades[rows, cols].astype(int), cols] = 1
+
+    one_hot = one_hot.reshape(n_graders * n_grades, n_reports)
+    confusion = (one_hot @ one_hot.T).reshape(n_graders, n_grades, n_graders, n_grades)
+    return confusion.transpose(0, 2, 1, 3).round().astype(int)
+
+
+@labelled
+def calculate_reliability_tables(graders, project = "reliability"):
+    """
+    Calculate every pairwise reliability metric between graders from one load of their grades
+
+    Args:
+        graders (list): Names of graders to compare grades
+        project (string): Project to evaluate grades for
+
+    Return:
+        metric_tables (dictionary): disagreement, kappa, kappa2vAll and kappa0vAll
+        tables between listed graders
+    """
+
     global sql_tables
     if project == "reliability":
         proc_ord_ids = get_reliability_proc_ord_ids()
     else:
-        client = bigquery.Client()
+        backend = get_backend()
         q_query = f'''
         SELECT DISTINCT proc_ord_id
         FROM {sql_tables["project_table"]}
-        WHERE project = "{project}"'''
-        proc_ord_ids = client.query(q_query).to_dataframe().proc_ord_id.astype(int)
-    metric_table = pd.DataFrame(np.nan, columns=graders[1:], index=graders[:-1])
-
+        WHERE project = @project'''
+        proc_ord_ids = backend.query(q_query, {"project": project}).proc_ord_id.astype(int)
+
+    grade_matrix = get_grade_matrix(graders, proc_ord_ids, project = project)
+    confusion = pairwise_confusion_matrices(grade_matrix)
+
+    metrics = {
+        "disagreement": confusion.sum(axis=(-2, -1)) - np.trace(confusion, axis1=-2, axis2=-1),
+        "kappa": kappa_from_confusion(confusion),
+        "kappa2vAll": kappa_from_confusion(collapse_confusion(confusion, [0, 0, 1])),
+        "kappa0vAll": kappa_from_confusion(collapse_confusion(confusion, [0, 1, 1])),
+    }
+
+    # Only the upper triangle is filled, as in the one-pair-at-a-time tables
+    upper = np.triu(np.ones((len(graders), len(graders)), dtype=bool), k=1)[:-1, 1:]
+    metric_tables = {}
+    for metric, values in metrics.items():
+        values = np.where(upper, values[:-1, 1:], np.nan)
+        metric_tables[metric] = pd.DataFrame(values, columns=graders[1:], index=graders[:-1])
+
+    n_common = confusion.sum(axis=(-2, -1))
     for idx1 in range(len(graders) - 1):
-        # Get the grades for grader 1
-        grades1 = get_reports_for_user(graders[idx1], proc_ord_ids, project = project)
-        grades1 = grades1.sort_values("proc_ord_id", ignore_index=True)
-        grades1 = grades1.loc[np.logical_and(grades1.grade >= 0, grades1.grade <= 2),:]
-
         for idx2 in range(idx1 + 1, len(graders)):
-            # Get the grades for grader 2
-            grades2 = get_reports_for_user(graders[idx2], proc_ord_ids, project = project)
-            grades2 = grades2.sort_values("proc_ord_id", ignore_index=True)
-            grades2 = grades2.loc[np.logical_and(grades2.grade >= 0, grades2.grade <= 2),:]
-            
-            # Select only intersecting proc_ord_ids
-            intersect_ids = set(grades1.proc_ord_id).intersection(set(grades2.proc_ord_id))
-            print(f"{len(intersect_ids)} common grades between {graders[idx1]} and {graders[idx2]}")
-            grades1_subset = grades1.loc[grades1.proc_ord_id.isin(intersect_ids),:]
-            grades2_subset = grades2.loc[grades2.proc_ord_id.isin(intersect_ids),:]
-            
-            if not ~grades1_subset.proc_ord_id.equals(grades2_subset.proc_ord_id):
-                print("Warning: proc_ord_ids from graders are not identical")
-            
-            if metric == "disagreement":
-                tmp = identify_disagreement_reports(grades1_subset, grades2_subset)
-                metric_table.loc[graders[idx1], graders[idx2]] = len(tmp)
-
-            elif metric == "kappa":
-                k = calc_kappa(grades1_subset, grades2_subset)
-                metric_table.loc[graders[idx1], graders[idx2]] = k
-                
-
-            elif metric == "kappa2vAll":
-                k = calc_kappa_2_v_all(grades1_subset, grades2_subset)
-                metric_table.loc[graders[idx1], graders[idx2]] = k
-            elif metric == "kappa0vAll":
-                k = calc_kappa_0_v_all(grades1_subset, grades2_subset)
-                metric_table.loc[graders[idx1], graders[idx2]] = k
-            
-
-    return metric_table
+            print(f"{n_common[idx1, idx2]} common grades between {graders[idx1]} and {graders[idx2]}")
+
+    return metric_tables
+
+
+def calculate_metric_for_graders(graders, metric, project = "reliability"):
+    """
+    Calculate Cohen's Kappa between graders
+
+    Args:
+        graders (list): Names of graders to compare grades
+        metric (string): Metric to evaluate. Options: disagreement, kappa, 
+                         kappa2vAll, kappa0vAll
+        project (string): Project to evaluate grades for
+    
+    Return:
+        metric_table (dataframe): Dataframe with specified metric between listed graders
+    """
+
+    metric_tables = calculate_reliability_tables(graders, project = project)
+    if metric not in metric_tables:
+        raise ValueError(f"Unknown metric {metric}. Options: {', '.join(metric_tables)}")
+    return metric_tables[metric]
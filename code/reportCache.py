@@ -0,0 +1,287 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+import pandas as pd
+from storageBackends import get_backend
+from reportSnapshot import get_report_snapshot
+from reportFormatting import format_report_series
+
+with open(f"{os.path.dirname(__file__)}/sql_tables.json", 'r', encoding='utf-8') as f:
+    sql_tables = json.load(f)
+
+default_cache_path = "~/.cache/radiology_report_grading/report_text.sqlite"
+
+# Keeps each IN (...) list below SQLite's limit on bound variables
+chunk_size = 500
+
+
+def _chunks(values):
+    for idx in range(0, len(values), chunk_size):
+        yield values[idx:idx + chunk_size]
+
+
+class ReportCache:
+    """
+    Report text cache keyed by proc_ord_id. Recently used reports are kept in memory
+    and every report is also stored in a SQLite file in the user's home directory, so
+    a report is downloaded at most once per machine. Both levels evict the least
+    recently used reports when they are full. The file is shared by every kernel of
+    the user, so its size is read from the file rather than counted per process.
+    """
+
+    def __init__(self, path=default_cache_path, max_memory_reports=2000, max_disk_bytes=500 * 1024 ** 2):
+        """
+        Args:
+            path (string): Cache file (None keeps the cache in memory only)
+            max_memory_reports (int): Number of reports kept in memory
+            max_disk_bytes (int): Size limit of the cache file
+        """
+        self.max_memory_reports = max_memory_reports
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        self.conn = None
+        if path is not None:
+            path = os.path.expanduser(path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode = WAL")
+            self.conn.execute("PRAGMA busy_timeout = 30000")
+            self.conn.execute('''create table if not exists reports (
+                proc_ord_id TEXT PRIMARY KEY, report_text TEXT, size INTEGER, last_access REAL)''')
+            self.conn.execute("create index if not exists idx_reports_last_access on reports (last_access)")
+        self.path = path
+
+    def _disk_bytes(self):
+        # Bytes of the pages in use, as written by every process sharing the file
+        page_size = self.conn.execute("PRAGMA page_size").fetchone()[0]
+        page_count = self.conn.execute("PRAGMA page_count").fetchone()[0]
+        free_pages = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return (page_count - free_pages) * page_size
+
+    def _remember(self, proc_ord_id, report_text):
+        self.memory[proc_ord_id] = report_text
+        self.memory.move_to_end(proc_ord_id)
+        while len(self.memory) > self.max_memory_reports:
+            self.memory.popitem(last=False)
+
+    def get_many(self, proc_ord_ids):
+        """
+        Look up reports in the cache
+
+        Args:
+            proc_ord_ids (list): proc_ord_ids to look up
+
+        Return:
+            found (dictionary): proc_ord_id -> report_text for the cached reports
+        """
+        found = {}
+        with self._lock:
+            to_read = []
+            for proc_ord_id in proc_ord_ids:
+                proc_ord_id = str(proc_ord_id)
+                if proc_ord_id in self.memory:
+                    self.memory.move_to_end(proc_ord_id)
+                    found[proc_ord_id] = self.memory[proc_ord_id]
+                    self.memory_hits += 1
+                else:
+                    to_read.append(proc_ord_id)
+
+            if self.conn is not None and len(to_read) > 0:
+                rows = []
+                for chunk in _chunks(to_read):
+                    rows += self.conn.execute(
+                        f"select proc_ord_id, report_text from reports where proc_ord_id in ({', '.join('?' for _ in chunk)})",
+                        chunk,
+                    ).fetchall()
+                now = time.time()
+                self.conn.execute("begin")
+                self.conn.executemany(
+                    "update reports set last_access = ? where proc_ord_id = ?", [(now, row[0]) for row in rows]
+                )
+                self.conn.execute("commit")
+                for proc_ord_id, report_text in rows:
+                    found[proc_ord_id] = report_text
+                    self._remember(proc_ord_id, report_text)
+                self.disk_hits += len(rows)
+
+            self.misses += len([i for i in to_read if i not in found])
+        return found
+
+    def get(self, proc_ord_id):
+        """
+        Look up one report in the cache
+
+        Return:
+            (string): report text, or None if the report is not cached
+        """
+        return self.get_many([proc_ord_id]).get(str(proc_ord_id))
+
+    def put_many(self, reports):
+        """
+        Add reports to the cache
+
+        Args:
+            reports (dictionary): proc_ord_id -> report_text
+        """
+        with self._lock:
+            for proc_ord_id, report_text in reports.items():
+                self._remember(str(proc_ord_id), report_text)
+            if self.conn is None or len(reports) == 0:
+                return
+
+            now = time.time()
+            rows = [(str(i), t, len(t.encode("utf-8")), now) for i, t in reports.items()]
+            self.conn.execute("begin")
+            self.conn.executemany("insert or replace into reports values (?, ?, ?, ?)", rows)
+            self.conn.execute("commit")
+            disk_bytes = self._disk_bytes()
+            if disk_bytes > self.max_disk_bytes:
+                self._evict(disk_bytes)
+
+    def put(self, proc_ord_id, report_text):
+        """
+        Add one report to the cache
+        """
+        self.put_many({proc_ord_id: report_text})
+
+    def _evict(self, disk_bytes):
+        # Drop the least recently used reports until the cache is at 90% of its limit.
+        # A report takes at least its text size in pages, so this frees enough
+        to_free = disk_bytes - 0.9 * self.max_disk_bytes
+        rows = self.conn.execute("select proc_ord_id, size from reports order by last_access").fetchall()
+        to_delete = []
+        for proc_ord_id, size in rows:
+            if to_free <= 0:
+                break
+            to_delete.append((proc_ord_id,))
+            to_free -= size
+        self.conn.executemany("delete from reports where proc_ord_id = ?", to_delete)
+
+    def stats(self):
+        """
+        Return:
+            (dictionary): hit and miss counters and the size of each cache level
+        """
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups > 0 else 0.0,
+            "memory_reports": len(self.memory),
+            "disk_bytes": self._disk_bytes() if self.conn is not None else 0,
+        }
+
+    def clear(self):
+        """
+        Remove every report from the cache
+        """
+        with self._lock:
+            self.memory.clear()
+            if self.conn is not None:
+                self.conn.execute("delete from reports")
+
+
+_report_cache = None
+
+
+def get_report_cache():
+    """
+    Get the report cache shared by the grading functions of this session
+    """
+    global _report_cache
+    if _report_cache is None:
+        _report_cache = ReportCache()
+    return _report_cache
+
+
+def set_report_cache(cache):
+    """
+    Replace the shared report cache, e.g. with ReportCache(path=None) for a memory-only cache
+    """
+    global _report_cache
+    _report_cache = cache
+
+
+def download_report_texts(proc_ord_ids=None, backend=None):
+    """
+    Download the report text (narrative plus impression) of reports
+
+    Args:
+        proc_ord_ids (list): proc_ord_ids of the reports (None downloads every report)
+        backend (StorageBackend): backend to read from (default: the active backend)
+
+    Return:
+        (dictionary): proc_ord_id -> report_text for every report found
+    """
+    global sql_tables
+    if backend is None:
+        backend = get_backend()
+    # Get the narrative and impression for all reports
+    q_get_report_rows = f'''
+        SELECT
+          COALESCE(narr.proc_ord_id, impr.proc_ord_id) as proc_ord_id,
+          narr.narrative_text,
+          impr.impression_text
+        FROM {sql_tables["source_table"]} narr
+        FULL OUTER JOIN {sql_tables["impression_table"]} impr
+          ON (narr.proc_ord_id = impr.proc_ord_id)'''
+    params = None
+    if proc_ord_ids is not None:
+        q_get_report_rows += '''
+        WHERE narr.proc_ord_id IN @proc_ord_ids
+        OR impr.proc_ord_id IN @proc_ord_ids'''
+        params = {"proc_ord_ids": list(proc_ord_ids)}
+    report_df = backend.query(q_get_report_rows, params)
+    if len(report_df) == 0:
+        return {}
+    report_df.loc[~report_df.impression_text.isna(),"impression_text"] = "\n\nIMPRESSION: " + report_df.impression_text
+    report_df.loc[report_df.impression_text.isna(),"impression_text"] = ""
+    report_df["report_text"] = report_df.narrative_text.fillna("") + report_df.impression_text.astype(str)
+    return dict(zip(report_df.proc_ord_id.astype(str), report_df.report_text))
+
+
+def load_report_texts(proc_ord_ids, backend=None, cache=None, snapshot=None):
+    """
+    Get the report text (narrative plus impression) for a list of reports, formatted
+    for display, reading from the local report snapshot and the report cache first and
+    downloading only the reports neither of them holds. The snapshot stores the text
+    already formatted; cached and downloaded reports are formatted here
+
+    Args:
+        proc_ord_ids (list): proc_ord_ids of the reports
+        backend (StorageBackend): backend to read from (default: the active backend)
+        cache (ReportCache): cache to use (default: the shared report cache)
+        snapshot (ReportSnapshot): snapshot to use (default: the shared snapshot, if one was synced)
+
+    Return:
+        report_df (dataframe): proc_ord_id and formatted report_text for every report found
+    """
+    if cache is None:
+        cache = get_report_cache()
+    if snapshot is None:
+        snapshot = get_report_snapshot()
+    proc_ord_ids = list(dict.fromkeys(str(i) for i in proc_ord_ids))
+    found = snapshot.get_many(proc_ord_ids) if snapshot is not None else {}
+    preformatted = set(found) if snapshot is not None and snapshot.formatted else set()
+    found.update(cache.get_many([i for i in proc_ord_ids if i not in found]))
+
+    to_download = [i for i in proc_ord_ids if i not in found]
+    if len(to_download) > 0:
+        downloaded = download_report_texts(to_download, backend)
+        cache.put_many(downloaded)
+        found.update(downloaded)
+
+    ids = [i for i in proc_ord_ids if i in found]
+    report_df = pd.DataFrame({"proc_ord_id": ids, "report_text": [found[i] for i in ids]})
+    to_format = ~report_df["proc_ord_id"].isin(preformatted)
+    report_df.loc[to_format, "report_text"] = format_report_series(report_df.loc[to_format, "report_text"])
+    return report_df
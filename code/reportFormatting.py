@@ -0,0 +1,61 @@
+import re
+from functools import lru_cache
+
+# Section headers that start on a new paragraph when a report is displayed
+section_headers = [
+    "CLINICAL INDICATION",
+    "TECHNIQUE",
+    "HISTORY",
+    "IMPRESSION",
+    "FINDINGS",
+    "COMPARISON",
+]
+
+
+@lru_cache(maxsize=8)
+def _section_pattern(headers):
+    # Leading/trailing whitespace is dropped, inner whitespace collapsed and
+    # headers (longest first) moved onto a new paragraph, all in the same pass
+    headers_str = "|".join(re.escape(h) for h in sorted(headers, key=len)[::-1])
+    return re.compile(r"(^\s+|\s+$)|(\s+)|(" + headers_str + ")")
+
+
+def _replace(m):
+    if m.group(1) is not None:
+        return ""
+    if m.group(2) is not None:
+        return " "
+    return "\n\n" + m.group(3)
+
+
+def format_report_text(report_text, headers=None):
+    """
+    Normalize the whitespace of a report and start each section header on a new paragraph
+
+    Args:
+        report_text (string): Text of a radiology report
+        headers (list): Section headers (default: section_headers)
+
+    Return:
+        (string): formatted report text
+    """
+    if headers is None:
+        headers = section_headers
+    return _section_pattern(tuple(headers)).sub(_replace, report_text)
+
+
+def format_report_series(reports, headers=None):
+    """
+    Format a whole column of reports at once, e.g. when a batch is fetched, so the
+    reports are ready to display. Missing reports stay missing.
+
+    Args:
+        reports (series): Texts of radiology reports
+        headers (list): Section headers (default: section_headers)
+
+    Return:
+        (series): formatted report texts
+    """
+    if headers is None:
+        headers = section_headers
+    return reports.str.replace(_section_pattern(tuple(headers)), _replace, regex=True)
@@ -0,0 +1,320 @@
+import os
+import re
+import json
+import sqlite3
+import hashlib
+import argparse
+import threading
+import pandas as pd
+from highlighter import get_highlighter
+from reportFormatting import format_report_text
+
+default_index_path = "~/.cache/radiology_report_grading/report_index.sqlite"
+default_phrases_path = f"{os.path.dirname(__file__)}/phrases_to_highlight.json"
+
+# Reports written per transaction while indexing
+index_batch_size = 5000
+
+
+def _phrase_set_key(to_highlight):
+    # Identifies the phrase dictionary the stored highlight spans were computed for
+    return hashlib.sha1(json.dumps(to_highlight, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _phrase_pattern(phrase):
+    # The words of a phrase in order, ignoring case and the whitespace between them
+    return re.compile(r"\s+".join(re.escape(word) for word in phrase.split()), re.IGNORECASE)
+
+
+def _fts_phrase(phrase):
+    return '"' + phrase.replace('"', '""') + '"'
+
+
+class ReportIndex:
+    """
+    Full-text index of the report text in a local SQLite file (FTS5, which keeps
+    the position of every token, so phrases are looked up without scanning the
+    reports). The reports are indexed as displayed (after format_report_text), so
+    the offsets returned by search and the stored highlight spans can be used on
+    the text printed to graders. Reports can be added or replaced at any time.
+    """
+
+    def __init__(self, path=default_index_path, to_highlight=None):
+        """
+        Args:
+            path (string): Index file (":memory:" for a temporary index)
+            to_highlight (dictionary): phrases to precompute highlight spans for
+                                       (default: phrases_to_highlight.json)
+        """
+        if to_highlight is None:
+            with open(default_phrases_path, "r", encoding="utf-8") as f:
+                to_highlight = json.load(f)
+        self.to_highlight = to_highlight
+        self.phrase_set = _phrase_set_key(to_highlight)
+        self._lock = threading.Lock()
+
+        if path != ":memory:":
+            path = os.path.expanduser(path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA busy_timeout = 30000")
+        self.conn.executescript('''
+        create table if not exists reports (rowid INTEGER PRIMARY KEY, proc_ord_id TEXT UNIQUE, report_text TEXT);
+        create virtual table if not exists reports_fts using fts5(report_text, content='reports', content_rowid='rowid');
+        create trigger if not exists reports_ai after insert on reports begin
+          insert into reports_fts (rowid, report_text) values (new.rowid, new.report_text);
+        end;
+        create trigger if not exists reports_ad after delete on reports begin
+          insert into reports_fts (reports_fts, rowid, report_text) values ('delete', old.rowid, old.report_text);
+        end;
+        create table if not exists spans (proc_ord_id TEXT, start INTEGER, end INTEGER, phrase TEXT);
+        create index if not exists idx_spans_proc_ord_id on spans (proc_ord_id);
+        create table if not exists meta (key TEXT PRIMARY KEY, value TEXT);
+        ''')
+
+        # Spans computed for another phrase dictionary are recomputed
+        stored = self.conn.execute("select value from meta where key = 'phrase_set'").fetchone()
+        if stored is None or stored[0] != self.phrase_set:
+            self._recompute_spans()
+
+    def __len__(self):
+        return self.conn.execute("select count(*) from reports").fetchone()[0]
+
+    def _span_rows(self, reports):
+        highlighter = get_highlighter(self.to_highlight)
+        return [
+            (proc_ord_id, start, end, phrase)
+            for proc_ord_id, text in reports
+            for start, end, phrase in highlighter.spans(text)
+        ]
+
+    def _recompute_spans(self):
+        with self._lock:
+            self.conn.execute("begin")
+            self.conn.execute("delete from spans")
+            cursor = self.conn.execute("select proc_ord_id, report_text from reports")
+            while True:
+                rows = cursor.fetchmany(index_batch_size)
+                if len(rows) == 0:
+                    break
+                self.conn.executemany("insert into spans values (?, ?, ?, ?)", self._span_rows(rows))
+            self.conn.execute("insert or replace into meta values ('phrase_set', ?)", (self.phrase_set,))
+            self.conn.execute("commit")
+
+    def add_reports(self, reports, formatted=False):
+        """
+        Add reports to the index, replacing reports that are already indexed
+
+        Args:
+            reports (dictionary): proc_ord_id -> report_text
+            formatted (boolean): True if the texts already went through format_report_text
+        """
+        rows = [
+            (str(proc_ord_id), text if formatted else format_report_text(text))
+            for proc_ord_id, text in reports.items()
+        ]
+        with self._lock:
+            for idx in range(0, len(rows), index_batch_size):
+                chunk = rows[idx:idx + index_batch_size]
+                ids = [(row[0],) for row in chunk]
+                self.conn.execute("begin")
+                self.conn.executemany("delete from reports where proc_ord_id = ?", ids)
+                self.conn.executemany("delete from spans where proc_ord_id = ?", ids)
+                self.conn.executemany("insert into reports (proc_ord_id, report_text) values (?, ?)", chunk)
+                self.conn.executemany("insert into spans values (?, ?, ?, ?)", self._span_rows(chunk))
+                self.conn.execute("commit")
+
+    def indexed_ids(self):
+        """
+        Return:
+            (set): proc_ord_id of every indexed report
+        """
+        return {row[0] for row in self.conn.execute("select proc_ord_id from reports")}
+
+    def search(self, phrase, limit=None):
+        """
+        Find every report containing a phrase
+
+        Args:
+            phrase (string): words to find in this order (case and whitespace are ignored)
+            limit (int): Maximum number of reports to return (None returns all of them)
+
+        Return:
+            matches (dataframe): proc_ord_id, start and end of each match in the
+            displayed report text, and the matched text
+        """
+        q = '''
+        select reports.proc_ord_id, reports.report_text
+        from reports_fts join reports on (reports.rowid = reports_fts.rowid)
+        where reports_fts match ?'''
+        if limit is not None:
+            q += f" limit {int(limit)}"
+        pattern = _phrase_pattern(phrase)
+        rows = []
+        # The index also matches the words across punctuation, the offsets keep exact matches only
+        for proc_ord_id, text in self.conn.execute(q, (_fts_phrase(phrase),)):
+            rows += [(proc_ord_id, m.start(), m.end(), m.group(0)) for m in pattern.finditer(text)]
+        return pd.DataFrame(rows, columns=["proc_ord_id", "start", "end", "match"])
+
+    def search_phrases(self, to_highlight=None):
+        """
+        Find the reports containing each phrase of a phrase dictionary, e.g. to audit how
+        reports with a guideline phrase were graded
+
+        Args:
+            to_highlight (dictionary): color -> phrases (default: the phrases of the index)
+
+        Return:
+            matches (dataframe): phrase, proc_ord_id, start, end and match of every match
+        """
+        if to_highlight is None:
+            to_highlight = self.to_highlight
+        phrases = []
+        for to_mark in to_highlight.values():
+            phrases += [to_mark] if type(to_mark) == str else [str(p) for p in to_mark]
+        results = [self.search(phrase).assign(phrase=phrase) for phrase in dict.fromkeys(phrases) if phrase.strip() != ""]
+        if len(results) == 0:
+            return pd.DataFrame(columns=["phrase", "proc_ord_id", "start", "end", "match"])
+        return pd.concat(results, ignore_index=True)[["phrase", "proc_ord_id", "start", "end", "match"]]
+
+    def get_spans(self, reports, to_highlight):
+        """
+        Get the precomputed highlight spans of reports, for Highlighter.highlight(text, spans)
+
+        Args:
+            reports (dictionary): proc_ord_id -> displayed report text
+            to_highlight (dictionary): the phrases that will be highlighted
+
+        Return:
+            spans (dictionary): proc_ord_id -> list of (start, end, phrase), only for reports
+            indexed with the same text and phrases (others are highlighted the usual way)
+        """
+        if _phrase_set_key(to_highlight) != self.phrase_set or len(reports) == 0:
+            return {}
+        ids = [str(i) for i in reports]
+        placeholders = ", ".join("?" for _ in ids)
+        with self._lock:
+            texts = dict(self.conn.execute(
+                f"select proc_ord_id, report_text from reports where proc_ord_id in ({placeholders})", ids
+            ).fetchall())
+            span_rows = self.conn.execute(
+                f"select proc_ord_id, start, end, phrase from spans where proc_ord_id in ({placeholders}) order by start",
+                ids,
+            ).fetchall()
+        spans = {i: [] for i in ids if texts.get(i) is not None and texts[i] == reports[i]}
+        for proc_ord_id, start, end, phrase in span_rows:
+            if proc_ord_id in spans:
+                spans[proc_ord_id].append((start, end, phrase))
+        return spans
+
+    def optimize(self):
+        """
+        Merge the index segments written by many small updates
+        """
+        with self._lock:
+            self.conn.execute("insert into reports_fts (reports_fts) values ('optimize')")
+
+
+_report_index = None
+
+
+def get_report_index(path=default_index_path):
+    """
+    Get the report index shared by the grading functions of this session
+
+    Return:
+        (ReportIndex): the index, or None if no index was built at path
+    """
+    global _report_index
+    if _report_index is None:
+        if not os.path.exists(os.path.expanduser(path)):
+            return None
+        _report_index = ReportIndex(path)
+    return _report_index
+
+
+def set_report_index(index):
+    """
+    Replace the shared report index (None looks for a built index again)
+    """
+    global _report_index
+    _report_index = index
+
+
+def get_report_spans(report_df, to_highlight):
+    """
+    Precomputed highlight spans for a batch of reports, from the shared index if one was built
+
+    Args:
+        report_df (dataframe): proc_ord_id and displayed report_text of each report
+        to_highlight (dictionary): the phrases that will be highlighted
+
+    Return:
+        spans (dictionary): proc_ord_id -> list of (start, end, phrase)
+    """
+    index = get_report_index()
+    if index is None or len(to_highlight) == 0:
+        return {}
+    return index.get_spans(dict(zip(report_df.proc_ord_id.astype(str), report_df.report_text)), to_highlight)
+
+
+def sync_report_index(index=None, backend=None, chunk_size=index_batch_size):
+    """
+    Index the reports that are not in the index yet. Reports come from the local
+    report snapshot when one was synced, otherwise they are downloaded
+
+    Args:
+        index (ReportIndex): index to update (default: the index at default_index_path)
+        backend (StorageBackend): backend to read from (default: the active backend)
+        chunk_size (int): Number of reports loaded at a time
+
+    Return:
+        (int): number of reports added
+    """
+    # Imported here so the index can be used without a database connection
+    from reportCache import load_report_texts, ReportCache
+    from reportSnapshot import get_report_snapshot
+    from storageBackends import get_backend
+
+    if index is None:
+        index = ReportIndex()
+    snapshot = get_report_snapshot()
+    if snapshot is not None:
+        ids = snapshot.ids()
+    else:
+        if backend is None:
+            backend = get_backend()
+        with open(f"{os.path.dirname(__file__)}/sql_tables.json", 'r', encoding='utf-8') as f:
+            sql_tables = json.load(f)
+        ids = set()
+        for table in (sql_tables["source_table"], sql_tables["impression_table"]):
+            ids |= set(backend.query(f"SELECT DISTINCT proc_ord_id FROM {table}")["proc_ord_id"].astype(str))
+
+    new_ids = sorted(ids - index.indexed_ids())
+    # A memory-only cache, so indexing does not evict the reports cached for grading
+    cache = ReportCache(path=None, max_memory_reports=0)
+    for idx in range(0, len(new_ids), chunk_size):
+        report_df = load_report_texts(new_ids[idx:idx + chunk_size], backend, cache, snapshot)
+        index.add_reports(dict(zip(report_df.proc_ord_id, report_df.report_text)), formatted=True)
+    if len(new_ids) > 0:
+        index.optimize()
+    set_report_index(None)
+    return len(new_ids)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Full-text index of the reports")
+    parser.add_argument("command", choices=["sync", "search"])
+    parser.add_argument("phrase", nargs="?", default=None, help="search: phrase to find")
+    parser.add_argument("--path", default=default_index_path)
+    parser.add_argument("--limit", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.command == "sync":
+        print(sync_report_index(ReportIndex(args.path)), "reports added to the index")
+    else:
+        matches = ReportIndex(args.path).search(args.phrase, args.limit)
+        print(matches.to_string(index=False))
+        print(matches.proc_ord_id.nunique(), "reports found")
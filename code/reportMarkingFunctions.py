@@ -6,56 +6,70 @@ import json
 from annotationHelperLib import *
 from dxFilterLibraryPreGrading import *
 from IPython.display import clear_output
-from google.cloud import bigquery  # SQL table interface
+from storageBackends import *  # SQL table interface (BigQuery or local)
+from queryLog import labelled, timed, enable_cell_summaries
+from gradeBuffer import GradeBuffer
+from gradingSession import GradingSession
+from highlighter import get_highlighter
+from reportFormatting import format_report_text
+from reportCache import load_report_texts
+from progressSummary import *
+from queueAssignment import assign_reports, queue_reports
+from bulkInsert import bulk_insert
+from graderBackups import backup_table, compact_backups, list_backups, compact_after_segments, backup_root
 from datetime import date
 from projectTableFunctions import *
 
 num_validation_graders = 2
 
+# List of the reliability reports shared by all graders
+reliability_info_path = "~/arcus/shared/reliability_report_info.csv"
+_reliability_info_cache = {}
+# Grade criteria of the reliability rows in the grader table
+reliability_criteria = "SLIP"
+
 with open(f"{os.path.dirname(__file__)}/sql_tables.json", 'r', encoding='utf-8') as f:
     sql_tables = json.load(f)
 
+# Print the time spent on database calls after each notebook cell
+enable_cell_summaries()
+
 
-def backup_grader_table():
+def backup_grader_table(full=False, root=backup_root, server_copy=False):
     """
-    Back up grader table.
+    Back up grader table. Only the rows changed since the last backup are saved, as
+    a compressed segment under ~/.backups/ (see graderBackups.restore_backup for restores)
+
+    Args:
+        full (boolean): Check every row of the table for changes
+        root (string): Directory holding the backups
+        server_copy (boolean): Also recreate the full bak_ copy of the table on the
+                               server (copies the whole table, so off by default)
     """
     
     global sql_tables
-    client = bigquery.Client()
-    
-    # Step 1: save the grader_table_with_metadata to a .csv
-    tmp_dir = os.path.expanduser("~.backups/")
-    if not os.path.exists(tmp_dir):
-        os.makedirs(tmp_dir)
-    tmp_fn = f'{sql_tables["grader_table"].replace(".", "_")}_{np.datetime64("today")}.csv'
-    tmp_csv = os.path.join(tmp_dir, tmp_fn)
-    get_table_query = "select * from " + sql_tables["grader_table"]
-    grader_table = client.query(get_table_query).to_dataframe()
-    grader_table.to_csv(tmp_csv, index=False)
-
-    # Step 2: drop table bak_grader_table_with_metadata
-    grader_table_name_bak = "bak_" + sql_tables["grader_table"]
-    q_drop_table = "drop table "+grader_table_name_bak
-    try:
-        job = client.query(q_drop_table)
-        job.result()
-    except: 
-        pass
-
-    # Step 3: create table bak_grader_table_with_metadata
-    q_create_backup_table = "create table "+grader_table_name_bak+" as select * from " + sql_tables["grader_table"]
-    job = client.query(q_create_backup_table)
-    job.result()
-    print(sql_tables["grader_table"], " backup successful")
+    backend = get_backend()
+    stats = backup_table(sql_tables["grader_table"], backend, root, full=full)
+    if len(list_backups(sql_tables["grader_table"], root)) > compact_after_segments:
+        compact_backups(sql_tables["grader_table"], root)
+
+    if server_copy:
+        grader_table_name_bak = "bak_" + sql_tables["grader_table"]
+        backend.execute("drop table if exists " + grader_table_name_bak)
+        backend.execute("create table " + grader_table_name_bak + " as select * from " + sql_tables["grader_table"])
+    print(
+        sql_tables["grader_table"], " backup successful:", stats["rows_written"], "of",
+        stats["rows_downloaded"], "rows checked had changed"
+    )
 
 
+@labelled
 def regrade_skipped_reports(client, project_name="", grader="", flag=-1):
     """
     Regrade skipped reports
 
     Args:
-        client (string): A bigquery client object
+        client (string): A bigquery client object or storage backend (None for the active backend)
         project_name (string): Name of a project to evaluate
         grader (string): Name of user/grader (leave blank to review all flagged reports)
         flag (int): The level of "skip" to examine (-1 is group, -2 is clinician)
@@ -65,6 +79,7 @@ def regrade_skipped_reports(client, project_name="", grader="", flag=-1):
     # Handle different projects: 
     # If the project is not specified, assume we're looking only at SLIP grading
     global sql_tables
+    backend = as_backend(client)
     # Get the flagged reports
     # Start the query
     q = "select distinct * from " + sql_tables["grader_table"]
@@ -82,7 +97,7 @@ def regrade_skipped_reports(client, project_name="", grader="", flag=-1):
         q += " and name = '" + grader + "'"
 
     q += ";"
-    flagged_reports = client.query(q).to_dataframe() #LOH
+    flagged_reports = backend.query(q) #LOH
 
     if flagged_reports.shape[0] == 0:
         print("There are currently no reports with the grade of", flag)
@@ -91,29 +106,13 @@ def regrade_skipped_reports(client, project_name="", grader="", flag=-1):
     # Shuffle the flagged reports
     flagged_reports = flagged_reports.sample(frac=1)
 
-    # Get the narrative and impression for all reports
+    # Get the narrative and impression for all reports (downloading only uncached reports)
     proc_ord_ids = flagged_reports.proc_ord_id.astype(str).unique()
-    proc_ord_id_str = '","'.join(proc_ord_ids)
-    
-    # Get the narrative and impression for all reports
-    q_get_report_rows = f'''
-        SELECT 
-          COALESCE(narr.proc_ord_id, impr.proc_ord_id) as proc_ord_id,
-          narr.narrative_text,
-          impr.impression_text
-        FROM narrative narr
-        FULL OUTER JOIN impression impr
-          ON (narr.proc_ord_id = impr.proc_ord_id)
-        WHERE narr.proc_ord_id IN ("{proc_ord_id_str}")
-        OR impr.proc_ord_id IN ("{proc_ord_id_str}");'''
-    report_df = client.query(q_get_report_rows).to_dataframe()
-    if df.proc_ord_id[~df.proc_ord_id.isin(report_df.proc_ord_id)].shape[0] == 0:
-        report_df.loc[~report_df.impression_text.isna(),"impression_text"] = "\n\nIMPRESSION: " + report_df.impression_text
-        report_df.loc[report_df.impression_text.isna(),"impression_text"] = ""
-        report_df["report_text"] = report_df.narrative_text + report_df.impression_text.astype(str)
-    else:
-        # Don't exit the function if proc_ord_ids are missing. Flag them for technical review
-        missing_proc_ord_ids = df.proc_ord_id[~df.proc_ord_id.isin(report_df.proc_ord_id)]
+    report_df = load_report_texts(proc_ord_ids, backend)
+    found_proc_ord_ids = set(report_df.proc_ord_id)
+    missing_proc_ord_ids = [i for i in proc_ord_ids if i not in found_proc_ord_ids]
+    if len(missing_proc_ord_ids) > 0:
+        # Flag the missing proc_ord_ids for technical review
         missing_proc_str = '","'.join(missing_proc_ord_ids)
         print(f"Missing proc_ord_ids: {missing_proc_str}")
         return
@@ -132,7 +131,7 @@ def regrade_skipped_reports(client, project_name="", grader="", flag=-1):
             + str(row["proc_ord_id"])
         )
         check_skipped_query += "' and name = '" + row["name"] + "';"
-        skipped_df = client.query(check_skipped_query).to_dataframe()
+        skipped_df = backend.query(check_skipped_query)
 
         print("Grader:", row["name"])
         print("Grading criteria:", row["grade_criteria"])
@@ -156,7 +155,7 @@ def regrade_skipped_reports(client, project_name="", grader="", flag=-1):
         with open("code/phrases_to_highlight.json", "r") as f:
             to_highlight = json.load(f)
             
-        print_report(report_df.report_text[report_df.proc_ord_id == proc_ord_id].values[0], to_highlight)  # -- LOH
+        print_report(report_df.report_text[report_df.proc_ord_id == proc_ord_id].values[0], to_highlight, preformatted=True)  # -- LOH
 
         print()
         # ask for grade
@@ -169,11 +168,13 @@ def regrade_skipped_reports(client, project_name="", grader="", flag=-1):
             q_update = "UPDATE "+ sql_tables["grader_table"] +" set grade = " + str(
                 grade
             )
+            q_update += ', grade_date = "' + date.today().strftime("%Y-%m-%d") + '"'
             q_update += ' WHERE proc_ord_id = "' + str(proc_ord_id) + '"'
             q_update += ' and name = "' + row["name"] + '"'
 
-            j_update = client.query(q_update)
-            j_update.result()
+            changes = grade_changes([(proc_ord_id, row["name"])], int(grade), backend)
+            backend.execute(q_update)
+            record_grade_changes(changes, backend)
 
             if is_skip_logged:
                 # Update the skipped reports table
@@ -186,8 +187,7 @@ def regrade_skipped_reports(client, project_name="", grader="", flag=-1):
                 )
                 q_update_skipped += 'name = "' + row["name"] + '";'
 
-                j_update_skipped = client.query(q_update)
-                j_update_skipped.result()
+                backend.execute(q_update)
             else:
                 # Add the report to the skipped reports table.
                 # ('proc_ord_id', 'grade', 'name', 'skip_date', 'skip_reason', 'regrade_date', 'regrade_reason')
@@ -226,34 +226,15 @@ def mark_text_color(line, to_mark, color):
         specified color with bold black text
 
     """
-    # Sort the list of strings to highlight by length (longest to shortest)
-    to_mark = sorted(to_mark, key=len)[::-1]
-
-    if color == "green":
-        start = "\x1b[5;30;42m"  # green background, bold black text
-    elif color == "yellow":
-        start = "\x1b[5;30;43m"  # yellow background, bold black text
-    elif color == "red":
-        start = "\x1b[5;30;41m"  # red background, bold black text
-    elif color == "gray" or color == "grey":
-        start = "\x1b[5;30;47m"  # gray background, bold black text
-
-    end = "\x1b[0m"
-
     if line is np.nan:
         return "<No report available.>"
 
-    if type(to_mark) == str:
-        line = line.replace(to_mark, start + to_mark + end)
-
-    elif type(to_mark) == list:
-        for phrase in to_mark:
-            line = line.replace(str(phrase), start + str(phrase).upper() + end)
-
-    else:
+    if type(to_mark) not in (str, list):
         print("Error: the second argument must be either a string or a list of strings")
+        return line
 
-    return line
+    # The compiled highlighter matches the longest phrase first in a single pass
+    return get_highlighter({color: to_mark}).highlight(line)
 
 
 def print_report_from_proc(proc_ord_id, client, to_highlight={}, source_table="narrative"):
@@ -262,67 +243,23 @@ def print_report_from_proc(proc_ord_id, client, to_highlight={}, source_table="n
 
     Args:
         proc_ord_id (int): proc_ord_id associated with a radiology report
-       client (string): A bigquery client object
+       client (string): A bigquery client object or storage backend (None for the active backend)
        to_highlight (dictionary): terms to highlight and the color(s) to highlight them as
-       source_table (string): Name of a SQL table where radiology reports are stored
+       source_table (string): Name of the SQL table where radiology reports are stored (shown if the report is missing)
     """
     
-    try:
-        # Get the report for that proc_ord_id from the primary report table
-        q_get_report_row = (
-            "SELECT * FROM "
-            + source_table
-            + ' where proc_ord_id like "'
-            + str(proc_ord_id)
-            + '"'
-        )
-        df_report = client.query(q_get_report_row).to_dataframe()
-    except:
-        print(
-            "AN ERROR HAS OCCURRED: REPORT", proc_ord_id, "CANNOT BE FOUND IN", source_table
-        )
+    backend = as_backend(client)
 
-    # If the id was in the new table:
-    origin_table = source_table
-
-    q_get_report_row = (
-        "SELECT * FROM "
-        + '.narrative where proc_ord_id = "'
-        + str(proc_ord_id)
-        + '"'
-    )
-    if len(df_report) == 1:
-        report_text = (
-            client.query(q_get_report_row).to_dataframe()["narrative_text"].values[0]
-        )
+    # Get the narrative and impression, formatted (downloading the report only if it is not cached)
+    report_df = load_report_texts([proc_ord_id], backend)
+    if len(report_df) == 1:
+        report_text = report_df["report_text"].values[0]
     else:
         report_text = ""
-
-    q_get_report_row = (
-        "SELECT * FROM "
-        + '.impression where proc_ord_id = "'
-        + str(proc_ord_id)
-        + '"'
-    )
-    df_report = client.query(q_get_report_row).to_dataframe()
-
-    if len(df_report) == 1:
-        report_text += "\n\nIMPRESSION: " + df_report["impression_text"].values[0]
-    elif len(df_report) == 0:
         print("proc_ord_id not in", source_table, ":", proc_ord_id)
 
-    report_text = " ".join(report_text.split())
-    report_text = report_text.replace("CLINICAL INDICATION", "\n\nCLINICAL INDICATION")
-    report_text = report_text.replace("TECHNIQUE", "\n\nTECHNIQUE")
-    report_text = report_text.replace("HISTORY", "\n\nHISTORY")
-    report_text = report_text.replace("IMPRESSION", "\n\nIMPRESSION")
-    report_text = report_text.replace("FINDINGS", "\n\nFINDINGS")
-    report_text = report_text.replace("COMPARISON", "\n\nCOMPARISON")
-
-    # If the user passed a dictionary of lists to highlight
-    if len(to_highlight.keys()) > 0:
-        for key in to_highlight.keys():
-            report_text = mark_text_color(report_text, to_highlight[key], key)
+    # Highlight the phrases for every color in one pass
+    report_text = get_highlighter(to_highlight).highlight(report_text)
 
     # Print the report and ask for a grade
     print(report_text)
@@ -340,26 +277,24 @@ def get_grade_counts_since(d):
         d (string): representation of the date in YYYY-MM-DD format
     """
     
-    client = bigquery.Client()
+    backend = get_backend()
     global sql_tables
 
-    # Query the table
-    q = (
-        'select * from '+ sql_tables["grader_table"] +' where grade_date != "0000-00-00" and cast(grade_date as date) >= cast("'
-        + d
-        + '" as date);'
+    # Count the rows for each grader (dates are YYYY-MM-DD strings, so they compare in order)
+    df_counts = backend.count_rows(
+        sql_tables["grader_table"],
+        ["name"],
+        'grade_date != "0000-00-00" and grade_date >= @since',
+        {"since": d},
     )
-    df = client.query(q).to_dataframe()
-
-    # Get the count of rows for each grader
-    graders = list(set(df["name"].values))
+    df_counts = df_counts.sort_values("n", ascending=False)
 
     # Print the table header
     print("# Reports \t Grader Name")
 
     # Print the rows for each grader
-    for grader in graders:
-        print(len(df[df["name"] == grader]), "\t\t", grader)
+    for grader, n in zip(df_counts["name"], df_counts["n"]):
+        print(n, "\t\t", grader)
 
     # Print a statement about who has not graded any reports
     print()
@@ -377,13 +312,13 @@ def read_sample_reports(to_highlight={}):
         to_highlight (dictionary): terms to highlight and the color(s) to highlight them as
     """
     
-    # Initialize the client service
-    client = bigquery.Client()
+    # Get the storage backend
+    backend = get_backend()
 
     # Get the example reports
     get_slip_examples = "SELECT * FROM training_examples;"
 
-    df_slip = client.query(get_slip_examples).to_dataframe()
+    df_slip = backend.query(get_slip_examples)
 
     slip_reports = [
         row["narrative_text"]
@@ -401,15 +336,8 @@ def read_sample_reports(to_highlight={}):
     for report in slip_reports:
         # If the user passed a dictionary of lists to highlight
         if len(to_highlight.keys()) > 0:
-            report_text = report
-            report_text = report_text.replace("CLINICAL INDICATION", "\n\nCLINICAL INDICATION")
-            report_text = report_text.replace("TECHNIQUE", "\n\nTECHNIQUE")
-            report_text = report_text.replace("HISTORY", "\n\nHISTORY")
-            report_text = report_text.replace("IMPRESSION", "\n\nIMPRESSION")
-            report_text = report_text.replace("FINDINGS", "\n\nFINDINGS")
-            report_text = report_text.replace("COMPARISON", "\n\nCOMPARISON")
-            for key in to_highlight.keys():
-                report_text = mark_text_color(report_text, to_highlight[key], key)
+            report_text = format_report_text(report)
+            report_text = get_highlighter(to_highlight).highlight(report_text)
 
             # Print the report and ask for a grade
             print(report_text)
@@ -438,18 +366,12 @@ def add_self_eval_reports(name):
         name (string): Full name of the grader (to also be referenced in publications)
     """
     
-    client = bigquery.Client()
+    backend = get_backend()
 
     q_get_selfeval = "select distinct report_id from training_selfeval;"
-    df_self_eval = client.query(q_get_selfeval).to_dataframe()
+    df_self_eval = backend.query(q_get_selfeval)
     report_ids = df_self_eval["report_id"].values
 
-    q_insert_report = "INSERT into training_selfeval (report_id, grade, name, reason) VALUES"
-
-    for report in report_ids:
-        q_insert_report += " ('" + str(report) + "', 999, '" + name + "', ' '),"
-
-    q_insert_report = q_insert_report[:-1] + ";"
     print(
         "Adding "
         + str(len(report_ids))
@@ -457,8 +379,11 @@ def add_self_eval_reports(name):
         + name
         + " to grade."
     )
-    j_add_report = client.query(q_insert_report)
-    j_add_report.result()
+    bulk_insert(
+        "training_selfeval",
+        [{"report_id": str(report), "grade": 999, "name": name, "reason": " "} for report in report_ids],
+        backend,
+    )
 
 
 def mark_selfeval_report_sql(name, to_highlight={}):
@@ -471,8 +396,8 @@ def mark_selfeval_report_sql(name, to_highlight={}):
         to_highlight (dictionary): terms to highlight and the color(s) to highlight them as
     """
     
-    # Initialize the client service
-    client = bigquery.Client()
+    # Get the storage backend
+    backend = get_backend()
 
     # Get a row from the grader table for the specified rater that has not been graded yet
     q_get_single_row = (
@@ -481,7 +406,7 @@ def mark_selfeval_report_sql(name, to_highlight={}):
         + '" and grade = 999 LIMIT 1'
     )
 
-    df = client.query(q_get_single_row).to_dataframe()
+    df = backend.query(q_get_single_row)
 
     if len(df) == 0:
         print(
@@ -497,7 +422,7 @@ def mark_selfeval_report_sql(name, to_highlight={}):
         + str(df["report_id"].values[0])
         + '"'
     )
-    df_report = client.query(q_get_report_row).to_dataframe()
+    df_report = backend.query(q_get_report_row)
     print(df_report.shape)
     print(list(df_report))
 
@@ -506,10 +431,8 @@ def mark_selfeval_report_sql(name, to_highlight={}):
     if df_report["impression_text"].values[0] != "nan":
         report_text += " IMPRESSION:" + df_report["impression_text"].values[0]
 
-    # If the user passed a dictionary of lists to highlight
-    if len(to_highlight.keys()) > 0:
-        for key in to_highlight.keys():
-            report_text = mark_text_color(report_text, to_highlight[key], key)
+    # Highlight the phrases for every color in one pass
+    report_text = get_highlighter(to_highlight).highlight(report_text)
 
     # Print the report and ask for a grade
     print_report(report_text)
@@ -532,8 +455,7 @@ def mark_selfeval_report_sql(name, to_highlight={}):
     q_update += ' WHERE report_id like "' + str(df["report_id"].values[0]) + '"'
     q_update += ' and name like "' + name + '"'
 
-    j_update = client.query(q_update)
-    j_update.result()
+    backend.execute(q_update)
 
     # Ask for a reason the report was given the grade it was
     reason = str(input("Why does this report get that grade? "))
@@ -544,8 +466,7 @@ def mark_selfeval_report_sql(name, to_highlight={}):
     q_update += ' WHERE report_id like "' + str(df["report_id"].values[0]) + '"'
     q_update += ' and name like "' + name + '"'
 
-    j_update = client.query(q_update)
-    j_update.result()
+    backend.execute(q_update)
 
     # Print out the grade and reason others gave the report
     print()
@@ -555,7 +476,7 @@ def mark_selfeval_report_sql(name, to_highlight={}):
     )
     q_others += '" and name not like "' + name + '"'
 
-    df_truth = client.query(q_others).to_dataframe()
+    df_truth = backend.query(q_others)
     print(
         "For reference, other graders have given this report the following grades for the specified reasons:"
     )
@@ -570,7 +491,8 @@ def mark_selfeval_report_sql(name, to_highlight={}):
     print("Grade saved. Run the cell again to grade another report.")
 
 
-def mark_reports(name, project, n_grades = 10, to_highlight={}):
+@labelled
+def mark_reports(name, project, n_grades = 10, to_highlight={}, max_buffered_grades=25, batch_size=25, grade_fn=None):
     """
     Pull the report associated with a proc_ord_id for which the specified grader has a grade of 999,
     and then grade the report.
@@ -580,162 +502,81 @@ def mark_reports(name, project, n_grades = 10, to_highlight={}):
         project (string): Project to grade for
         n_grades (int): Number of reports to present
         to_highlight (dictionary): terms to highlight and the color(s) to highlight them as
-        
+        max_buffered_grades (int): Number of grades to collect before writing them to the grader table
+        batch_size (int): Number of reports to load at a time. The next batch is loaded in
+                          the background while the current one is graded
+        grade_fn (function): Called as grade_fn(proc_ord_id, report_text) to get each grade
+                             instead of asking the grader, e.g. for benchmarks. Reports it
+                             skips (-1) are saved with the reason "skipped by grade_fn"
 
     """
     
-    # Initialize the client service
-    client = bigquery.Client()
-    global sql_tables
-
-    # Get a row from the grader table for the specified rater that has not been graded yet
-    # If there's any reliability reports, start there
-    q_get_rows = f'''
-    SELECT *
-    FROM {sql_tables["grader_table"]} grader
-    INNER JOIN 2023_04_05.narrative narr
-        on narr.proc_ord_id = grader.proc_ord_id
-    WHERE name = "{name}"
-        and grade = 999
-        and grade_category = "Reliability"
-    LIMIT {n_grades}'''
-    df = client.query(q_get_rows).to_dataframe()
-    source_table = "2023_04_05.narrative"
-
-    if len(df) == 0:
-        # If no reports need Reliability, then get Unique reports
-        q_get_rows = f'''
-            SELECT * FROM {sql_tables["grader_table"]} reports
-            WHERE name = "{name}"
-                and grade = 999
-                and grade_category = "Unique"
-            ORDER BY reports.proc_ord_id
-            LIMIT {n_grades};'''
-        # print(q_get_rows)
-        df = client.query(q_get_rows).to_dataframe()
-        source_table = "narrative"
-        
-    if len(df) == 0:
-        print(
-            "There are currently no reports to grade for",
-            name,
-            " in the table. Please add more to continue.",
-        )
-        return
-        
-    proc_ord_ids = df.proc_ord_id.astype(str).unique()
-    proc_ord_id_str = '","'.join(proc_ord_ids)
-
-    # Get the projects for all reports
-    q_get_report_rows = f'''
-        SELECT *
-        FROM {sql_tables["project_table"]}
-        where proc_ord_id IN ("{proc_ord_id_str}");'''
-    # print(q_get_report_rows)
-    project_df = client.query(q_get_report_rows).to_dataframe()
-    
-    # Get the narrative and impression for all reports
-    q_get_report_rows = f'''
-        SELECT 
-          COALESCE(narr.proc_ord_id, impr.proc_ord_id) as proc_ord_id,
-          narr.narrative_text,
-          impr.impression_text
-        FROM narrative narr
-        FULL OUTER JOIN impression impr
-          ON (narr.proc_ord_id = impr.proc_ord_id)
-        WHERE narr.proc_ord_id IN ("{proc_ord_id_str}")
-        OR impr.proc_ord_id IN ("{proc_ord_id_str}");'''
-    # print(q_get_report_rows)
-    report_df = client.query(q_get_report_rows).to_dataframe()
-    if df.proc_ord_id[~df.proc_ord_id.isin(report_df.proc_ord_id)].shape[0] == 0:
-        report_df.loc[~report_df.impression_text.isna(),"impression_text"] = "\n\nIMPRESSION: " + report_df.impression_text
-        report_df.loc[report_df.impression_text.isna(),"impression_text"] = ""
-        report_df["report_text"] = report_df.narrative_text + report_df.impression_text.astype(str)
-    else:
-        # Don't exit the function if proc_ord_ids are missing. Flag them for technical review
-        missing_proc_ord_ids = df.proc_ord_id[~df.proc_ord_id.isin(report_df.proc_ord_id)]
-        missing_proc_str = '","'.join(missing_proc_ord_ids)
-        print(f"Missing proc_ord_ids: {missing_proc_str}")
-        q_update = f'''
-        UPDATE {sql_tables["grader_table"]}
-            set grade = 404,
-            grade_date = "{date.today().strftime("%Y-%m-%d")}"
-            WHERE proc_ord_id IN ("{missing_proc_str}")
-                and name like "{name}"'''
-        
-        j_update = client.query(q_update)
-        j_update.result()
-
-    # print(report_df)
-        
-    for proc_ord_id in proc_ord_ids:
-        print("Report ID: ", proc_ord_id)
-        print("Year of scan:", df.loc[df.proc_ord_id == proc_ord_id, "proc_ord_year"].values[0])
-        print("Age at scan:", np.round(df.loc[df.proc_ord_id == proc_ord_id, "age_in_days"].values[0] / 365.25, 2), "years")
-        print("Grading Criteria:", df.loc[df.proc_ord_id == proc_ord_id, 'grade_criteria'].values[0])
-        # Fixing the project name confusion
-        # Query the project table
-        proc_projects = project_df.project[project_df.proc_ord_id == proc_ord_id].values
-        if df['grade_category'].values[0] == "Reliability":
-            print("This is a Reliability report, not a unique report")
-        elif project in proc_projects:
-            print("Project:", project)
-            print()
-        else:
-            print("WARNING: report "+str(proc_ord_id)+" does not appear to belong to the cohort for "+project)
-            print("It does belong to the following cohorts: "+", ".join(list(proc_projects)))
-            print()
-        # print(report_df.report_text[report_df.proc_ord_id == proc_ord_id].values[0])
-        print_report(report_df.report_text[report_df.proc_ord_id == proc_ord_id].values[0], to_highlight)  # -- LOH
-        grade = get_grade(enable_md_flag=False)
-    
-        # write the case to handle the skipped reports 
-        if grade == -1 or grade == 503:
-            # Ask the user for a reason
-            if grade == -1:
-                skip_reason = get_reason("skip")
-            elif grade == 503:
-                skip_reason = "OUTSIDE SCAN"
-            # Write a query to add the report to the skipped reports table.
-            # ('proc_ord_id', 'grade', 'name', 'skip_date', 'skip_reason', 'regrade_date', 'regrade_reason', 'grade_criteria')
-            q_skip_report = "insert into "+ sql_tables["skipped_reports_table"] +" values ("
-            today = date.today().strftime("%Y-%m-%d")
-            q_skip_report += (
-                "'"
-                + str(proc_ord_id)
-                + "', "
-                + str(grade)
-                + ", '"
-                + name
-                + "', '"
-                + str(today)
-                + "', '"
-                + skip_reason
-                + "', '', '', '"
-                + df['grade_criteria'].values[0]
-                + "');"
+    # The session loads reports in batches on a background thread and buffers the
+    # grades; closing it saves any pending grades if the grader stops early or
+    # interrupts the kernel
+    session = GradingSession(
+        name, project, min(batch_size, n_grades), max_buffered_grades, to_highlight, max_reports=n_grades
+    )
+    try:
+        report = session.next_report()
+        if report is None:
+            if len(session.missing) > 0:
+                print("Missing proc_ord_ids: " + '","'.join(session.missing))
+            print(
+                "There are currently no reports to grade for",
+                name,
+                " in the table. Please add more to continue.",
             )
-    
-            # Execute the query
-            # print(q_skip_report)
-            j_skip_report = client.query(q_skip_report)
-            j_skip_report.result()
-    
-        # Update the grader table with the new grade
-        q_update = f'''
-        UPDATE {sql_tables["grader_table"]}
-            set grade = {str(grade)},
-            grade_date = "{date.today().strftime("%Y-%m-%d")}"
-            WHERE proc_ord_id = "{str(proc_ord_id)}"
-                and name like "{name}"'''
-        # print(q_update)
-        j_update = client.query(q_update)
-        j_update.result()
-        print("Grade saved.")
-        clear_output()
+            return
+
+        while report is not None:
+            proc_ord_id = report["proc_ord_id"]
+            print("Report ID: ", proc_ord_id)
+            print("Year of scan:", report["proc_ord_year"])
+            print("Age at scan:", report["age_years"], "years")
+            print("Grading Criteria:", report["grade_criteria"])
+            # Fixing the project name confusion
+            if report["grade_category"] == "Reliability":
+                print("This is a Reliability report, not a unique report")
+            elif report["in_project"]:
+                print("Project:", project)
+                print()
+            else:
+                print("WARNING: report "+str(proc_ord_id)+" does not appear to belong to the cohort for "+project)
+                print("It does belong to the following cohorts: "+", ".join(report["projects"]))
+                print()
+            with timed("step:highlight"):
+                print_report(report["report_text"], to_highlight, preformatted=True, spans=report["spans"])  # -- LOH
+            if grade_fn is not None:
+                grade = grade_fn(proc_ord_id, report["report_text"])
+            else:
+                with timed("step:grader_input"):
+                    grade = get_grade(enable_md_flag=False)
+
+            # Ask the user why the report was skipped (503 is saved as an outside scan)
+            skip_reason = None
+            if grade == -1 and grade_fn is not None:
+                skip_reason = "skipped by grade_fn"
+            elif grade == -1:
+                with timed("step:grader_input"):
+                    skip_reason = get_reason("skip")
+
+            # Queue the new grade for the grader table
+            session.submit_grade(proc_ord_id, grade, skip_reason)
+            print("Grade saved.")
+            clear_output()
+
+            if session.num_presented >= n_grades:
+                break
+            report = session.next_report()
+    finally:
+        session.close()
+    if len(session.missing) > 0:
+        print("Missing proc_ord_ids: " + '","'.join(session.missing))
     print("Run the cell again to grade another report.")
 
 
+@labelled
 def get_more_reports_to_grade(name, project="SLIP Adolescents", num_to_add=100):
     """
     Get more proc_ord_id for which no reports have been rated for the specified user to grade
@@ -766,7 +607,6 @@ def get_more_reports_to_grade(name, project="SLIP Adolescents", num_to_add=100):
     order_params = project_params["sort"]
     if project_params["validation"] == "yes" and project_params["prioritize_validation"] == "yes":
         order_params = ['report_type = "validation" desc'] + order_params
-    order_params_str = ",\n            ".join(order_params)
 
     
     # Global var declaration
@@ -778,10 +618,9 @@ def get_more_reports_to_grade(name, project="SLIP Adolescents", num_to_add=100):
         num_validation = num_validation_graders
     
     global sql_tables
-    print("It is expected for this function to take several minutes to run. Your patience is appreciated.")
 
-    # Initialize the client service
-    client = bigquery.Client()
+    # Get the storage backend
+    backend = get_backend()
 
     # Get the grading criteria
     criteria = load_cohort_config(project, "grade_criteria")
@@ -789,88 +628,11 @@ def get_more_reports_to_grade(name, project="SLIP Adolescents", num_to_add=100):
     # Get the number of reports for a cohort
     get_project_report_stats(project)
 
-    # Get both validation and new reports in a single table
-    q_get_reports = f'''
-    with joint_reports as (
-        with CTE as (
-          select
-            count(proc_ord_id) as counter,
-            proc_ord_id,
-            avg(grade) as avg_grade
-          from {sql_tables["grader_table"]}
-          group by proc_ord_id
-        )
-        select
-        distinct 
-          CTE.counter,
-          CTE.avg_grade,
-          grader.proc_ord_id,
-          grader.name,
-          "validation" as report_type
-        from {sql_tables["grader_table"]} grader
-        join {sql_tables["project_table"]} projects on (
-          grader.proc_ord_id = projects.proc_ord_id
-          and grader.pat_id = projects.pat_id
-        )
-        join CTE on (
-          grader.proc_ord_id = CTE.proc_ord_id
-        )
-        where
-          projects.project = "{project}"
-          and grader.name != "{name}"  
-          and CTE.counter < {str(num_validation)}
-          and grader.name not like "Coarse Text Search%"
-          and grade_category = "Unique"
-          and grade_criteria = "{criteria}"
-          and avg_grade > 0 
-          and avg_grade <= 2
-        UNION ALL
-        select
-          0 as counter,
-          null as avg_grade,
-          projects.proc_ord_id,
-          "" as name,
-          "new" as report_type
-        from {sql_tables["project_table"]} projects
-        join procedures proc on 
-          (proc.proc_ord_id = projects.proc_ord_id)
-        left join visits enc on 
-          (proc.encounter_id = enc.encounter_id)
-        where
-        project = "{project}"
-          and projects.proc_ord_id not in (
-          select
-            grader.proc_ord_id
-            from {sql_tables["grader_table"]} grader
-            where grader.grade_criteria = "{criteria}"
-          )
-          and enc_type_name != "Reconciled Outside Data"
-    )
-    SELECT DISTINCT
-    joint_reports.*,
-    pat.birth_weight_kg,
-    pat.gestational_age_num,
-    proc.proc_ord_datetime,
-    proc.proc_ord_age'''
-
-    
-    q_get_reports += f'''
-    FROM joint_reports
-    LEFT JOIN procedures proc ON (proc.proc_ord_id = joint_reports.proc_ord_id)
-    LEFT JOIN patient_info pat ON (pat.pat_id = proc.pat_id)'''
-
-        
-    # Add birth weight, gestational_age, and proc_ord_datetime
-    
-    q_get_reports += f'''
-    ORDER BY {order_params_str}
-    LIMIT {str(num_to_add)};'''
-        
-    
-    df_reports = client.query(q_get_reports).to_dataframe()
-    to_add = list(set(df_reports['proc_ord_id'].values))
-    if len(to_add) > 0:
-        add_reports_for_grader(to_add, name, project)
+    # Get both validation and new reports from the project's candidate pool. Reports
+    # are claimed first so graders adding reports at the same time never share one
+    # beyond num_validation graders
+    df_reports = assign_reports(name, project, criteria, num_to_add, num_validation, order_params, backend)
+    to_add = list(df_reports['proc_ord_id'].astype(str).values)
    
     # Count reports
     print("Number of validation reports added:", sum(df_reports.report_type == "validation"))
@@ -882,16 +644,12 @@ def get_more_reports_to_grade(name, project="SLIP Adolescents", num_to_add=100):
             "There are no reports for this project that have yet to be either graded or validated."
         )
     else:
-        get_user_unrated_count = (
-            'SELECT * FROM '+ sql_tables["grader_table"] +' WHERE name like "'
-            + name
-            + '" and grade = 999'
-        )
-
-        df = client.query(get_user_unrated_count).to_dataframe()
+        n_queued = backend.count_rows(
+            sql_tables["grader_table"], where="name = @name and grade = 999", params={"name": name}
+        ).n.sum()
 
         # Inform the user
-        print(len(df), "reports are in the queue for grader", name)
+        print(n_queued, "reports are in the queue for grader", name)
 
 
 def add_reports_for_grader(proc_ord_ids, name, project):
@@ -903,47 +661,10 @@ def add_reports_for_grader(proc_ord_ids, name, project):
         name (string): Full name of the grader (to also be referenced in publications)
         project (string): Project to grade for
     """
-    
-    client = bigquery.Client()
-    global sql_tables
-    
-    # Get the column names from the table
-    q_get_cols = "select * from "+ sql_tables["grader_table"] +" limit 1;"
-    df_get_cols = client.query(q_get_cols).to_dataframe()
-    cols_str = " ("+", ".join(list(df_get_cols))+") "
-    
-    # Convert the list of proc_ord_ids to a SQL string
-    procs_str = ' ("'+'", "'.join(proc_ord_ids)+'") '
 
     # Get the grading criteria field for the project
     criteria = load_cohort_config(project, "grade_criteria")
-    
-    # Set up the query
-    q_insert = '''insert into '''+ sql_tables["grader_table"] +cols_str+'''
-        select
-          distinct 
-          proc_ord.proc_ord_id, "'''+name+'''" as name,
-          999 as grade,
-          "Unique" as grade_category,
-          proc_ord.pat_id,
-          proc_ord.proc_ord_age as age_in_days,
-          proc_ord.proc_ord_year,
-          proc_ord.proc_ord_desc as proc_name,
-          "procedure_order" as report_origin_table, '''
-    if "project" in cols_str:
-        q_insert += '"'+project+'" as project, '
-    q_insert += '"0000-00-00" as grade_date, '
-    q_insert += '"'+criteria+'''" as grade_criteria
-        from
-          procedures proc_ord
-          join patient_info pat on proc_ord.pat_id = pat.pat_id
-        where
-          proc_ord.proc_ord_id in '''+procs_str+'''
-        order by 
-          proc_ord.proc_ord_year desc;'''
-    # print(q_insert)
-    j_insert = client.query(q_insert)
-    j_insert.result()
+    queue_reports(proc_ord_ids, name, project, criteria, get_backend())
 
 
 def get_second_look_reports_to_grade(name, num_to_add=100):
@@ -964,8 +685,8 @@ def get_second_look_reports_to_grade(name, num_to_add=100):
     )
     print("Looking at", sql_tables["grader_table"])
 
-    # Initialize the client service
-    client = bigquery.Client()
+    # Get the storage backend
+    backend = get_backend()
 
     # Get the proc_ord_ids from the grader table
     q_grade_table = f'''with CTE as (
@@ -996,7 +717,7 @@ def get_second_look_reports_to_grade(name, num_to_add=100):
           and grade_category = "Unique"
         order by grader.proc_ord_year desc
         limit {str(num_to_add)};'''
-    df_grade_table = client.query(q_grade_table).to_dataframe()
+    df_grade_table = backend.query(q_grade_table)
     
     to_validate_ids = df_grade_table["proc_ord_id"].values
     print(df_grade_table.shape)
@@ -1011,12 +732,13 @@ def get_second_look_reports_to_grade(name, num_to_add=100):
         + name
         + '%";'
     )
-    df = client.query(q_get_user_unrated_count).to_dataframe()
+    df = backend.query(q_get_user_unrated_count)
 
     # Inform the user
     print(len(df), "reports are in the queue for grader", name)
 
 
+@labelled
 def welcome_user(name):
     """
     Print welcome message to user, letting them know the status of their grading 
@@ -1031,13 +753,13 @@ def welcome_user(name):
     print("Welcome,", name)
     global sql_tables
 
-    client = bigquery.Client()
+    backend = get_backend()
 
     # Possibly pull this bit into its own function - make it user proof
     q_check_self_eval = (
         'select * from training_selfeval where name like"' + name + '"'
     )
-    df_self_eval = client.query(q_check_self_eval).to_dataframe()
+    df_self_eval = backend.query(q_check_self_eval)
 
     if len(df_self_eval) == 0:
         print(
@@ -1052,42 +774,35 @@ def welcome_user(name):
         )
         return "self-eval"
 
-    q_reliability = (
-        'select * from '+ sql_tables["grader_table"] +' where grade_category = "Reliability" and name like"'
-        + name
-        + '"'
-    )
-    df_reliability = client.query(q_reliability).to_dataframe()
-    # print(check_reliability_ratings(df_reliability))
+    num_graded_reliability, num_reliability = reliability_progress(name, backend)
+    if num_reliability > 0:
+        print(name, "has graded", num_graded_reliability, "of", num_reliability, "reliability reports")
 
-    if not check_reliability_ratings(df_reliability):
+    if num_reliability == 0 or num_graded_reliability < num_reliability:
         print("It appears you have yet to grade the reliability reports.")
         add_reliability_reports(name)
-        return "reliability"
-    elif 999 in df_reliability["grade"].values:
-        reliability_count = len(df_reliability[df_reliability["grade"] == 999])
-        print("You have", reliability_count, "reliability reports to grade.")
+        # Count again, as reports may have just been added to the queue
+        num_graded_reliability, num_reliability = reliability_progress(name, backend)
+        print("You have", num_reliability - num_graded_reliability, "reliability reports to grade.")
         return "reliability"
     else:
-        q_get_queued_count = (
-            'select * from '+ sql_tables["grader_table"] +' where name like "'
-        )
-        q_get_queued_count += name + '" and grade = 999'
-
-        df_grader_unrated = client.query(q_get_queued_count).to_dataframe()
+        # Read the grader's queue from the progress summary instead of their full history
+        summary = get_progress_summary(name, backend)
+        num_unrated = summary.loc[summary["grade"] == 999, "n"].sum()
 
-        if len(df_grader_unrated) == 0:
+        if num_unrated == 0:
             print("You are caught up on your report ratings")
-            # TODO add function here to get more reports for the user
+            print("Run get_more_reports_to_grade(name, project) to add more reports to your queue")
         else:
             print(
                 "You currently have",
-                len(df_grader_unrated),
+                num_unrated,
                 "ungraded reports to work on.",
             )
         return "unique"
 
 
+@labelled
 def add_reliability_reports(name):
     """
     Add reliability reports to a user's queue
@@ -1096,41 +811,134 @@ def add_reliability_reports(name):
         name (string):  Full name of the grader (to also be referenced in publications)
     """
     
-    client = bigquery.Client()
+    backend = get_backend()
     global sql_tables
 
-    # Get the grader table
+    # Get the reliability reports already in the grader's queue
     q_get_grader_table = (
-        "SELECT * from "+ sql_tables["grader_table"] +" where name = '"
-        + name
-        + "' and grade_category = 'Reliability';"
+        "SELECT proc_ord_id from " + sql_tables["grader_table"] + " where name = @name and grade_category = 'Reliability';"
     )
-    df_grader = client.query(q_get_grader_table).to_dataframe()
+    df_grader = backend.query(q_get_grader_table, {"name": name})
 
-    df_reliability = pd.read_csv("~/arcus/shared/reliability_report_info.csv")
-    add_reports = False
+    df_reliability = load_reliability_info()
+    df_reliability = df_reliability.assign(proc_ord_id=df_reliability["proc_ord_id"].astype(int).astype(str))
+    df_add = df_reliability[~df_reliability["proc_ord_id"].isin(df_grader["proc_ord_id"].astype(str))]
 
-    q_insert_report = "INSERT into "+ sql_tables["grader_table"] +" (proc_ord_id, name, grade, grade_category, pat_id, age_in_days, proc_ord_year, proc_name, report_origin_table, grade_date, grade_criteria) VALUES"
+    if len(df_add) > 0:
+        print("Adding reliability reports to grade")
+        rows = pd.DataFrame({
+            "proc_ord_id": df_add["proc_ord_id"],
+            "name": name,
+            "grade": 999,
+            "grade_category": "Reliability",
+            "pat_id": df_add["pat_id"].astype(str),
+            "age_in_days": df_add["age_in_days"],
+            "proc_ord_year": df_add["proc_ord_year"],
+            "proc_name": df_add["proc_name"],
+            "report_origin_table": df_add["report_origin_table"],
+            "grade_date": "0000-00-00",
+            "grade_criteria": reliability_criteria,
+        })
+        bulk_insert(sql_tables["grader_table"], rows, backend)
+        record_grade_changes(queued_reports(list(rows["proc_ord_id"]), name, reliability_criteria, "Reliability"), backend)
+
+
+def load_reliability_info(path=reliability_info_path):
+    """
+    Load the list of reliability reports. The file is parsed once and read again
+    only when it changes on disk
 
-    # print(df_grader['proc_ord_id'].values)
+    Args:
+        path (string): Location of the reliability report csv
+    
+    Return:
+        df_reliability (dataframe): proc_ord_id and report details of each reliability report
+    """
 
-    for idx, row in df_reliability.iterrows():
-        # print(row['proc_ord_id'])
-        if str(row["proc_ord_id"]) not in df_grader["proc_ord_id"].values:
-            # Add the report
-            q_insert_report += f'''
-            ("{str(int(row["proc_ord_id"]))}", "{name}", 999, "Reliability",
-            "{row["pat_id"]}", {str(row["age_in_days"])}, {str(row["proc_ord_year"])},
-            "{row["proc_name"]}", "{row["report_origin_table"]}", 
-            "0000-00-00", "SLIP"),'''
-            add_reports = True
+    return _cached_reliability_info(path)[1]
+
+
+def get_reliability_ids(path=reliability_info_path):
+    """
+    Get the proc_ord_ids of the reliability reports as a set of strings (cached like load_reliability_info)
+    """
+    return _cached_reliability_info(path)[2]
 
-    if add_reports:
-        print("Adding reliability reports to grade")
-        q_insert_report = q_insert_report[:-1] + ";"
-        # print(q_insert_report)
-        j_add_report = client.query(q_insert_report)
-        j_add_report.result()
+
+def _cached_reliability_info(path):
+    path = os.path.expanduser(path)
+    mtime = os.stat(path).st_mtime_ns
+    cached = _reliability_info_cache.get(path)
+    if cached is None or cached[0] != mtime:
+        df_reliability = pd.read_csv(path)
+        reliability_ids = frozenset(df_reliability["proc_ord_id"].astype("int64").astype(str))
+        cached = (mtime, df_reliability, reliability_ids)
+        _reliability_info_cache[path] = cached
+    return cached
+
+
+def get_reliability_status(df_grader=None):
+    """
+    Count the reliability reports each grader has been assigned and has graded
+
+    Args:
+        df_grader (dataframe): Report history/queue of one or more graders. By default
+                               the reliability rows of every grader are loaded
+    
+    Return:
+        status (dataframe): num_reliability and num_graded_reliability for each grader name
+    """
+
+    global sql_tables
+    if df_grader is None:
+        q_reliability = f'''
+        SELECT name, proc_ord_id, grade, grade_category
+        FROM {sql_tables["grader_table"]}
+        WHERE grade_category = "Reliability"'''
+        df_grader = get_backend().query(q_reliability)
+
+    reliability_ids = get_reliability_ids()
+
+    df_grader_reliability = df_grader[df_grader["grade_category"] == "Reliability"]
+    df_grader_reliability = df_grader_reliability[
+        df_grader_reliability["proc_ord_id"].astype(str).isin(reliability_ids)
+    ]
+    # A report counts as graded once any of its rows for the grader has a grade
+    max_grades = df_grader_reliability.astype({"grade": int}).groupby(
+        ["name", df_grader_reliability["proc_ord_id"].astype(str)]
+    )["grade"].max()
+    status = (max_grades != 999).groupby(level="name").agg(["size", "sum"])
+    status.columns = ["num_reliability", "num_graded_reliability"]
+    status = status.reindex(pd.unique(df_grader["name"]), fill_value=0)
+    status.index.name = "name"
+    return status.astype(int)
+
+
+def reliability_progress(name, backend=None):
+    """
+    Count the reliability reports of one grader like check_reliability_ratings: each
+    report of the reliability list once, from the grader's reliability rows only
+
+    Args:
+        name (string):  Full name of the grader (to also be referenced in publications)
+        backend (StorageBackend): backend to use (default: the active backend)
+
+    Return:
+        (tuple): number of graded reliability reports, number of assigned reliability reports
+    """
+
+    global sql_tables
+    if backend is None:
+        backend = get_backend()
+    q_reliability = f'''
+    SELECT name, proc_ord_id, grade, grade_category
+    FROM {sql_tables["grader_table"]}
+    WHERE name = @name and grade_category = "Reliability" and grade_criteria = @criteria'''
+    df_reliability = backend.query(q_reliability, {"name": name, "criteria": reliability_criteria})
+    if len(df_reliability) == 0:
+        return 0, 0
+    status = get_reliability_status(df_reliability).loc[name]
+    return int(status["num_graded_reliability"]), int(status["num_reliability"])
 
 
 def check_reliability_ratings(df_grader):
@@ -1138,55 +946,31 @@ def check_reliability_ratings(df_grader):
     Print the status of a user's reliability report grading progress
 
     Args:
-        df_grader (dataframe): A user's report history/queue in a table
+        df_grader (dataframe): A user's report history/queue in a table. Rows of
+                               several users print a line for each user
 
+    Return:
+        (boolean): True if every assigned reliability report has been graded
     """
     if len(df_grader) == 0:
         return False
 
-    name = df_grader["name"].values[0]
-    df_reliability = pd.read_csv("~/arcus/shared/reliability_report_info.csv")
-    reliability_ids = df_reliability["proc_ord_id"].values
-    df_grader_reliability = df_grader[df_grader["grade_category"] == "Reliability"]
-    grader_ids = df_grader_reliability["proc_ord_id"].values
-    num_reliability = len([i for i in reliability_ids if str(i) in grader_ids])
-    num_graded_reliability = len(
-        [
-            i
-            for i in reliability_ids
-            if str(i) in grader_ids
-            and max(
-                df_grader_reliability[df_grader_reliability["proc_ord_id"] == str(i)][
-                    "grade"
-                ].values
-            )
-            != 999
-        ]
-    )
-    # print(num_reliability)
-    # print(len(reliability_ids))
-
-    # assert num_reliability == len(reliability_ids)
-    print(
-        name,
-        "has graded",
-        num_graded_reliability,
-        "of",
-        num_reliability,
-        "reliability reports",
-    )
-
-    if num_graded_reliability == num_reliability:
-        return True
-    elif num_graded_reliability < num_reliability:
-        return False
-    else:
+    status = get_reliability_status(df_grader)
+    for name, row in status.iterrows():
         print(
-            "Error (code surplus): Grader has graded more reliability reports than exist"
+            name,
+            "has graded",
+            row["num_graded_reliability"],
+            "of",
+            row["num_reliability"],
+            "reliability reports",
         )
 
+    return bool((status["num_graded_reliability"] == status["num_reliability"]).all())
+
 
-def release_reports(name, reports_list):
+@labelled
+def release_reports(name, reports_list, dry_run=False):
     """
     For a specified list of reports, change their grades to 999 to put them back
     in a user's queue. ASSUMES THE USER HAS VERIFIED THE REPORTS TO RELEASE
@@ -1194,134 +978,105 @@ def release_reports(name, reports_list):
     Args:
         name (string):  Full name of the grader (to also be referenced in publications)
         reports_list (list): proc_ord_id for reports to reset the grades for
+        dry_run (boolean): Only report how many grades would be reset
+
+    Return:
+        (int): number of graded reports released (or that would be)
     """
     
-    # Initialize the client
-    client = bigquery.Client()
+    # Get the storage backend
+    backend = get_backend()
     # Use the previously specified global vars
     global sql_tables
+    changes = grade_changes([(proc_ord_id, name) for proc_ord_id in reports_list], 999, backend)
+    n_graded = int((changes["grade"] != 999).sum())
 
-    # For each report
-    for proc_ord_id in reports_list:
-        # Update the grader table with the new grade
-        q_update = "UPDATE "+ sql_tables["grader_table"] +" set grade = 999,"
-        q_update += ' grade_date="0000-00-00"'
-        q_update += ' WHERE proc_ord_id = "' + str(proc_ord_id) + '"'
-        q_update += ' and name = "' + name + '"'
+    if dry_run:
+        print(
+            len(changes), "of", len(reports_list), "reports are in the queue for", name + ",",
+            n_graded, "of them graded. Nothing was released (dry run)"
+        )
+        return n_graded
 
-        j_update = client.query(q_update)
-        j_update.result()
+    # Reset the grades of all of the reports at once
+    q_update = "UPDATE " + sql_tables["grader_table"] + " set grade = 999, grade_date = \"0000-00-00\""
+    q_update += " WHERE name = @name and proc_ord_id IN @proc_ord_ids"
+    backend.execute(q_update, {"name": name, "proc_ord_ids": [str(proc_ord_id) for proc_ord_id in reports_list]})
 
+    record_grade_changes(changes, backend)
     print(len(reports_list), "were released back into the queue for", name)
+    return n_graded
 
 
-def backup_reliability_grades(name):
+@labelled
+def backup_reliability_grades(name, dry_run=False):
     """
-    Backup a user's recently entered grades
+    Backup a user's recently entered grades. Reliability reports not in the backup
+    table yet are added, and backed up reports still ungraded (999) get the grade
 
     Args:
         name (string):  Full name of the grader (to also be referenced in publications)
+        dry_run (boolean): Only report how many rows of the backup would change
+
+    Return:
+        (dictionary): number of backup rows inserted and updated (or that would be)
     """
     
-    client = bigquery.Client()
+    backend = get_backend()
     # Use currently set global vars
     global sql_tables
 
-    q = "select * from "+ sql_tables["grader_table"] +" where name = '" + name
-    q += "' and grade_category = 'Reliability'"
-    df_primary = client.query(q).to_dataframe()
-
-    for proc_ord_id in df_primary["proc_ord_id"].values:
-        # If the proc id is not in the df for the user
-        q = "select * from lab.reliability_grades_original where name = '" + name
-        q += (
-            "' and grade_category = 'Reliability' and proc_ord_id = "
-            + str(proc_ord_id)
-            + ";"
-        )
-        df_backup = client.query(q).to_dataframe()
-
-        # if the query returned an empty dataframe
-        if len(df_backup) == 0:
-            # Then add the row to the table
-            q_add = "insert into lab.reliability_grades_original (proc_ord_id, name, "
-            q_add += (
-                "grade, grade_category, pat_id, age_in_days, proc_ord_year, proc_name, "
-            )
-            q_add += (
-                "report_origin_table, project) values ('"
-                + str(proc_ord_id)
-                + "', '"
-                + df_primary["name"].values[0]
-            )
-            q_add += (
-                "', "
-                + str(df_primary["grade"].values[0])
-                + ", 'Reliability', '"
-                + str(df_primary["pat_id"].values[0])
-            )
-            q_add += (
-                "', "
-                + str(df_primary["age_in_days"].values[0])
-                + ", "
-                + str(df_primary["proc_ord_year"].values[0])
-            )
-            q_add += (
-                ", '"
-                + str(df_primary["proc_name"].values[0])
-                + "', '"
-                + str(df_primary["report_origin_table"].values[0])
-            )
-            q_add += (
-                "', '"
-                + str(df_primary["project"].values[0])
-                + "', '"
-                + str(df_primary["grade_date"].values[0])
-                + "' ) ;"
-            )
-
-        elif len(df_backup) == 1:
-            if df_backup["grade"].values == 999:
-                q_update = (
-                    "UPDATE lab.reliability_grades_original set grade = "
-                    + df_primary["grade"].values[0]
-                )
-                q_update += (
-                    ' WHERE proc_ord_id = "'
-                    + str(df_primary["proc_ord_id"].values[0])
-                    + '"'
-                )
-                q_update += (
-                    ' and name = "'
-                    + str(df_primary["name"].values[0])
-                    + '"'
-                )
+    # Copy the columns both tables have (the grader table may not have a project column)
+    columns = [
+        "proc_ord_id", "name", "grade", "grade_category", "pat_id", "age_in_days", "proc_ord_year",
+        "proc_name", "report_origin_table", "project", "grade_date",
+    ]
+    grader_columns = backend.table_columns(sql_tables["grader_table"])
+    columns = [col for col in columns if col in grader_columns]
+
+    # A report may be in the grader table more than once: keep one row per backup
+    # key, the graded one if any and then the latest, so the MERGE (and the dry run
+    # counting the same source) matches each backup row at most once
+    q_source = "select " + ", ".join(columns) + " from ("
+    q_source += "select " + ", ".join(columns) + ", row_number() over ("
+    q_source += "partition by proc_ord_id, name, grade_category"
+    q_source += " order by case when grade != 999 then 1 else 0 end desc, grade_date desc) as row_num"
+    q_source += " from " + sql_tables["grader_table"]
+    q_source += " where name = @name and grade_category = 'Reliability') where row_num = 1"
+    counts = backend.merge_query(
+        "lab.reliability_grades_original",
+        q_source,
+        ["proc_ord_id", "name", "grade_category"],
+        columns,
+        update_columns=["grade", "grade_date"],
+        update_condition="target.grade = 999 and source.grade != 999",
+        params={"name": name},
+        dry_run=dry_run,
+    )
 
-                j_update = client.query(q_update)
-                j_update.result()
+    if dry_run:
+        print("Would back up", counts["inserted"], "new and", counts["updated"], "graded reliability reports for", name)
+    else:
+        print("Backed up", counts["inserted"], "new and", counts["updated"], "graded reliability reports for", name)
+    return counts
 
 
-def print_report(report_text, to_highlight={}):
+def print_report(report_text, to_highlight={}, preformatted=False, spans=None):
     """
     Print a report with highlighted text
 
     Args:
         report_text (string): Text of a radiology report in a string
         to_highlight (dictionary): terms to highlight and the color(s) to highlight them as
+        preformatted (boolean): True if the text already went through format_report_text
+        spans (list): precomputed (start, end, phrase) matches in the formatted text, from the report index
     """
 
-    report_text = " ".join(report_text.split())
-    report_text = report_text.replace("CLINICAL INDICATION", "\n\nCLINICAL INDICATION")
-    report_text = report_text.replace("TECHNIQUE", "\n\nTECHNIQUE")
-    report_text = report_text.replace("HISTORY", "\n\nHISTORY")
-    report_text = report_text.replace("IMPRESSION", "\n\nIMPRESSION")
-    report_text = report_text.replace("FINDINGS", "\n\nFINDINGS")
-    report_text = report_text.replace("COMPARISON", "\n\nCOMPARISON")
+    if not preformatted:
+        report_text = format_report_text(report_text)
 
-    # If the user passed a dictionary of lists to highlight
-    if len(to_highlight.keys()) > 0:
-        for key in to_highlight.keys():
-            report_text = mark_text_color(report_text, to_highlight[key], key)
+    # Highlight the phrases for every color in one pass
+    report_text = get_highlighter(to_highlight).highlight(report_text, spans)
 
     # Print the report and ask for a grade
     print(report_text)
@@ -1438,35 +1193,32 @@ def get_grade(enable_md_flag=False):
         return grade
 
 
-def check_unique_grades(df, name):
+def check_unique_grades(summary, name):
     """
     Print statement on a user's grading progress
 
     Args:
-        df (dataframe): A user's report grading queue
+        summary (dataframe): A user's progress summary rows (see get_progress_summary)
         name (string):  Full name of the grader (to also be referenced in publications)
     """
     
     # Unique
-    df_unique_reports = df[df["grade_category"] == "Unique"]
-    df_graded_unique_reports = df[
-        (df["grade_category"] == "Unique") & (df["grade"] != 999)
-    ]
+    num_graded, num_assigned = category_progress(summary, "Unique")
     print(
         name,
         "has graded",
-        df_graded_unique_reports.shape[0],
+        num_graded,
         "unique reports of",
-        df_unique_reports.shape[0],
+        num_assigned,
         "assigned where",
     )
+    df_unique_reports = summary[summary["grade_category"] == "Unique"]
     for grade in range(3):
-        num_graded = df_graded_unique_reports[
-            df_graded_unique_reports["grade"] == grade
-        ].shape[0]
+        num_graded = df_unique_reports.loc[df_unique_reports["grade"] == grade, "n"].sum()
         print(num_graded, "have been given a grade of", grade)
     
 
+@labelled
 def get_grader_status_report(name):
     """
     Check a user's grading status
@@ -1475,34 +1227,29 @@ def get_grader_status_report(name):
         name (string):  Full name of the grader (to also be referenced in publications)
     """
     
-    client = bigquery.Client()
-    # Declare global var, but automatically start with SLIP regardless
-    global sql_tables
+    backend = get_backend()
 
-    query = "select * from "+sql_tables["grader_table"].replace("nonslip_", "")+" where "
-    query += "name = '" + name + "' and grade_criteria = 'SLIP' ;"
-    df = client.query(query).to_dataframe()
+    # Start with SLIP regardless
+    summary = get_progress_summary(name, backend)
+    df_slip = summary[summary["grade_criteria"] == "SLIP"]
     # Case: user not in table
-    if len(df) == 0:
+    if len(df_slip) == 0:
         print("User is not grading SLIP reports yet.")
         return
 
     # Reliability ratings
-    check_reliability_ratings(df)
+    num_graded_reliability, num_reliability = reliability_progress(name, backend)
+    print(name, "has graded", num_graded_reliability, "of", num_reliability, "reliability reports")
     # SLIP grades
     print("")
     print("SLIP ---------")
-    check_unique_grades(df, name)
+    check_unique_grades(df_slip, name)
 
     # See if the user is also grading nonslip reports
-    query = "select * from "+ sql_tables["grader_table"] +" where "
-    query += "name = '" + name
-    df = client.query(query).to_dataframe()
-
-    # Case: user not in table
-    if len(df) > 0:
+    df_nonslip = summary[summary["grade_criteria"] != "SLIP"]
+    if len(df_nonslip) > 0:
         print("")
-        check_unique_grades(df, name)
+        check_unique_grades(df_nonslip, name)
 
 
 
@@ -0,0 +1,200 @@
+import os
+import json
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from storageBackends import get_backend
+from reportCache import load_report_texts
+from progressSummary import grade_changes, record_grade_changes
+from queryLog import in_context
+
+with open(f"{os.path.dirname(__file__)}/sql_tables.json", 'r', encoding='utf-8') as f:
+    sql_tables = json.load(f)
+
+
+def fetch_report_batch(name, n_grades, exclude_ids=(), backend=None):
+    """
+    Get the next batch of reports in a grader's queue (reliability reports first),
+    together with their projects and report text. Nothing is written: reports without
+    text are only returned as missing, for flag_missing_reports once the batch is used
+
+    Args:
+        name (string): Full name of the grader (to also be referenced in publications)
+        n_grades (int): Maximum number of reports in the batch
+        exclude_ids (list): proc_ord_ids already handed out to the grader this session
+        backend (StorageBackend): backend to read from (default: the active backend)
+
+    Return:
+        batch (dictionary): "queue" (grader table rows), "projects" (project table rows),
+        "reports" (proc_ord_id and formatted report_text) and "missing" (proc_ord_ids without text)
+    """
+
+    global sql_tables
+    if backend is None:
+        backend = get_backend()
+    params = {"name": name, "exclude_ids": [str(i) for i in exclude_ids]}
+
+    # Get a row from the grader table for the specified rater that has not been graded yet
+    # If there's any reliability reports, start there
+    q_get_rows = f'''
+    SELECT grader.*
+    FROM {sql_tables["grader_table"]} grader
+    INNER JOIN {sql_tables["reliability_source_table"]} narr
+        on narr.proc_ord_id = grader.proc_ord_id
+    WHERE name = @name
+        and grade = 999
+        and grade_category = "Reliability"
+        and grader.proc_ord_id NOT IN @exclude_ids
+    LIMIT {int(n_grades)}'''
+    df = backend.query(q_get_rows, params)
+
+    if len(df) == 0:
+        # If no reports need Reliability, then get Unique reports
+        q_get_rows = f'''
+            SELECT * FROM {sql_tables["grader_table"]} reports
+            WHERE name = @name
+                and grade = 999
+                and grade_category = "Unique"
+                and reports.proc_ord_id NOT IN @exclude_ids
+            ORDER BY reports.proc_ord_id
+            LIMIT {int(n_grades)};'''
+        df = backend.query(q_get_rows, params)
+
+    batch = {"queue": df, "projects": None, "reports": None, "missing": []}
+    if len(df) == 0:
+        return batch
+
+    proc_ord_ids = list(df.proc_ord_id.astype(str).unique())
+
+    # Get the projects for all reports
+    q_get_report_rows = f'''
+        SELECT *
+        FROM {sql_tables["project_table"]}
+        where proc_ord_id IN @proc_ord_ids;'''
+    batch["projects"] = backend.query(q_get_report_rows, {"proc_ord_ids": proc_ord_ids})
+
+    # Get the narrative and impression for all reports, formatted for display
+    # (downloading only uncached reports)
+    batch["reports"] = load_report_texts(proc_ord_ids, backend)
+
+    missing_proc_ord_ids = list(df.proc_ord_id[~df.proc_ord_id.astype(str).isin(batch["reports"].proc_ord_id)].astype(str))
+    if len(missing_proc_ord_ids) > 0:
+        batch["missing"] = missing_proc_ord_ids
+        batch["queue"] = df[~df.proc_ord_id.astype(str).isin(missing_proc_ord_ids)]
+
+    return batch
+
+
+def flag_missing_reports(name, missing_proc_ord_ids, backend=None):
+    """
+    Grade the reports of a grader's queue that have no text 404, so grading does not
+    stop on them and they are flagged for technical review
+
+    Args:
+        name (string): Full name of the grader (to also be referenced in publications)
+        missing_proc_ord_ids (list): proc_ord_ids returned as missing by fetch_report_batch
+        backend (StorageBackend): backend to write to (default: the active backend)
+    """
+
+    global sql_tables
+    if len(missing_proc_ord_ids) == 0:
+        return
+    if backend is None:
+        backend = get_backend()
+    q_update = f'''
+    UPDATE {sql_tables["grader_table"]}
+        set grade = 404,
+        grade_date = @grade_date
+        WHERE proc_ord_id IN @missing_proc_ord_ids
+            and name = @name'''
+    changes = grade_changes([(i, name) for i in missing_proc_ord_ids], 404, backend)
+    backend.execute(q_update, {
+        "grade_date": date.today().strftime("%Y-%m-%d"),
+        "missing_proc_ord_ids": list(missing_proc_ord_ids),
+        "name": name,
+    })
+    record_grade_changes(changes, backend)
+
+
+class ReportPrefetcher:
+    """
+    Loads a grader's queue in batches on a background thread. While one batch is
+    being graded the next one (queue rows, projects and report text) is fetched,
+    so the next report is shown without waiting on the database. The background
+    thread only reads: reports without text are flagged when their batch is taken.
+    """
+
+    def __init__(self, name, batch_size=25, backend=None, executor=None, max_reports=None):
+        """
+        Args:
+            name (string): Full name of the grader (to also be referenced in publications)
+            batch_size (int): Number of reports fetched per batch
+            backend (StorageBackend): backend to read from (default: the active backend)
+            executor (ThreadPoolExecutor): pool shared by several prefetchers, e.g. in the
+                                           grading server (default: one thread of its own)
+            max_reports (int): Number of reports the caller will use. No batch is loaded
+                               beyond it (default: the whole queue)
+        """
+        self.name = name
+        self.batch_size = batch_size
+        self.backend = backend if backend is not None else get_backend()
+        self.max_reports = max_reports
+        self.handed_out = set()
+        self.num_reports = 0
+        self._owns_executor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="report-prefetch")
+        self._executor = executor
+        self._pending = None
+
+    def _fetch(self, n_reports, exclude_ids):
+        return fetch_report_batch(self.name, n_reports, exclude_ids, self.backend)
+
+    def _reports_needed(self):
+        if self.max_reports is None:
+            return self.batch_size
+        return min(self.batch_size, self.max_reports - self.num_reports)
+
+    def prefetch(self):
+        """
+        Start loading the next batch in the background (no-op if one is already loading
+        or the caller has all the reports it needs)
+        """
+        n_reports = self._reports_needed()
+        if self._pending is None and n_reports > 0:
+            # The background queries are logged under the label of the caller, e.g. mark_reports
+            self._pending = self._executor.submit(in_context(self._fetch), n_reports, frozenset(self.handed_out))
+
+    def next_batch(self):
+        """
+        Get the next batch and flag its reports without text, then start loading the
+        one after it if more reports are needed
+
+        Return:
+            batch (dictionary): see fetch_report_batch. The queue is empty when
+            the grader has no more reports (or the caller has all it needs)
+        """
+        self.prefetch()
+        if self._pending is None:
+            return {"queue": pd.DataFrame(columns=["proc_ord_id"]), "projects": None, "reports": None, "missing": []}
+        batch = self._pending.result()
+        self._pending = None
+
+        flag_missing_reports(self.name, batch["missing"], self.backend)
+        ids = batch["queue"].proc_ord_id.astype(str)
+        self.handed_out.update(ids)
+        self.handed_out.update(batch["missing"])
+        self.num_reports += len(set(ids))
+        if len(ids) > 0:
+            self.prefetch()
+        return batch
+
+    def close(self):
+        """
+        Stop the background thread (or only cancel the pending batch on a shared pool)
+        """
+        if self._owns_executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        elif self._pending is not None:
+            self._pending.cancel()
+        self._pending = None
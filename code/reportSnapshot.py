@@ -0,0 +1,258 @@
+import os
+import json
+import argparse
+from datetime import datetime
+from storageBackends import get_backend
+from reportFormatting import format_report_text
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+with open(f"{os.path.dirname(__file__)}/sql_tables.json", 'r', encoding='utf-8') as f:
+    sql_tables = json.load(f)
+
+default_snapshot_path = "~/.cache/radiology_report_grading/report_snapshot"
+
+# Number of reports downloaded per query by a delta sync
+sync_chunk_size = 5000
+
+# Delta segments are merged into the base segment once there are more than this many
+compact_after_deltas = 10
+
+
+def _watermark(proc_ord_ids):
+    # Largest numeric proc_ord_id: proc_ord_ids are assigned in increasing order, so a
+    # delta sync only has to look at the ids above it
+    ids = [int(i) for i in proc_ord_ids if str(i).isdigit()]
+    return max(ids) if len(ids) > 0 else None
+
+
+def _load_manifest(path):
+    fn = os.path.join(path, "manifest.json")
+    if not os.path.exists(fn):
+        return {"segments": [], "synced_at": None, "formatted": True, "watermark": None}
+    with open(fn, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _save_manifest(path, manifest):
+    fn = os.path.join(path, "manifest.json")
+    with open(fn + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(fn + ".tmp", fn)
+
+
+def _write_segment(path, reports, kind):
+    # One uncompressed record batch sorted by proc_ord_id, so readers can memory-map
+    # the file and binary search the id column in place
+    table = pa.table({
+        "proc_ord_id": pa.array(list(reports.keys()), pa.string()),
+        "report_text": pa.array(list(reports.values()), pa.string()),
+    }).sort_by("proc_ord_id")
+    fn = f"{kind}_{datetime.now().strftime('%Y%m%dT%H%M%S%f')}.arrow"
+    with pa.OSFile(os.path.join(path, fn + ".tmp"), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table, max_chunksize=max(len(table), 1))
+    os.replace(os.path.join(path, fn + ".tmp"), os.path.join(path, fn))
+    return {"file": fn, "kind": kind, "reports": len(table)}
+
+
+class ReportSnapshot:
+    """
+    Read-only view of the local report text snapshot. Each segment is an Arrow file
+    sorted by proc_ord_id that is memory-mapped, not loaded: a report is found by
+    binary search on the id column and only the pages holding it are read from
+    disk. Delta segments hold reports added by later syncs and are searched first.
+    The text is stored formatted for display (see format_report_text), unless the
+    snapshot was synced before that (formatted is False)
+    """
+
+    def __init__(self, path=default_snapshot_path):
+        """
+        Args:
+            path (string): Directory of the snapshot, as written by sync_report_snapshot
+        """
+        if pa is None:
+            raise ImportError("pyarrow is required for the report snapshot")
+        self.path = os.path.expanduser(path)
+        manifest = _load_manifest(self.path)
+        self.synced_at = manifest["synced_at"]
+        self.formatted = manifest.get("formatted", False)
+        self.segments = []
+        for segment in manifest["segments"][::-1]:
+            source = pa.memory_map(os.path.join(self.path, segment["file"]), "r")
+            table = pa.ipc.open_file(source).read_all()
+            if table.num_rows > 0:
+                self.segments.append((table.column("proc_ord_id").chunk(0), table.column("report_text").chunk(0)))
+
+    def __len__(self):
+        return sum(len(ids) for ids, _ in self.segments)
+
+    def _find(self, ids, proc_ord_id):
+        # Leftmost position of proc_ord_id in a sorted id column, or -1
+        low, high = 0, len(ids)
+        while low < high:
+            mid = (low + high) // 2
+            if ids[mid].as_py() < proc_ord_id:
+                low = mid + 1
+            else:
+                high = mid
+        if low < len(ids) and ids[low].as_py() == proc_ord_id:
+            return low
+        return -1
+
+    def get_many(self, proc_ord_ids):
+        """
+        Look up reports in the snapshot
+
+        Args:
+            proc_ord_ids (list): proc_ord_ids to look up
+
+        Return:
+            found (dictionary): proc_ord_id -> report_text (formatted if self.formatted)
+            for the reports in the snapshot
+        """
+        found = {}
+        for proc_ord_id in proc_ord_ids:
+            proc_ord_id = str(proc_ord_id)
+            for ids, texts in self.segments:
+                idx = self._find(ids, proc_ord_id)
+                if idx >= 0:
+                    found[proc_ord_id] = texts[idx].as_py()
+                    break
+        return found
+
+    def get(self, proc_ord_id):
+        """
+        Look up one report in the snapshot
+
+        Return:
+            (string): report text, or None if the report is not in the snapshot
+        """
+        return self.get_many([proc_ord_id]).get(str(proc_ord_id))
+
+    def ids(self):
+        """
+        Return:
+            (set): proc_ord_id of every report in the snapshot
+        """
+        return set().union(*[ids.to_pylist() for ids, _ in self.segments])
+
+
+_report_snapshot = None
+
+
+def get_report_snapshot(path=default_snapshot_path):
+    """
+    Get the report snapshot shared by the grading functions of this session
+
+    Return:
+        (ReportSnapshot): the snapshot, or None if no snapshot was synced to path
+    """
+    global _report_snapshot
+    if _report_snapshot is None:
+        if pa is None or not os.path.exists(os.path.join(os.path.expanduser(path), "manifest.json")):
+            return None
+        _report_snapshot = ReportSnapshot(path)
+    return _report_snapshot
+
+
+def set_report_snapshot(snapshot):
+    """
+    Replace the shared report snapshot (None looks for a synced snapshot again)
+    """
+    global _report_snapshot
+    _report_snapshot = snapshot
+
+
+def sync_report_snapshot(path=default_snapshot_path, backend=None, full=False):
+    """
+    Export the report text of source_table and impression_table to the local snapshot,
+    formatted for display so reading a report does not format it again. The first sync
+    (or full=True) downloads every report into a new base segment. Later syncs list only
+    the report ids above the snapshot's watermark (its largest proc_ord_id) and download
+    the reports the snapshot does not hold yet into a delta segment. Reports added late
+    for older procedures are picked up by the next full sync
+
+    Args:
+        path (string): Directory of the snapshot
+        backend (StorageBackend): backend to read from (default: the active backend)
+        full (boolean): Rebuild the snapshot from scratch, e.g. to pick up corrected reports
+
+    Return:
+        (int): number of reports added to the snapshot
+    """
+    # Imported here because reportCache imports this module
+    from reportCache import download_report_texts
+
+    global sql_tables
+    if pa is None:
+        raise ImportError("pyarrow is required for the report snapshot")
+    if backend is None:
+        backend = get_backend()
+    path = os.path.expanduser(path)
+    os.makedirs(path, exist_ok=True)
+    manifest = _load_manifest(path)
+
+    # Snapshots synced before the text was stored formatted are rebuilt once
+    if full or len(manifest["segments"]) == 0 or not manifest.get("formatted", False):
+        reports = download_report_texts(None, backend)
+        reports = {i: format_report_text(t) for i, t in reports.items()}
+        old_segments = manifest["segments"]
+        manifest["segments"] = [_write_segment(path, reports, "base")]
+        manifest["formatted"] = True
+        manifest["watermark"] = _watermark(reports.keys())
+    else:
+        watermark = manifest.get("watermark")
+        if watermark is None:
+            watermark = _watermark(ReportSnapshot(path).ids())
+        remote_ids = set()
+        for table in (sql_tables["source_table"], sql_tables["impression_table"]):
+            q_new_ids = f"SELECT DISTINCT proc_ord_id FROM {table}"
+            params = None
+            if watermark is not None:
+                q_new_ids += " WHERE CAST(proc_ord_id AS INT64) > @watermark"
+                params = {"watermark": int(watermark)}
+            remote_ids |= set(backend.query(q_new_ids, params)["proc_ord_id"].astype(str))
+        new_ids = sorted(remote_ids - ReportSnapshot(path).ids())
+        reports = {}
+        for idx in range(0, len(new_ids), sync_chunk_size):
+            reports.update(download_report_texts(new_ids[idx:idx + sync_chunk_size], backend))
+        reports = {i: format_report_text(t) for i, t in reports.items()}
+        old_segments = []
+        if len(reports) > 0:
+            manifest["segments"].append(_write_segment(path, reports, "delta"))
+            new_watermark = _watermark(reports.keys())
+            manifest["watermark"] = max(w for w in (watermark, new_watermark) if w is not None)
+            _save_manifest(path, manifest)
+        if len(manifest["segments"]) > compact_after_deltas + 1:
+            # Later segments win, as in ReportSnapshot.get_many
+            merged = {}
+            for ids, texts in ReportSnapshot(path).segments[::-1]:
+                merged.update(zip(ids.to_pylist(), texts.to_pylist()))
+            old_segments = manifest["segments"]
+            manifest["segments"] = [_write_segment(path, merged, "base")]
+
+    manifest["synced_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    _save_manifest(path, manifest)
+    # Open memory maps of removed files stay readable until they are closed
+    for segment in old_segments:
+        os.remove(os.path.join(path, segment["file"]))
+    set_report_snapshot(None)
+    return len(reports)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local snapshot of the report text for offline grading")
+    parser.add_argument("command", choices=["sync", "info"])
+    parser.add_argument("--path", default=default_snapshot_path)
+    parser.add_argument("--full", action="store_true", help="sync: rebuild the snapshot from scratch")
+    args = parser.parse_args()
+
+    if args.command == "sync":
+        print(sync_report_snapshot(args.path, full=args.full), "reports added to the snapshot")
+    else:
+        snapshot = ReportSnapshot(args.path)
+        print(len(snapshot), "reports in", len(snapshot.segments), "segment(s), synced at", snapshot.synced_at)
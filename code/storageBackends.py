@@ -0,0 +1,902 @@
+import os
+import re
+import json
+import time
+import random
+import sqlite3
+import threading
+import itertools
+import numpy as np
+import pandas as pd
+from queryLog import timed
+
+try:
+    from google.cloud import bigquery  # SQL table interface on Arcus
+except ImportError:
+    bigquery = None
+
+with open(f"{os.path.dirname(__file__)}/sql_tables.json", 'r', encoding='utf-8') as f:
+    sql_tables = json.load(f)
+
+
+# Column names and types for every table the local backend holds. The grader
+# table columns follow the insert statements in reportMarkingFunctions.py
+grader_columns = {
+    "proc_ord_id": "TEXT",
+    "name": "TEXT",
+    "grade": "INTEGER",
+    "grade_category": "TEXT",
+    "pat_id": "TEXT",
+    "age_in_days": "REAL",
+    "proc_ord_year": "INTEGER",
+    "proc_name": "TEXT",
+    "report_origin_table": "TEXT",
+    "grade_date": "TEXT",
+    "grade_criteria": "TEXT",
+}
+
+local_schema = {
+    sql_tables["grader_table"]: grader_columns,
+    sql_tables["project_table"]: {
+        "pat_id": "TEXT",
+        "proc_ord_id": "TEXT",
+        "project": "TEXT",
+    },
+    sql_tables["skipped_reports_table"]: {
+        "proc_ord_id": "TEXT",
+        "grade": "INTEGER",
+        "name": "TEXT",
+        "skip_date": "TEXT",
+        "skip_reason": "TEXT",
+        "regrade_date": "TEXT",
+        "regrade_reason": "TEXT",
+        "grade_criteria": "TEXT",
+    },
+    sql_tables["source_table"]: {
+        "proc_ord_id": "TEXT",
+        "narrative_text": "TEXT",
+    },
+    sql_tables["impression_table"]: {
+        "pat_id": "TEXT",
+        "proc_ord_id": "TEXT",
+        "impression_text": "TEXT",
+    },
+    sql_tables["procedure_table"]: {
+        "pat_id": "TEXT",
+        "proc_ord_id": "TEXT",
+        "proc_ord_age": "REAL",
+        "proc_ord_year": "INTEGER",
+        "proc_ord_desc": "TEXT",
+        "proc_ord_datetime": "TEXT",
+        "encounter_id": "TEXT",
+    },
+    sql_tables["patient_table"]: {
+        "pat_id": "TEXT",
+        "sex": "TEXT",
+        "gestational_age_num": "REAL",
+        "birth_weight_kg": "REAL",
+    },
+    "visits": {
+        "encounter_id": "TEXT",
+        "enc_type_name": "TEXT",
+    },
+    "training_selfeval": {
+        "report_id": "TEXT",
+        "grade": "INTEGER",
+        "name": "TEXT",
+        "reason": "TEXT",
+    },
+    "training_examples": {
+        "narrative_text": "TEXT",
+        "impression_text": "TEXT",
+        "grade": "INTEGER",
+    },
+    "reports_master": {
+        "proc_ord_id": "TEXT",
+        "combo_id": "TEXT",
+        "narrative_text": "TEXT",
+        "impression_text": "TEXT",
+    },
+    "lab.reliability_grades_original": dict(grader_columns, project="TEXT"),
+    sql_tables["progress_table"]: {
+        "name": "TEXT",
+        "grade_criteria": "TEXT",
+        "grade_category": "TEXT",
+        "grade": "INTEGER",
+        "n": "INTEGER",
+        "rebuilt_at": "TEXT",
+    },
+    sql_tables["candidate_pool_table"]: {
+        "project": "TEXT",
+        "grade_criteria": "TEXT",
+        "proc_ord_id": "TEXT",
+        "pat_id": "TEXT",
+        "counter": "INTEGER",
+        "grade_sum": "INTEGER",
+        "birth_weight_kg": "REAL",
+        "gestational_age_num": "REAL",
+        "proc_ord_datetime": "TEXT",
+        "proc_ord_age": "REAL",
+    },
+    sql_tables["pool_rebuilds_table"]: {
+        "project": "TEXT",
+        "grade_criteria": "TEXT",
+        "project_reports": "INTEGER",
+        "rebuilt_at": "TEXT",
+    },
+    sql_tables["claims_table"]: {
+        "proc_ord_id": "TEXT",
+        "grade_criteria": "TEXT",
+        "slot": "INTEGER",
+        "name": "TEXT",
+        "status": "TEXT",
+        "claimed_at": "TEXT",
+        "expires_at": "TEXT",
+    },
+}
+
+# Indexes that keep the grading hot path (queue reads, grade writes) fast locally
+local_indexes = {
+    sql_tables["grader_table"]: [("proc_ord_id", "name"), ("name", "grade")],
+    sql_tables["project_table"]: [("proc_ord_id",), ("project",)],
+    sql_tables["skipped_reports_table"]: [("proc_ord_id", "name")],
+    sql_tables["source_table"]: [("proc_ord_id",)],
+    sql_tables["impression_table"]: [("proc_ord_id",)],
+    sql_tables["procedure_table"]: [("proc_ord_id",), ("pat_id",)],
+    sql_tables["patient_table"]: [("pat_id",)],
+    sql_tables["progress_table"]: [("name", "grade_criteria", "grade_category", "grade")],
+    sql_tables["candidate_pool_table"]: [("project", "grade_criteria", "counter"), ("grade_criteria", "proc_ord_id")],
+    sql_tables["claims_table"]: [("grade_criteria", "proc_ord_id"), ("status", "expires_at")],
+}
+
+# Unique keys enforced locally (BigQuery has no unique constraints)
+local_unique_indexes = {
+    sql_tables["claims_table"]: [("proc_ord_id", "grade_criteria", "slot")],
+}
+
+# Tables that are snapshots of another table remotely and plain views locally
+local_views = {
+    sql_tables["reliability_source_table"]: sql_tables["source_table"],
+}
+
+# Attempts of a BigQuery transaction aborted by a concurrent transaction on the same table
+transaction_attempts = 5
+
+# Matches "IN @param" so that list parameters can be expanded per dialect
+in_param_pattern = re.compile(r"\bIN\s+@(\w+)", re.IGNORECASE)
+
+
+def _to_python(value):
+    """
+    Convert numpy/pandas scalars to the builtin types the database drivers accept
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    if value is pd.NaT or (isinstance(value, float) and np.isnan(value)):
+        return None
+    return value
+
+
+class StorageBackend:
+    """
+    Interface used by the grading functions to read and write the grading tables.
+
+    Queries are written once using "@name" parameters. Parameters passed as lists
+    may be used as "proc_ord_id IN @ids" and are expanded for each dialect.
+    """
+
+    is_local = False
+
+    def query(self, q, params=None):
+        """
+        Run a query and return the result
+
+        Args:
+            q (string): SQL query
+            params (dictionary): values for the @name parameters in the query
+
+        Return:
+            (dataframe): query result
+        """
+        raise NotImplementedError
+
+    def execute(self, q, params=None):
+        """
+        Run a statement that modifies a table (insert/update/delete/create)
+
+        Args:
+            q (string): SQL statement
+            params (dictionary): values for the @name parameters in the statement
+
+        Return:
+            (int): number of rows affected, if known
+        """
+        raise NotImplementedError
+
+    def execute_transaction(self, statements, params=None):
+        """
+        Run several statements as one transaction: other readers and writers see all
+        of their changes or none of them, and transactions running at the same time
+        are applied one after the other
+
+        Args:
+            statements (list): SQL statements
+            params (dictionary): values for the @name parameters, shared by the statements
+        """
+        raise NotImplementedError
+
+    def table_columns(self, table):
+        """
+        Column names of a table. Looked up once per backend and table, then cached
+
+        Args:
+            table (string): Name of the table
+
+        Return:
+            (list): column names in table order
+        """
+        cache = self.__dict__.setdefault("_columns_cache", {})
+        if table not in cache:
+            cache[table] = list(self.query(f"SELECT * FROM {table} LIMIT 0"))
+        return cache[table]
+
+    def insert_rows(self, table, rows):
+        """
+        Insert many rows into a table with a single statement
+
+        Args:
+            table (string): Name of the table
+            rows (list): dictionaries mapping column name to value (same columns in each row)
+        """
+        raise NotImplementedError
+
+    def update_rows(self, table, rows, key_columns):
+        """
+        Update many rows of a table with a single statement. Each row holds the key
+        columns identifying the rows to update and the new values for the other columns
+
+        Args:
+            table (string): Name of the table
+            rows (list): dictionaries mapping column name to value (same columns in each row)
+            key_columns (list): columns used to match rows, e.g. ["proc_ord_id", "name"]
+        """
+        raise NotImplementedError
+
+    def increment_rows(self, table, rows, key_columns, count_columns, insert_missing=True):
+        """
+        Add to counter columns of many rows with a single statement. Rows whose key
+        is not in the table yet are inserted with the given counts
+
+        Args:
+            table (string): Name of the table
+            rows (list): dictionaries holding the key columns and the amount to add to each count column
+            key_columns (list): columns used to match rows
+            count_columns (list): columns to add to, e.g. ["n"]
+            insert_missing (boolean): False only updates rows that already exist
+        """
+        raise NotImplementedError
+
+    def write_transaction(self, writes):
+        """
+        Run several insert_rows, update_rows and increment_rows writes as one
+        transaction (a single job on BigQuery): other readers see all of them or
+        none, and transactions running at the same time are applied one after the other
+
+        Args:
+            writes (list): (method name, table, rows, other arguments of the method) tuples, e.g.
+                           ("update_rows", "grader_table", rows, ["proc_ord_id", "name"]).
+                           Writes without rows are skipped
+        """
+        raise NotImplementedError
+
+    def insert_missing_rows(self, table, rows, key_columns):
+        """
+        Insert the rows whose key is not in the table yet, in a single statement.
+        Used to claim keys: of two writers inserting the same key at once, at most
+        one row is kept where the table enforces the key (see local_unique_indexes)
+
+        Args:
+            table (string): Name of the table
+            rows (list): dictionaries mapping column name to value (same columns in each row)
+            key_columns (list): columns identifying a row
+        """
+        raise NotImplementedError
+
+    def merge_query(self, table, source, key_columns, columns, update_columns=(), update_condition="TRUE",
+                    params=None, dry_run=False):
+        """
+        Merge the result of a query into a table in one set-based operation: rows
+        whose key is not in the table are inserted, and matching rows that meet
+        update_condition get the update_columns of the query
+
+        Args:
+            table (string): Name of the table
+            source (string): SELECT query returning at least the columns to insert
+            key_columns (list): columns used to match rows, e.g. ["proc_ord_id", "name"]
+            columns (list): columns to insert, including the key columns
+            update_columns (list): columns to update in matching rows ([] only inserts)
+            update_condition (string): condition on the matching rows to update, referring
+                                       to the table as target and the query as source
+            params (dictionary): values for the @name parameters in the query
+            dry_run (boolean): Only count the rows that would change
+
+        Return:
+            (dictionary): number of rows inserted and updated (or that would be)
+        """
+        if len(update_columns) == 0:
+            update_condition = "FALSE"
+        if dry_run:
+            on_str = " and ".join(f"target.{col} = source.{col}" for col in key_columns)
+            q = f'''
+            SELECT
+              COALESCE(SUM(CASE WHEN target.{key_columns[0]} IS NULL THEN 1 ELSE 0 END), 0) AS inserted,
+              COALESCE(SUM(CASE WHEN target.{key_columns[0]} IS NOT NULL AND ({update_condition}) THEN 1 ELSE 0 END), 0) AS updated
+            FROM ({source}) source
+            LEFT JOIN {table} target ON {on_str}'''
+            counts = self.query(q, params)
+            return {"inserted": int(counts["inserted"].values[0]), "updated": int(counts["updated"].values[0])}
+        return self._merge_query(table, source, key_columns, columns, update_columns, update_condition, params)
+
+    def _merge_query(self, table, source, key_columns, columns, update_columns, update_condition, params):
+        raise NotImplementedError
+
+    def count_rows(self, table, group_by=(), where="TRUE", params=None):
+        """
+        Count the rows of a table, optionally per value of some columns, in the
+        database: only the counts are downloaded, not the rows themselves
+
+        Args:
+            table (string): Name of the table. It is aliased as "counted", so the
+                            where clause can refer to it from a subquery
+            group_by (list): Columns to count rows for, e.g. ["grade"] ([] counts all rows)
+            where (string): Condition on the rows to count
+            params (dictionary): values for the @name parameters in the where clause
+
+        Return:
+            (dataframe): the group_by columns and the number of rows n for each group
+        """
+        group_by = list(group_by)
+        cols_str = ", ".join(group_by)
+        q = f"SELECT {cols_str + ', ' if cols_str else ''}COUNT(*) AS n FROM {table} counted WHERE {where}"
+        if len(group_by) > 0:
+            q += f" GROUP BY {cols_str}"
+        return self.query(q, params)
+
+
+class BigQueryBackend(StorageBackend):
+    """
+    Storage backend that sends queries to BigQuery
+    """
+
+    def __init__(self, client=None):
+        if client is None:
+            if bigquery is None:
+                raise ImportError("google-cloud-bigquery is required for the BigQuery backend")
+            client = bigquery.Client()
+        self.client = client
+
+    def _param_type(self, value):
+        if isinstance(value, (bool, np.bool_)):
+            return "BOOL"
+        if isinstance(value, (int, np.integer)):
+            return "INT64"
+        if isinstance(value, (float, np.floating)):
+            return "FLOAT64"
+        return "STRING"
+
+    def _job_config(self, q, params):
+        if not params:
+            return q, None
+        query_params = []
+        for key, value in params.items():
+            if isinstance(value, (list, tuple, set, np.ndarray, pd.Series)):
+                values = [_to_python(v) for v in value]
+                value_type = self._param_type(values[0]) if len(values) > 0 else "STRING"
+                query_params.append(bigquery.ArrayQueryParameter(key, value_type, values))
+            else:
+                query_params.append(
+                    bigquery.ScalarQueryParameter(key, self._param_type(value), _to_python(value))
+                )
+        q = in_param_pattern.sub(lambda m: f"IN UNNEST(@{m.group(1)})", q)
+        return q, bigquery.QueryJobConfig(query_parameters=query_params)
+
+    def query(self, q, params=None):
+        q, job_config = self._job_config(q, params)
+        with timed("query", q) as record:
+            start = time.perf_counter()
+            job = self.client.query(q, job_config=job_config)
+            job.result()
+            # Running the query and downloading the result are timed separately
+            record["job_seconds"] = time.perf_counter() - start
+            df = job.to_dataframe()
+            record["rows"] = len(df)
+            record["bytes_processed"] = job.total_bytes_processed
+        return df
+
+    def execute(self, q, params=None):
+        q, job_config = self._job_config(q, params)
+        return self._run_job("execute", q, job_config).num_dml_affected_rows
+
+    def execute_transaction(self, statements, params=None):
+        q, job_config = self._job_config(
+            "BEGIN TRANSACTION;\n" + ";\n".join(statements) + ";\nCOMMIT TRANSACTION;", params
+        )
+        self._run_transaction("transaction", q, job_config)
+
+    def _run_transaction(self, operation, q, job_config):
+        """
+        Run a BEGIN/COMMIT script, again if a concurrent transaction aborted it
+        """
+        for attempt in range(transaction_attempts):
+            try:
+                self._run_job(operation, q, job_config)
+                return
+            except Exception as e:
+                # Of transactions changing the same table at once all but one are
+                # aborted (and rolled back): run this one again on the new data
+                if "concurrent update" not in str(e).lower() or attempt == transaction_attempts - 1:
+                    raise
+                time.sleep(random.uniform(0.5, 1.5) * 2 ** attempt)
+
+    def _run_job(self, operation, q, job_config):
+        """
+        Run a statement, wait for it to finish and log it
+        """
+        with timed(operation, q) as record:
+            job = self.client.query(q, job_config=job_config)
+            job.result()
+            record["rows"] = job.num_dml_affected_rows
+            record["bytes_processed"] = job.total_bytes_processed
+        return job
+
+    def _rows_param(self, rows, name="rows"):
+        """
+        Convert a list of row dictionaries to an ARRAY<STRUCT> query parameter
+        """
+        columns = list(rows[0].keys())
+        types = {}
+        for col in columns:
+            values = [_to_python(row[col]) for row in rows if _to_python(row[col]) is not None]
+            types[col] = self._param_type(values[0]) if len(values) > 0 else "STRING"
+        structs = [
+            bigquery.StructQueryParameter(
+                None, *[bigquery.ScalarQueryParameter(col, types[col], _to_python(row[col])) for col in columns]
+            )
+            for row in rows
+        ]
+        return bigquery.ArrayQueryParameter(name, "STRUCT", structs)
+
+    def _insert_rows_sql(self, table, rows, param="rows"):
+        cols_str = ", ".join(rows[0].keys())
+        return f"insert into {table} ({cols_str}) select {cols_str} from unnest(@{param})"
+
+    def insert_rows(self, table, rows):
+        if len(rows) == 0:
+            return 0
+        q = self._insert_rows_sql(table, rows)
+        job_config = bigquery.QueryJobConfig(query_parameters=[self._rows_param(rows)])
+        return self._run_job("insert_rows", q, job_config).num_dml_affected_rows
+
+    def _update_rows_sql(self, table, rows, key_columns, param="rows"):
+        on_str = " and ".join(f"target.{col} = source.{col}" for col in key_columns)
+        set_str = ", ".join(f"{col} = source.{col}" for col in rows[0].keys() if col not in key_columns)
+        return f'''
+        merge {table} target
+        using unnest(@{param}) source
+        on {on_str}
+        when matched then update set {set_str}'''
+
+    def update_rows(self, table, rows, key_columns):
+        if len(rows) == 0:
+            return 0
+        q = self._update_rows_sql(table, rows, key_columns)
+        job_config = bigquery.QueryJobConfig(query_parameters=[self._rows_param(rows)])
+        return self._run_job("update_rows", q, job_config).num_dml_affected_rows
+
+    def insert_missing_rows(self, table, rows, key_columns):
+        if len(rows) == 0:
+            return 0
+        columns = list(rows[0].keys())
+        on_str = " and ".join(f"target.{col} = source.{col}" for col in key_columns)
+        q = f'''
+        merge {table} target
+        using unnest(@rows) source
+        on {on_str}
+        when not matched then insert ({", ".join(columns)})
+            values ({", ".join("source." + col for col in columns)})'''
+        job_config = bigquery.QueryJobConfig(query_parameters=[self._rows_param(rows)])
+        return self._run_job("insert_missing_rows", q, job_config).num_dml_affected_rows
+
+    def _increment_rows_sql(self, table, rows, key_columns, count_columns, insert_missing=True, param="rows"):
+        columns = list(rows[0].keys())
+        on_str = " and ".join(f"target.{col} = source.{col}" for col in key_columns)
+        set_str = ", ".join(f"{col} = target.{col} + source.{col}" for col in count_columns)
+        q = f'''
+        merge {table} target
+        using unnest(@{param}) source
+        on {on_str}
+        when matched then update set {set_str}'''
+        if insert_missing:
+            q += f'''
+        when not matched then insert ({", ".join(columns)})
+            values ({", ".join("source." + col for col in columns)})'''
+        return q
+
+    def increment_rows(self, table, rows, key_columns, count_columns, insert_missing=True):
+        if len(rows) == 0:
+            return 0
+        q = self._increment_rows_sql(table, rows, key_columns, count_columns, insert_missing)
+        job_config = bigquery.QueryJobConfig(query_parameters=[self._rows_param(rows)])
+        return self._run_job("increment_rows", q, job_config).num_dml_affected_rows
+
+    def write_transaction(self, writes):
+        statements, query_params = [], []
+        for i, (method, table, rows, *args) in enumerate(w for w in writes if len(w[2]) > 0):
+            # Each write reads its rows from its own parameter
+            statements.append(getattr(self, f"_{method}_sql")(table, rows, *args, param=f"rows_{i}"))
+            query_params.append(self._rows_param(rows, f"rows_{i}"))
+        if len(statements) == 0:
+            return
+        q = "BEGIN TRANSACTION;\n" + ";\n".join(statements) + ";\nCOMMIT TRANSACTION;"
+        self._run_transaction("write_transaction", q, bigquery.QueryJobConfig(query_parameters=query_params))
+
+    def _merge_query(self, table, source, key_columns, columns, update_columns, update_condition, params):
+        on_str = " and ".join(f"target.{col} = source.{col}" for col in key_columns)
+        q = f'''
+        merge {table} target
+        using ({source}) source
+        on {on_str}'''
+        if len(update_columns) > 0:
+            q += f'''
+        when matched and ({update_condition}) then update set {", ".join(f"{col} = source.{col}" for col in update_columns)}'''
+        q += f'''
+        when not matched then insert ({", ".join(columns)})
+            values ({", ".join("source." + col for col in columns)})'''
+        q, job_config = self._job_config(q, params)
+        job = self._run_job("merge_query", q, job_config)
+        return {"inserted": job.dml_stats.inserted_row_count, "updated": job.dml_stats.updated_row_count}
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    Embedded storage backend holding the grading tables in a local SQLite database.
+    Used to grade, benchmark and test the pipeline on a single workstation.
+    """
+
+    is_local = True
+    _memory_ids = itertools.count()
+
+    def __init__(self, path=":memory:"):
+        """
+        Args:
+            path (string): Database file. ":memory:" keeps the tables in memory
+        """
+        if path == ":memory:":
+            # A named shared-cache database so that every thread sees the same tables
+            self.uri = f"file:grading_{os.getpid()}_{next(self._memory_ids)}?mode=memory&cache=shared"
+        else:
+            path = os.path.expanduser(path)
+            self.uri = f"file:{path}"
+        self.path = path
+        self._local = threading.local()
+
+        # Tables with dots in their name (dataset.table) are quoted for SQLite
+        dotted = sorted([t for t in list(local_schema) + list(local_views) if "." in t], key=len)[::-1]
+        self._dotted_pattern = None
+        if len(dotted) > 0:
+            self._dotted_pattern = re.compile(
+                r'(?<!["\w])(' + "|".join(re.escape(t) for t in dotted) + r')(?!["\w])'
+            )
+
+        # Hold a connection open so an in-memory database lives as long as the backend
+        self._keep_alive = self._connect()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.uri, uri=True, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA busy_timeout = 30000")
+        if self.path != ":memory:":
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+        return conn
+
+    @property
+    def conn(self):
+        """
+        Connection for the calling thread (sqlite connections are not shared across threads)
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    def _prepare(self, q, params):
+        if self._dotted_pattern is not None:
+            q = self._dotted_pattern.sub(lambda m: '"' + m.group(1) + '"', q)
+        if not params:
+            return q, {}
+
+        bound = {}
+        for key, value in params.items():
+            if isinstance(value, (list, tuple, set, np.ndarray, pd.Series)):
+                continue
+            bound[key] = _to_python(value)
+
+        def expand(m):
+            key = m.group(1)
+            values = params[key]
+            if not isinstance(values, (list, tuple, set, np.ndarray, pd.Series)):
+                return m.group(0)
+            if len(values) == 0:
+                # SQLite accepts empty lists, so "NOT IN @ids" stays true for no ids
+                return "IN ()"
+            names = []
+            for idx, value in enumerate(values):
+                bound[f"{key}_{idx}"] = _to_python(value)
+                names.append(f"@{key}_{idx}")
+            return "IN (" + ", ".join(names) + ")"
+
+        q = in_param_pattern.sub(expand, q)
+        return q, bound
+
+    def query(self, q, params=None):
+        q, bound = self._prepare(q, params)
+        with timed("query", q) as record:
+            cursor = self.conn.execute(q, bound)
+            columns = [d[0] for d in cursor.description] if cursor.description else []
+            df = pd.DataFrame.from_records(cursor.fetchall(), columns=columns)
+            record["rows"] = len(df)
+        return df
+
+    def execute(self, q, params=None):
+        q, bound = self._prepare(q, params)
+        with timed("execute", q) as record:
+            cursor = self.conn.execute(q, bound)
+            record["rows"] = max(cursor.rowcount, 0)
+        return record["rows"]
+
+    def execute_transaction(self, statements, params=None):
+        prepared = [self._prepare(q, params) for q in statements]
+        conn = self.conn
+        with timed("transaction", ";\n".join(q for q, _ in prepared)) as record:
+            # Take the write lock up front, so concurrent transactions wait for each other
+            conn.execute("begin immediate")
+            try:
+                rows = 0
+                for q, bound in prepared:
+                    rows += max(conn.execute(q, bound).rowcount, 0)
+                conn.execute("commit")
+            except BaseException:
+                conn.execute("rollback")
+                raise
+            record["rows"] = rows
+
+    def create_tables(self):
+        """
+        Create the grading tables, indexes and views if they do not exist yet
+        """
+        self.__dict__.pop("_columns_cache", None)
+        for table, columns in local_schema.items():
+            cols_str = ", ".join(f"{col} {col_type}" for col, col_type in columns.items())
+            self.execute(f"create table if not exists {table} ({cols_str})")
+        for table, indexes in local_indexes.items():
+            for cols in indexes:
+                index_name = "idx_" + re.sub(r"\W", "_", table) + "_" + "_".join(cols)
+                self.execute(f"create index if not exists {index_name} on {table} ({', '.join(cols)})")
+        for table, indexes in local_unique_indexes.items():
+            for cols in indexes:
+                index_name = "uq_" + re.sub(r"\W", "_", table) + "_" + "_".join(cols)
+                self.execute(f"create unique index if not exists {index_name} on {table} ({', '.join(cols)})")
+        for view, table in local_views.items():
+            if view != table:
+                self.execute(f"create view if not exists {view} as select * from {table}")
+
+    def _executemany(self, q, rows, operation):
+        """
+        Run one statement for many rows inside a single transaction
+        """
+        q, _ = self._prepare(q, None)
+        conn = self.conn
+        with timed(operation, q) as record:
+            conn.execute("begin")
+            try:
+                cursor = conn.executemany(q, rows)
+                conn.execute("commit")
+            except BaseException:
+                conn.execute("rollback")
+                raise
+            record["rows"] = max(cursor.rowcount, 0)
+        return record["rows"]
+
+    def _insert_rows_sql(self, table, rows):
+        columns = list(rows[0].keys())
+        q = (
+            "insert into " + table + " (" + ", ".join(columns) + ") values ("
+            + ", ".join("?" for _ in columns) + ")"
+        )
+        return q, [tuple(_to_python(row[col]) for col in columns) for row in rows]
+
+    def insert_rows(self, table, rows):
+        if len(rows) == 0:
+            return 0
+        return self._executemany(*self._insert_rows_sql(table, rows), "insert_rows")
+
+    def _update_rows_sql(self, table, rows, key_columns):
+        set_columns = [col for col in rows[0].keys() if col not in key_columns]
+        q = (
+            "update " + table + " set " + ", ".join(f"{col} = ?" for col in set_columns)
+            + " where " + " and ".join(f"{col} = ?" for col in key_columns)
+        )
+        return q, [tuple(_to_python(row[col]) for col in set_columns + list(key_columns)) for row in rows]
+
+    def update_rows(self, table, rows, key_columns):
+        if len(rows) == 0:
+            return 0
+        return self._executemany(*self._update_rows_sql(table, rows, key_columns), "update_rows")
+
+    def insert_missing_rows(self, table, rows, key_columns):
+        # Relies on a unique index over key_columns (see local_unique_indexes)
+        if len(rows) == 0:
+            return 0
+        columns = list(rows[0].keys())
+        q = (
+            "insert or ignore into " + table + " (" + ", ".join(columns) + ") values ("
+            + ", ".join("?" for _ in columns) + ")"
+        )
+        return self._executemany(
+            q, [tuple(_to_python(row[col]) for col in columns) for row in rows], "insert_missing_rows"
+        )
+
+    def _increment_rows_sql(self, table, rows, key_columns, count_columns):
+        q_update, _ = self._prepare(
+            "update " + table + " set " + ", ".join(f"{col} = {col} + ?" for col in count_columns)
+            + " where " + " and ".join(f"{col} = ?" for col in key_columns), None
+        )
+        q_insert, _ = self._prepare(self._insert_rows_sql(table, rows)[0], None)
+        return q_update, q_insert
+
+    def _increment(self, conn, table, rows, key_columns, count_columns, insert_missing=True):
+        # Apply the increments on an open transaction
+        columns = list(rows[0].keys())
+        q_update, q_insert = self._increment_rows_sql(table, rows, key_columns, count_columns)
+        for row in rows:
+            values = [_to_python(row[col]) for col in list(count_columns) + list(key_columns)]
+            if conn.execute(q_update, values).rowcount == 0 and insert_missing:
+                conn.execute(q_insert, [_to_python(row[col]) for col in columns])
+        return len(rows)
+
+    def increment_rows(self, table, rows, key_columns, count_columns, insert_missing=True):
+        if len(rows) == 0:
+            return 0
+        conn = self.conn
+        with timed("increment_rows", self._increment_rows_sql(table, rows, key_columns, count_columns)[0]) as record:
+            conn.execute("begin")
+            try:
+                record["rows"] = self._increment(conn, table, rows, key_columns, count_columns, insert_missing)
+                conn.execute("commit")
+            except BaseException:
+                conn.execute("rollback")
+                raise
+        return record["rows"]
+
+    def write_transaction(self, writes):
+        writes = [w for w in writes if len(w[2]) > 0]
+        if len(writes) == 0:
+            return
+        statements = []
+        for method, table, rows, *args in writes:
+            if method == "increment_rows":
+                statements.append(("increment_rows", self._increment_rows_sql(table, rows, *args[:2])[0], None))
+            else:
+                q, values = getattr(self, f"_{method}_sql")(table, rows, *args)
+                statements.append((method, self._prepare(q, None)[0], values))
+        conn = self.conn
+        with timed("write_transaction", ";\n".join(q for _, q, _ in statements)) as record:
+            # Take the write lock up front, so concurrent transactions wait for each other
+            conn.execute("begin immediate")
+            try:
+                rows_written = 0
+                for (method, q, values), (_, table, rows, *args) in zip(statements, writes):
+                    if method == "increment_rows":
+                        rows_written += self._increment(conn, table, rows, *args)
+                    else:
+                        rows_written += max(conn.executemany(q, values).rowcount, 0)
+                conn.execute("commit")
+            except BaseException:
+                conn.execute("rollback")
+                raise
+            record["rows"] = rows_written
+
+    def _merge_query(self, table, source, key_columns, columns, update_columns, update_condition, params):
+        # SQLite has no MERGE: update the matching rows, then insert the others, in one transaction
+        on_str = " and ".join(f"target.{col} = source.{col}" for col in key_columns)
+        conn = self.conn
+        with timed("merge_query", source) as record:
+            conn.execute("begin")
+            try:
+                updated = 0
+                if len(update_columns) > 0:
+                    q_update, values = self._prepare(
+                        f"update {table} as target set {', '.join(f'{col} = source.{col}' for col in update_columns)} "
+                        f"from ({source}) as source where {on_str} and ({update_condition})",
+                        params,
+                    )
+                    updated = conn.execute(q_update, values).rowcount
+                q_insert, values = self._prepare(
+                    f"insert into {table} ({', '.join(columns)}) "
+                    f"select {', '.join('source.' + col for col in columns)} from ({source}) as source "
+                    f"where not exists (select 1 from {table} target where {on_str})",
+                    params,
+                )
+                inserted = conn.execute(q_insert, values).rowcount
+                conn.execute("commit")
+            except BaseException:
+                conn.execute("rollback")
+                raise
+            record["rows"] = max(inserted, 0) + max(updated, 0)
+        return {"inserted": max(inserted, 0), "updated": max(updated, 0)}
+
+    def load_dataframe(self, df, table):
+        """
+        Append the rows of a dataframe to a local table
+
+        Args:
+            df (dataframe): Rows to add. Columns must exist in the table
+            table (string): Name of the table
+        """
+        if len(df) == 0:
+            return
+        q = (
+            "insert into " + table + " (" + ", ".join(df.columns) + ") values ("
+            + ", ".join("?" for _ in df.columns) + ")"
+        )
+        self._executemany(
+            q, [tuple(_to_python(v) for v in row) for row in df.itertuples(index=False, name=None)], "load_dataframe"
+        )
+
+
+def set_backend(backend):
+    """
+    Select the storage backend used by all of the grading functions
+
+    Args:
+        backend (StorageBackend): backend instance, e.g. SQLiteBackend("~/grading.db")
+    """
+    # Imported here: the connection manager builds on the backends of this module
+    from connectionManager import get_connection_manager
+    get_connection_manager().set_backend(backend)
+
+
+def get_backend():
+    """
+    Get the storage backend used by the grading functions, created once per process
+    (see connectionManager.py). Defaults to BigQuery unless the RADIOLOGY_GRADING_DB
+    environment variable points to a local database file.
+
+    Return:
+        (StorageBackend): active backend
+    """
+    from connectionManager import get_connection_manager
+    return get_connection_manager().get_backend()
+
+
+def as_backend(client=None):
+    """
+    Wrap a bigquery client (as passed around by the notebooks) in a storage backend
+
+    Args:
+        client: A bigquery client object, a StorageBackend, or None for the active backend
+
+    Return:
+        (StorageBackend): backend to use
+    """
+    if client is None:
+        return get_backend()
+    if isinstance(client, StorageBackend):
+        return client
+    # The shared client, e.g. from get_client(), keeps using the shared backend
+    from connectionManager import get_connection_manager
+    active = get_connection_manager().current_backend()
+    if active is not None and getattr(active, "client", None) is client:
+        return active
+    return BigQueryBackend(client)